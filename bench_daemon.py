@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+
+# Measure the round-trip latency of small requests to a running daemon,
+# sending the message inline and through files (see scipherd.PROTOCOL), and
+# the time per message when they're sent in one batch.
+#
+#     ./scipherd.py --socket ipc:///tmp/scipherd &
+#     ./bench_daemon.py --socket ipc:///tmp/scipherd
+
+import argparse
+import os
+import scipher_client
+import tempfile
+import time
+
+def inline_request(socket_name, command, data):
+     (ok, reply) = scipher_client.send_request(
+          socket_name, [scipher_client.PROTOCOL, command, data])
+     if not ok:
+          raise Exception(reply[0])
+     return reply[0]
+
+def file_request(socket_name, command, data):
+     # what call_daemon does with --socket-files, for data from stdin
+     (inf, infile) = tempfile.mkstemp()
+     os.write(inf, data)
+     os.close(inf)
+     (outf, outfile) = tempfile.mkstemp()
+     os.close(outf)
+     (ok, reply) = scipher_client.send_request(
+          socket_name,
+          [scipher_client.PROTOCOL, command + "-file", infile, outfile])
+     f = open(outfile, 'rb')
+     result = f.read()
+     f.close()
+     os.unlink(infile)
+     os.unlink(outfile)
+     if not ok:
+          raise Exception(reply[0])
+     return result
+
+def time_requests(request, socket_name, command, data, count):
+     times = []
+     for i in xrange(count):
+          start = time.time()
+          request(socket_name, command, data)
+          times.append(time.time() - start)
+     times.sort()
+     return (times[len(times)//2], times[len(times)*9//10])
+
+def time_batch(socket_name, command, data, count):
+     start = time.time()
+     jobs = [(command, data)]*count
+     for (index, ok, result) in scipher_client.send_batch(socket_name, jobs):
+          if not ok:
+               raise Exception(result)
+     return (time.time() - start)/count
+
+def main():
+     parser = argparse.ArgumentParser(
+          description='Benchmark small requests to scipherd.py.')
+     parser.add_argument('--socket', metavar='S', type=str,
+                         default="ipc:///tmp/scipherd",
+                         help='the daemon\'s socket')
+     parser.add_argument('--count', metavar='N', type=int, default=100,
+                         help='requests of each kind to time')
+     parser.add_argument('--message', metavar='M', type=str,
+                         default="This is a secret",
+                         help='the message to encode and decode')
+     args = parser.parse_args()
+
+     cfp = inline_request(args.socket, "encode", args.message)
+     print "%-8s %-8s %10s %10s" % ("mode", "command", "median ms", "p90 ms")
+     for (mode, request) in [("inline", inline_request),
+                             ("files", file_request)]:
+          for (command, data) in [("encode", args.message),
+                                  ("decode", cfp)]:
+               (median, p90) = time_requests(request, args.socket, command,
+                                             data, args.count)
+               print "%-8s %-8s %10.2f %10.2f" % (mode, command,
+                                                  median*1000, p90*1000)
+     # a batch only has a total time, so report the time per message
+     for (command, data) in [("encode", args.message), ("decode", cfp)]:
+          each = time_batch(args.socket, command, data, args.count)
+          print "%-8s %-8s %10.2f %10s" % ("batch", command, each*1000, "-")
+
+if __name__ == "__main__":
+     main()
@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+
+# Time the encoder on messages of increasing size, to check that it scales
+# linearly: the time per byte should stay about the same.
+#
+#     ./bench_encode.py
+#     ./bench_encode.py --sizes 1024,1048576 --repeat 1
+
+import argparse
+import bench_parse
+import cfp_common
+import random
+import time
+
+def main():
+     parser = argparse.ArgumentParser(
+          description='Benchmark the encoder at several message sizes.')
+     parser.add_argument('--sizes', metavar='N,N,...', type=str,
+                         default='1024,4096,16384,65536,262144,1048576',
+                         help='message sizes to try, in bytes')
+     parser.add_argument('--repeat', metavar='R', type=int, default=3,
+                         help='runs per size; the fastest one is reported')
+     parser.add_argument('--seed', metavar='S', type=int, default=1,
+                         help='the random number generator seed')
+     args = parser.parse_args()
+
+     common = cfp_common.CfpCommon.get_latest_common()
+     # load the grammars before timing anything
+     bench_parse.encode_message(common, u"x", args.seed)
+
+     print "%10s %10s %10s %12s" % ("bytes", "output", "time (s)",
+                                    "us/byte")
+     for size in [int(s) for s in args.sizes.split(",")]:
+          rnd = random.Random(args.seed + size)
+          msg = u"".join(unichr(rnd.randint(32, 126)) for i in xrange(size))
+          best = None
+          for i in xrange(args.repeat):
+               start = time.time()
+               (header, body) = bench_parse.encode_message(common, msg,
+                                                           args.seed)
+               elapsed = time.time() - start
+               if best is None or elapsed < best:
+                    best = elapsed
+          print "%10d %10d %10.3f %12.2f" % (size, len(header) + len(body),
+                                             best, best*1e6/size)
+
+if __name__ == "__main__":
+     main()
@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+
+# Compare the LR parser (lr_parser.py) against nltk's chart parser, which
+# decode.py used to use, on the body of encoded messages of a few sizes.
+#
+#     ./bench_parse.py
+#     ./bench_parse.py --sizes 1024,65536 --chart-max 0
+#
+# The chart parser is slow and runs out of stack on messages of more than a
+# few KB, so it is only run for sizes up to --chart-max bytes.  It only
+# knows how version 1 and before code their choices, so --version can't be
+# any later.
+#
+# Some productions are the same once lower-cased for decoding (e.g.
+# "Colleague" and "colleague"), and both parsers have to take the first of
+# them.  Unless --duplicate-tries is 0, the parsers are also compared on a
+# small CFP that uses one of those.
+
+import argparse
+import cfp_common
+import decode
+import encode
+import grammar_cache
+import lr_parser
+import random
+import re
+import resource
+import time
+
+# encoding grammars, by file name
+grammars = {}
+
+def load_grammar(filename):
+     if filename not in grammars:
+          grammars[filename] = grammar_cache.load_grammar(filename)
+     return grammars[filename]
+
+def encode_message(common, msg, seed):
+     random.seed(seed)
+     state = encode.new_state(common, msg,
+                              load_grammar(common.header_cfg_filename()),
+                              load_grammar(common.body_cfg_filename()))
+     return encode.do_encode(state)
+
+def duplicated_rules(grammar, common):
+     """The ids of the productions that a later production of the same
+     nonterminal repeats, the way the decoder sees them.  Those are the
+     ones both parsers should pick.  Only nonterminals whose choices carry
+     bits are included, since for the rest the pick doesn't matter."""
+     (start, names, is_nonterm, prods, lhs_index) = grammar.table
+     bits = grammar.choices(common).bits
+     dups = set()
+     for lhs, ps in lhs_index.iteritems():
+          if bits[lhs] == 0:
+               continue
+          first = {}
+          for p in ps:
+               rhs = prods[p][1]
+               if rhs in first:
+                    dups.add(first[rhs])
+               else:
+                    first[rhs] = p
+     return dups
+
+def used_productions(text, grammar, common):
+     """The ids of the productions in the LR parser's tree for text."""
+     parse = lr_parser.Parse(grammar.parser(common))
+     for w in decode.text_to_words(text):
+          if not parse.feed(w):
+               return set()
+     used = set()
+     todo = [parse.finish()]
+     while todo:
+          node = todo.pop()
+          if node is not None:
+               used.add(node[0])
+               todo.extend(node[1])
+     return used
+
+def check_duplicates(common, grammar, seed, tries):
+     """Compare the parsers on the first of up to tries small messages
+     whose CFP uses a duplicated production."""
+     dups = duplicated_rules(grammar, common)
+     if not dups:
+          print "No duplicated productions to check"
+          return
+     size = 16
+     for i in xrange(tries):
+          rnd = random.Random(seed + i)
+          msg = u"".join(unichr(rnd.randint(32, 126)) for j in xrange(size))
+          (header, body) = encode_message(common, msg, seed + i)
+          (text, state, mask) = unpretty(common, grammar, header, body)
+          used = sorted(dups & used_productions(text, grammar, common))
+          if not used:
+               continue
+          (t, lr_bits) = time_parse(decode.parse_text, text, grammar,
+                                    state, size*8)
+          (t, chart_bits) = time_parse(decode.chart_parse_text, text,
+                                       grammar, state, size*8)
+          rule = grammar.production(used[0])
+          if chart_bits.getvalue() != lr_bits.getvalue():
+               print "Parsers disagree on duplicated production %s" % rule
+          else:
+               print "Parsers agree on duplicated production %s" % rule
+          return
+     print "No CFP used a duplicated production in %d tries" % tries
+
+def unpretty(common, grammar, header, body):
+     """The body text, ready to parse, and the decode state and mask."""
+     (conf_name, mask, version, ls_len,
+      compressed) = decode.decode_conf_name(header)
+     space_before = re.compile('([%s])' %
+                               common.chars_to_remove_a_space_before())
+     space_after = re.compile('([%s])' %
+                              common.chars_to_remove_a_space_after())
+     state = decode.DecodeState(common, conf_name, mask, None, grammar,
+                                {}, space_before, space_after,
+                                decode.Done())
+     return (decode.unpretty_body(body, state), state, mask)
+
+def time_parse(parse, text, grammar, state, length):
+     state.list_bits.clear()
+     start = time.time()
+     bits = parse(text, grammar, state, length)
+     return (time.time() - start, bits)
+
+def main():
+     parser = argparse.ArgumentParser(
+          description='Benchmark the decoder\'s parsers.')
+     parser.add_argument('--sizes', metavar='N,N,...', type=str,
+                         default='1024,65536,1048576',
+                         help='message sizes to try, in bytes')
+     parser.add_argument('--chart-max', metavar='N', type=int, default=4096,
+                         help='largest message to run the chart parser on')
+     parser.add_argument('--seed', metavar='S', type=int, default=1,
+                         help='the random number generator seed')
+     parser.add_argument('--version', metavar='V', type=int, default=1,
+                         help='the grammar version (default: 1)')
+     parser.add_argument('--duplicate-tries', metavar='N', type=int,
+                         default=200,
+                         help='how many small messages to encode looking '
+                         'for one that uses a duplicated production')
+     args = parser.parse_args()
+
+     common = cfp_common.CfpCommon.get_common_for_version(args.version)
+     if common is None or common.uses_all_productions():
+          parser.error("the chart parser can't decode version %d" %
+                       args.version)
+     grammar = decode.load_and_norm_grammar(common.body_cfg_filename())
+     # build (or load) the parse tables up front, so they aren't timed
+     grammar.parser()
+
+     print "%10s %10s %10s %10s %10s" % ("bytes", "words", "lr (s)",
+                                         "chart (s)", "maxrss (MB)")
+     for size in [int(s) for s in args.sizes.split(",")]:
+          rnd = random.Random(args.seed + size)
+          msg = u"".join(unichr(rnd.randint(32, 126)) for i in xrange(size))
+          (header, body) = encode_message(common, msg, args.seed)
+          (text, state, mask) = unpretty(common, grammar, header, body)
+          words = len(decode.text_to_words(text))
+
+          (lr_time, lr_bits) = time_parse(decode.parse_text, text, grammar,
+                                          state, size*8)
+          if decode.bin_to_text(lr_bits, mask) != msg:
+               print "LR parser decoded %d bytes incorrectly" % size
+          chart_time = "-"
+          if size <= args.chart_max:
+               try:
+                    (t, chart_bits) = time_parse(decode.chart_parse_text,
+                                                 text, grammar, state, size*8)
+                    chart_time = "%.3f" % t
+                    if chart_bits.getvalue() != lr_bits.getvalue():
+                         print "Parsers disagree for %d bytes" % size
+               except RuntimeError:
+                    # nltk builds the trees recursively, so long lists blow
+                    # past python's recursion limit
+                    chart_time = "failed"
+          maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024.0
+          print "%10d %10d %10.3f %10s %10.1f" % (size, words, lr_time,
+                                                  chart_time, maxrss)
+
+     if args.duplicate_tries > 0:
+          check_duplicates(common, grammar, args.seed, args.duplicate_tries)
+
+if __name__ == "__main__":
+     main()
@@ -0,0 +1,377 @@
+#!/usr/bin/env python
+
+# Benchmark encoding and decoding end to end, and write the results as
+# JSON, one line per case, so that runs can be compared:
+#
+#     ./bench_suite.py > before.jsonl
+#     ... change something ...
+#     ./bench_suite.py --compare before.jsonl > after.jsonl
+#
+# The messages are random printable text ending in a newline, the same for
+# a given --seed and size, and every encoding uses the same seed, so each
+# run does the same work.  The cases are:
+#
+#   inprocess   do_encode and decode, in this process, once per grammar
+#               version (each case runs in a child process of its own, so
+#               it gets its own peak RSS)
+#   script      encode.py and decode.py, one process per message, grammar
+#               loading included
+#   daemon      scipherd.py with each number of --workers (in processes,
+#               when there are several), timed one request at a time for
+#               the latencies and with all of them in flight for ops/sec
+#
+# Each line has the case's mode, op, version, workers and size, and:
+#
+#   ops          how many messages were timed
+#   ops_per_sec  messages per second
+#   p50_ms, p99_ms
+#                latency percentiles
+#   peak_rss_mb  the peak RSS of the process(es) doing the work
+#   expansion    CFP bytes per message byte
+#
+# Big messages are only run a few times: each case is repeated until it
+# has handled about --case-bytes of messages, up to --ops times.
+
+import argparse
+import cfp_common
+import decode
+import encode
+import grammar_cache
+import json
+import os
+import platform
+import random
+import resource
+import scipher_client
+import subprocess
+import sys
+import tempfile
+import time
+
+# each case's key, for --compare
+KEY = ("mode", "op", "version", "workers", "size")
+
+def message(seed, size):
+     # a line of text, since decode.py ends its output with a newline
+     rnd = random.Random(seed + size)
+     return u"".join(unichr(rnd.randint(32, 126))
+                     for i in xrange(size - 1)) + u"\n"
+
+def percentile(times, p):
+     times = sorted(times)
+     return times[min(len(times) - 1, len(times)*p//100)]
+
+def result(case, times, msg_bytes, cfp_bytes, peak_rss_mb):
+     r = dict(case)
+     r.update({'ops': len(times),
+               'ops_per_sec': len(times)/sum(times),
+               'p50_ms': percentile(times, 50)*1000,
+               'p99_ms': percentile(times, 99)*1000,
+               'peak_rss_mb': peak_rss_mb,
+               'expansion': float(cfp_bytes)/msg_bytes})
+     return r
+
+def log(msg):
+     sys.stderr.write(msg + "\n")
+
+def in_child(func, *args):
+     """Run func(*args) in a child process, and return what it returns
+     (which must be JSON), or raise an Exception if the child failed."""
+     (fd, path) = tempfile.mkstemp()
+     os.close(fd)
+     pid = os.fork()
+     if pid == 0:
+          status = 1
+          try:
+               out = open(path, 'w')
+               json.dump(func(*args), out)
+               out.close()
+               status = 0
+          finally:
+               os._exit(status)
+     (pid, status) = os.waitpid(pid, 0)
+     f = open(path)
+     data = f.read()
+     f.close()
+     os.unlink(path)
+     if status != 0:
+          raise Exception("Benchmark child process failed")
+     return json.loads(data)
+
+def self_peak_rss_mb():
+     return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024.0
+
+def encode_once(common, msg, seed):
+     random.seed(seed)
+     state = encode.new_state(
+          common, msg, grammar_cache.load_grammar(common.header_cfg_filename()),
+          grammar_cache.load_grammar(common.body_cfg_filename()))
+     (header, body) = encode.do_encode(state)
+     return u"%s\n\n%s\n" % (header, body)
+
+def decode_once(cfp):
+     return decode.decode_lines(iter(cfp.splitlines(True)))
+
+def inprocess_encode(version, size, ops, seed):
+     common = cfp_common.CfpCommon.get_common_for_version(version)
+     msg = message(seed, size)
+     # load the grammars and build the tables before timing anything
+     encode_once(common, u"x", seed)
+     times = []
+     for i in xrange(ops):
+          start = time.time()
+          cfp = encode_once(common, msg, seed)
+          times.append(time.time() - start)
+     return {'times': times, 'cfp': cfp, 'peak_rss_mb': self_peak_rss_mb()}
+
+def inprocess_decode(cfp, msg, ops):
+     # load the grammars and parse tables for cfp's version
+     header = cfp.split(u"\n\n", 1)[0].replace(u"\n", u" ")
+     (conf_name, mask, version, ls_len,
+      compressed) = decode.decode_conf_name(header)
+     common = cfp_common.CfpCommon.get_common_for_version(version)
+     for filename in [common.header_cfg_filename(),
+                      common.body_cfg_filename()]:
+          decode.load_and_norm_grammar(filename).parser()
+     times = []
+     for i in xrange(ops):
+          start = time.time()
+          out = decode_once(cfp)
+          times.append(time.time() - start)
+          if out != msg:
+               raise Exception("Decoded %d bytes incorrectly" % len(msg))
+     return {'times': times, 'peak_rss_mb': self_peak_rss_mb()}
+
+def run_inprocess(versions, sizes, args):
+     for version in versions:
+          for size in sizes:
+               ops = case_ops(size, args)
+               msg = message(args.seed, size)
+               e = in_child(inprocess_encode, version, size, ops, args.seed)
+               cfp = e['cfp']
+               nbytes = len(cfp.encode('utf-8'))
+               yield result({'mode': 'inprocess', 'op': 'encode',
+                             'version': version, 'workers': 1, 'size': size},
+                            e['times'], size, nbytes, e['peak_rss_mb'])
+               d = in_child(inprocess_decode, cfp, msg, ops)
+               yield result({'mode': 'inprocess', 'op': 'decode',
+                             'version': version, 'workers': 1, 'size': size},
+                            d['times'], size, nbytes, d['peak_rss_mb'])
+
+def run_script(argv, infile, outfile):
+     """Run a script with infile as stdin and outfile as stdout, and return
+     (elapsed seconds, its peak RSS in MB)."""
+     inf = open(infile, 'rb')
+     outf = open(outfile, 'wb')
+     devnull = open(os.devnull, 'w')
+     start = time.time()
+     p = subprocess.Popen([sys.executable] + argv, stdin=inf, stdout=outf,
+                          stderr=devnull)
+     (pid, status, usage) = os.wait4(p.pid, 0)
+     elapsed = time.time() - start
+     # wait4 has reaped it already
+     p.returncode = status
+     for f in (inf, outf, devnull):
+          f.close()
+     if status != 0:
+          raise Exception("%s failed" % argv[0])
+     return (elapsed, usage.ru_maxrss/1024.0)
+
+def run_scripts(sizes, args):
+     here = os.path.dirname(os.path.abspath(__file__))
+     tmp = tempfile.mkdtemp(prefix='bench-')
+     (msgfile, cfpfile, outfile) = [os.path.join(tmp, name)
+                                    for name in ("msg", "cfp", "out")]
+     version = cfp_common.CfpCommon.get_latest_common().version()
+     try:
+          for size in sizes:
+               ops = case_ops(size, args)
+               msg = message(args.seed, size)
+               f = open(msgfile, 'wb')
+               f.write(msg.encode('utf-8'))
+               f.close()
+               (enc, dec) = ([], [])
+               (enc_rss, dec_rss) = (0, 0)
+               for i in xrange(ops):
+                    (t, rss) = run_script([os.path.join(here, "encode.py"),
+                                           "--seed", str(args.seed)],
+                                          msgfile, cfpfile)
+                    enc.append(t)
+                    enc_rss = max(enc_rss, rss)
+                    (t, rss) = run_script([os.path.join(here, "decode.py")],
+                                          cfpfile, outfile)
+                    dec.append(t)
+                    dec_rss = max(dec_rss, rss)
+               nbytes = os.path.getsize(cfpfile)
+               f = open(outfile, 'rb')
+               if f.read().decode('utf-8') != msg:
+                    raise Exception("Decoded %d bytes incorrectly" % size)
+               f.close()
+               for (op, times, rss) in [("encode", enc, enc_rss),
+                                        ("decode", dec, dec_rss)]:
+                    yield result({'mode': 'script', 'op': op,
+                                  'version': version, 'workers': 1,
+                                  'size': size},
+                                 times, size, nbytes, rss)
+     finally:
+          for name in (msgfile, cfpfile, outfile):
+               if os.path.exists(name):
+                    os.unlink(name)
+          os.rmdir(tmp)
+
+def daemon_peak_rss_mb(pid):
+     """The peak RSS of the daemon and its worker processes, added up."""
+     pids = [pid]
+     try:
+          f = open('/proc/%d/task/%d/children' % (pid, pid))
+          pids.extend(int(p) for p in f.read().split())
+          f.close()
+     except IOError:
+          pass
+     total = 0.0
+     for p in pids:
+          try:
+               f = open('/proc/%d/status' % p)
+               for line in f:
+                    if line.startswith('VmHWM:'):
+                         total += int(line.split()[1])/1024.0
+               f.close()
+          except IOError:
+               pass
+     return total
+
+def run_daemon(sizes, workers, args):
+     here = os.path.dirname(os.path.abspath(__file__))
+     tmp = tempfile.mkdtemp(prefix='bench-')
+     socket_name = "ipc://%s/scipherd" % tmp
+     argv = [sys.executable, os.path.join(here, "scipherd.py"),
+             "--socket", socket_name, "--workers", str(workers)]
+     if workers > 1:
+          argv.append("--processes")
+     devnull = open(os.devnull, 'w')
+     daemon = subprocess.Popen(argv, stdout=devnull, stderr=devnull)
+     version = cfp_common.CfpCommon.get_latest_common().version()
+     try:
+          # this waits for the daemon to come up
+          scipher_client.get_stats(socket_name)
+          client = scipher_client.Client(socket_name)
+          for size in sizes:
+               ops = case_ops(size, args)
+               msg = message(args.seed, size)
+               cfp = client.encode(msg).result()
+               if client.decode(cfp).result().decode('utf-8') != msg:
+                    raise Exception("Decoded %d bytes incorrectly" % size)
+               for (op, data) in [("encode", msg), ("decode", cfp)]:
+                    times = []
+                    for i in xrange(ops):
+                         start = time.time()
+                         client.batch([(op, data)])[0].result()
+                         times.append(time.time() - start)
+                    # and all at once, which lets several workers share them
+                    start = time.time()
+                    for f in client.batch([(op, data)]*ops):
+                         f.result()
+                    r = result({'mode': 'daemon', 'op': op,
+                                'version': version, 'workers': workers,
+                                'size': size},
+                               times, size, len(cfp),
+                               daemon_peak_rss_mb(daemon.pid))
+                    r['ops_per_sec'] = ops/(time.time() - start)
+                    yield r
+          client.close()
+     finally:
+          daemon.terminate()
+          daemon.wait()
+          devnull.close()
+          for name in os.listdir(tmp):
+               os.unlink(os.path.join(tmp, name))
+          os.rmdir(tmp)
+
+def case_ops(size, args):
+     return max(1, min(args.ops, args.case_bytes//size))
+
+def compare(old_file, results):
+     """Print how results changed from the ones in old_file."""
+     old = {}
+     f = open(old_file)
+     for line in f:
+          r = json.loads(line)
+          if 'mode' in r:
+               old[tuple(r.get(k) for k in KEY)] = r
+     f.close()
+     log("%-10s %-7s %2s %2s %8s %12s %12s %8s" %
+         ("mode", "op", "v", "w", "size", "ops/s then", "ops/s now",
+          "change"))
+     for r in results:
+          o = old.get(tuple(r[k] for k in KEY))
+          if o is None:
+               continue
+          log("%-10s %-7s %2d %2d %8d %12.2f %12.2f %+7.1f%%" %
+              (r['mode'], r['op'], r['version'], r['workers'], r['size'],
+               o['ops_per_sec'], r['ops_per_sec'],
+               (r['ops_per_sec']/o['ops_per_sec'] - 1)*100))
+
+def main():
+     parser = argparse.ArgumentParser(
+          description='Benchmark encoding and decoding, and write the '
+          'results as JSON lines.')
+     parser.add_argument('--sizes', metavar='N,N,...', type=str,
+                         default='16,256,4096,65536,1000000',
+                         help='message sizes to try, in bytes')
+     parser.add_argument('--modes', metavar='M,M,...', type=str,
+                         default='inprocess,script,daemon',
+                         help='which of inprocess, script and daemon to run')
+     parser.add_argument('--versions', metavar='V,V,...', type=str,
+                         help='grammar versions for the inprocess cases '
+                         '(default: all of them)')
+     parser.add_argument('--workers', metavar='W,W,...', type=str,
+                         default='1,2',
+                         help='numbers of daemon workers to try')
+     parser.add_argument('--ops', metavar='N', type=int, default=20,
+                         help='the most messages to time per case')
+     parser.add_argument('--case-bytes', metavar='N', type=int,
+                         default=2**20,
+                         help='stop timing a case after about this many '
+                         'bytes of messages')
+     parser.add_argument('--seed', metavar='S', type=int, default=1,
+                         help='the random number generator seed')
+     parser.add_argument('--compare', metavar='FILE', type=str,
+                         help='show how ops/sec changed from an earlier '
+                         'run\'s output')
+     args = parser.parse_args()
+
+     sizes = [int(s) for s in args.sizes.split(",")]
+     modes = args.modes.split(",")
+     if args.versions:
+          versions = [int(v) for v in args.versions.split(",")]
+     else:
+          versions = sorted(cfp_common.CfpCommon.commons.keys())
+
+     # a first line describing the run
+     print json.dumps({'python': platform.python_version(),
+                       'platform': platform.platform(),
+                       'cpus': os.sysconf('SC_NPROCESSORS_ONLN'),
+                       'time': time.time(), 'seed': args.seed,
+                       'sizes': sizes})
+     runs = []
+     if "inprocess" in modes:
+          runs.append(run_inprocess(versions, sizes, args))
+     if "script" in modes:
+          runs.append(run_scripts(sizes, args))
+     if "daemon" in modes:
+          for workers in [int(w) for w in args.workers.split(",")]:
+               runs.append(run_daemon(sizes, workers, args))
+     results = []
+     for run in runs:
+          for r in run:
+               log("%-10s %-7s v%d %dw %8d bytes: %10.2f ops/s" %
+                   (r['mode'], r['op'], r['version'], r['workers'],
+                    r['size'], r['ops_per_sec']))
+               print json.dumps(r, sort_keys=True)
+               sys.stdout.flush()
+               results.append(r)
+     if args.compare:
+          compare(args.compare, results)
+
+if __name__ == "__main__":
+     main()
@@ -0,0 +1,140 @@
+# Bit-level I/O for the encoder and decoder.
+#
+# The secret is read and written as packed bytes, most significant bit
+# first, rather than as strings of '0' and '1' characters.  Each grammar
+# choice reads or writes only a handful of bits, so the reader pulls them
+# out of at most a couple of bytes, and the writer keeps the odd bits in a
+# small int until a whole byte is ready.
+
+import binascii
+import zlib
+
+def xor_table(mask):
+     """A table for str.translate that XORs every byte with mask."""
+     return "".join(chr(i ^ mask) for i in xrange(256))
+
+def text_to_bytes(text, mask):
+     """The characters of text as bytes, XOR'd with mask."""
+     try:
+          data = text.encode("latin-1")
+     except UnicodeEncodeError as e:
+          raise Exception("Unsupported character: %s" % text[e.start])
+     return data.translate(xor_table(mask))
+
+# A message can be compressed before it's encoded (see
+# encode.message_state), with raw deflate: the zlib header and checksum
+# would cost more than they're worth in a CFP.
+def compress(data):
+     """data, deflated."""
+     c = zlib.compressobj(9, zlib.DEFLATED, -zlib.MAX_WBITS)
+     return c.compress(data) + c.flush()
+
+# No CFP holds a message of more than this many characters: longer ones
+# are split into chunks (see chunked.py).
+MAX_MESSAGE = 2**20
+
+def decompress(data, limit=MAX_MESSAGE):
+     """data, inflated.  Raises ValueError if it isn't deflated, or if it
+     inflates to more than limit bytes.  A CFP is untrusted, and deflate
+     can expand about 1000:1, so this never inflates more than that."""
+     d = zlib.decompressobj(-zlib.MAX_WBITS)
+     try:
+          out = d.decompress(data, limit + 1)
+          if len(out) > limit or d.unconsumed_tail:
+               raise ValueError("Couldn't decompress the message: it's over "
+                                "%d bytes" % limit)
+          # unlike zlib.decompress, a decompressobj doesn't complain about
+          # a truncated stream; the output is known to be small, so check
+          return zlib.decompress(data, -zlib.MAX_WBITS)
+     except zlib.error as e:
+          raise ValueError("Couldn't decompress the message: %s" % e)
+
+class BitReader:
+     def __init__(self):
+          self.reset("")
+
+     def reset(self, data, length=None):
+          """Read from the bytes in data.  If length is given, only the
+          first length bits are used."""
+          self.data = bytearray(data)
+          if length is None:
+               length = len(self.data)*8
+          self.length = length
+          self.index = 0
+
+     def reset_int(self, value, length):
+          """Read the length-bit binary representation of value (or more
+          bits, if value doesn't fit, like "{0:0Nb}" would)."""
+          length = max(length, value.bit_length())
+          nbytes = (length + 7)//8
+          value <<= nbytes*8 - length
+          self.reset(binascii.unhexlify("%0*x" % (nbytes*2, value)), length)
+
+     def at_end(self):
+          return self.index >= self.length
+
+     def read(self, bits):
+          """Read the next bits bits as an int.  Near the end, fewer bits
+          may be left, in which case only those are used."""
+          start = self.index
+          end = min(start + bits, self.length)
+          if end <= start:
+               return 0
+          last = (end - 1) >> 3
+          chunk = 0
+          for b in self.data[start >> 3:last + 1]:
+               chunk = (chunk << 8) | b
+          self.index = end
+          return (chunk >> ((last + 1)*8 - end)) & ((1 << (end - start)) - 1)
+
+     def read_padded(self, bits):
+          """Like read, but near the end, the bits left are followed by
+          zeros, as if the data went on."""
+          left = self.length - self.index
+          if left >= bits:
+               return self.read(bits)
+          return self.read(left) << (bits - max(left, 0))
+
+# The decoder collects its choices as "pieces" before writing them out, so
+# that it can reorder and drop them cheaply.  A piece packs a value and its
+# width into one int, with a 1 bit just above the value marking the width.
+def piece(value, bits):
+     return (1 << bits) | value
+
+def piece_bits(p):
+     return p.bit_length() - 1
+
+class BitWriter:
+     def __init__(self):
+          self.buf = bytearray()
+          # bits that don't fill a whole byte yet
+          self.acc = 0
+          self.nacc = 0
+
+     def __len__(self):
+          return len(self.buf)*8 + self.nacc
+
+     def write(self, value, bits):
+          acc = (self.acc << bits) | value
+          nacc = self.nacc + bits
+          while nacc >= 8:
+               nacc -= 8
+               self.buf.append(acc >> nacc)
+               acc &= (1 << nacc) - 1
+          self.acc = acc
+          self.nacc = nacc
+
+     def write_piece(self, p):
+          bits = p.bit_length() - 1
+          self.write(p ^ (1 << bits), bits)
+
+     def getvalue(self):
+          """The whole bytes written so far, and the bits left over, as
+          (str, value, number of bits)."""
+          return (str(self.buf), self.acc, self.nacc)
+
+     def to_int(self):
+          value = 0
+          if self.buf:
+               value = int(binascii.hexlify(self.buf), 16)
+          return (value << self.nacc) | self.acc
@@ -1,3 +1,11 @@
+# The top bit of the header's version byte is set if the message was
+# compressed before it was encoded (see encode.message_state), so grammar
+# versions only go up to 127.
+COMPRESSED = 0x80
+
+class DecodeError(Exception):
+     """The text isn't a CFP this decoder can read."""
+
 class CfpCommon(object):
      maxv = 0
      commons = {}
@@ -19,31 +27,6 @@ class CfpCommon(object):
                return CfpCommon.commons[version]()
           return None
 
-     @staticmethod
-     def conf_names_filename():
-          return "cfp_conf_names.txt"
-
-     # This isn't likely to change in other grammar versions since we
-     # need to do this before we can even figure out the version in
-     # the first place
-     @staticmethod
-     def conf_name_from_index(f, index):
-          last_4byte_line = 9576
-          last_5byte_line = 114552
-          # now find the right conf name by jumping to the right place
-          # in the conf name file.  The first 9576 lines are 4 bytes
-          # each, the next 104976 lines are 5 bytes each, and the
-          # remaining lines are 6 bytes each
-          line_at_byte = 4*(min(last_4byte_line, index))
-          if index > last_4byte_line:
-               line_at_byte += 5*(min(last_5byte_line-last_4byte_line,
-                                      index-last_4byte_line))
-          if index > last_5byte_line:
-               line_at_byte += 6*(index-last_5byte_line)
-
-          f.seek(line_at_byte, 0)
-          return f.readline().rstrip()
-
      ## abstract interface below ##
 
      @staticmethod
@@ -74,5 +57,11 @@ class CfpCommon(object):
      def body_cfg_filename(self):
           raise NotImplementedError("")
 
+     def uses_all_productions(self):
+          """Whether a choice can pick any of a rule's productions, rather
+          than just the first 2**k (see grammar_cache.compile_choices)."""
+          return False
+
 import versions.v000.cfp_common_v0
 import cfp_common_v1
+import cfp_common_v2
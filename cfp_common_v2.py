@@ -0,0 +1,17 @@
+# GRAMMAR_VERSION == 2 uses the same grammars and lists as version 1, but
+# codes each choice over all of a rule's productions instead of just the
+# first 2**k of them (see grammar_cache.compile_choices), so the same
+# message makes a shorter CFP.
+
+import cfp_common
+import cfp_common_v1
+
+class CfpCommonV2(cfp_common_v1.CfpCommonV1):
+     @staticmethod
+     def version():
+          return 2
+
+     def uses_all_productions(self):
+          return True
+
+cfp_common.CfpCommon.register_common(CfpCommonV2)
@@ -1,8 +1,57 @@
 #!/usr/bin/env python
 
+# Check a grammar file for nonterminals with no productions, duplicate
+# productions and unused nonterminals:
+#
+#     ./check_grammar.py cfp_body.cfg
+#
+# With --density, also work out how well each nonterminal carries the
+# message.  A choice between n productions only uses some of them for data
+# (up to version 1, the first 2**k, where k = floor(log2(n-1)); see
+# grammar_cache.compile_choices), so it could carry log2(n) bits but
+# carries fewer.  For each nonterminal, this shows how many of its
+# productions are wasted, the bits, words and bytes of one expansion of it
+# (all the way down, while the message lasts), and the bits it loses
+# across a whole CFP, for a message of --length characters.  The worst
+# offenders are listed first.  It also counts the expansions saved by
+# folding the nonterminals that can only expand one way into the
+# productions that use them (see grammar_cache.constant_symbols).  Without
+# a file, it checks both grammars of --version (by default, the latest).
+#
+#     ./check_grammar.py --density
+#     ./check_grammar.py --density --top 50 cfp_body.cfg
+#
+# With --ambiguity, certify the grammars the decoder parses (with their
+# terminals lower-cased) as unambiguous, or list the nonterminals that
+# might not be.  A grammar whose LR parse tables (see lr_parser.py) have
+# no conflicts is SLR(1), and so can't be ambiguous; its parser then
+# skips looking for second parses.  Otherwise, this shows the nonterminals
+# the conflicting states reduce to, with the words that lead to them.
+# Not all of those are real ambiguities; some just need more lookahead.
+#
+#     ./check_grammar.py --ambiguity
+#
+# With --cache, check that the choice tables cached for each version (see
+# grammar_cache.load_choices) are the same as ones compiled afresh, for
+# both grammars, as the encoder and as the decoder loads them.  For the
+# versions decoded with decode.get_bits, which walks the LR parser's trees
+# by symbol id, also encode a few short messages and check that it gets
+# the same bits as get_number, the chart parser's walk over nltk's
+# symbols.  Without --version, every version is checked.
+#
+#     ./check_grammar.py --cache
+
+import argparse
 from itertools import groupby
+import cfp_common
+import decode
+import encode
+import grammar_cache
+import lr_parser
 import math
 import nltk
+import random
+import planner
 import sys
 
 def do_check(filename):
@@ -25,12 +74,6 @@ def do_check(filename):
                 if (not isinstance(term, basestring) and
                     len(body_grammar.productions(term)) == 0):
                     print "* %s (label %s)" % (term, label)
-        # check # of productions
-        #if np >= 3:
-        #    bits = math.log(np-1, 2)
-        #    if int(bits) != bits:
-        #        print "*** label %s has %s productions" % (label, np)
-
 
     print "Nonterminals with duplicate productions:"
     for label,prods in groupby(body_grammar.productions(),
@@ -60,4 +103,261 @@ def do_check(filename):
             print "-e \"^%s -\" " % t,
     print filename
 
-do_check(sys.argv[1])
+def wasted(tables, s):
+    """Productions of s that never carry data, not counting the one that
+    ends a list (see "Making changes to the grammar" in the README)."""
+    n = len(tables.prods[s])
+    if n < 3 and not tables.all_prods:
+        return 0
+    return n - tables.codes[s] - (1 if tables.recursive[s] else 0)
+
+def expansions(sizes, length):
+    """How many times each symbol is expanded in a CFP for a message of
+    length characters.  Each list gets as many items as the bits
+    calc_list_bits gives it, on average, can fill, and the last one gets
+    whatever the rest of the CFP leaves over."""
+    t = sizes.tables
+    start = t.ids[sizes.grammar.start().symbol()]
+    if t.body is None:
+        return sizes.expansions(start)
+
+    walk = planner.Walk(sizes, length*8)
+    (prods, bits) = sizes.choices(t.body, True)
+    lists = [(w, walk.list_bits(p)) for (w, p) in prods]
+    counts = sizes.expansions(start, leaves=set(l for (w, ls) in lists
+                                                for l in ls))
+    # the bits outside the lists
+    outside = sum(counts[s]*sizes.choices(s, True)[1]
+                  for s in xrange(len(t.prods)) if t.prods[s])
+
+    # the average bits for each list, over the body productions using it
+    budgets = {}
+    for (w, ls) in lists:
+        for (l, (b, last)) in ls.iteritems():
+            if last:
+                b = max(b, length*8 - outside -
+                        sum(b for (b, last) in ls.itervalues() if not last))
+            budgets.setdefault(l, []).append((w, b))
+    for (l, b) in budgets.iteritems():
+        budget = float(sum(w*b for (w, b) in b))/sum(w for (w, b) in b)
+        items = dict((s, budget/sizes.item[s].bits)
+                     for s in xrange(len(t.prods))
+                     if t.recursive[s] and sizes.item[s].bits > 0)
+        below = sizes.expansions(l, items=items)
+        # a list that's a list term itself repeats from the top
+        n = items.get(l, 1.0)
+        for s in xrange(len(counts)):
+            if s != l:
+                counts[s] += counts[l]*below[s]*n
+        counts[l] *= n
+    return counts
+
+def do_density(filename, common, length, top):
+    sizes = planner.GrammarSizes(grammar_cache.load_grammar(filename),
+                                 common, common.choose_last_or_nots())
+    t = sizes.tables
+    names = sizes.grammar.table[1]
+    counts = expansions(sizes, length)
+
+    rows = []
+    (total_bits, ideal_bits, total_words, total_bytes) = (0.0, 0.0, 0.0, 0.0)
+    (expanded, folded) = (0.0, 0.0)
+    for s in xrange(len(t.prods)):
+        if not t.prods[s]:
+            total_words += counts[s]*sizes.cost[s].words
+            total_bytes += counts[s]*sizes.cost[s].bytes
+            continue
+        (prods, bits) = sizes.choices(s, True)
+        expanded += counts[s]
+        folded += counts[s]*sum(w*t.folded[p] for (w, p) in prods)/float(
+            sum(w for (w, p) in prods))
+        n = len(t.prods[s])
+        ideal = math.log(n, 2) if s not in sizes.last_or_nots else 0.0
+        total_bits += counts[s]*bits
+        ideal_bits += counts[s]*ideal
+        rows.append((counts[s]*(ideal - bits), s, n, bits))
+
+    if t.body is None:
+        print "%s: %.1f bits in %.1f words, %.1f bytes" % (
+            filename, total_bits, total_words, total_bytes)
+    else:
+        print ("%s, for a %d-character message: %.0f bits in %.0f words, "
+               "%.0f bytes" % (filename, length, total_bits, total_words,
+                               total_bytes))
+    print "  %.3f bits/byte; with every production used, %.3f bits/byte" % (
+        total_bits/total_bytes, ideal_bits/total_bytes)
+    print ("  %d nonterminals can only expand one way; folding them saves "
+           "%.0f of %.0f expansions" % (
+               len(grammar_cache.constant_symbols(sizes.grammar.table)),
+               folded, expanded + folded))
+
+    print "\n  %-32s %5s %6s %5s %9s %9s %9s %8s %10s" % (
+        "worst offenders", "prods", "wasted", "bits", "sub bits",
+        "sub words", "sub bytes", "bits/byte", "lost bits")
+    rows.sort(reverse=True)
+    for (lost, s, n, bits) in rows[:top]:
+        size = sizes.data[s]
+        print "  %-32s %5d %6d %5.2f %9.1f %9.1f %9.1f %8.3f %10.1f" % (
+            names[s][:32], n, wasted(t, s), bits, size.bits, size.words,
+            size.bytes, size.bits/size.bytes if size.bytes else 0.0, lost)
+
+def do_ambiguity(filename, top):
+    grammar = grammar_cache.load_decode_grammar(filename)
+    tables = grammar.parser().tables
+    names = grammar.table[1]
+    conflicts = lr_parser.find_conflicts(tables)
+    if not conflicts:
+        print "%s: certified unambiguous (SLR(1))" % filename
+        return
+
+    # nonterminal -> (states, lookahead words)
+    found = {}
+    for (state, t, ps, shift) in conflicts:
+        for lhs in set(tables['prod_lhs'][p] for p in ps):
+            (states, words) = found.setdefault(lhs, (set(), set()))
+            states.add(state)
+            words.add(names[t] if t != lr_parser.END else "<end>")
+    print ("%s: not certified; %d parser states have conflicts, reducing "
+           "to %d nonterminals" % (filename,
+                                   len(set(c[0] for c in conflicts)),
+                                   len(found)))
+    print "\n  %-32s %6s  %s" % ("nonterminal", "states", "before words")
+    rows = sorted(((len(states), names[lhs], words)
+                   for (lhs, (states, words)) in found.iteritems()),
+                  key=lambda r: (-r[0], r[1]))
+    for (n, name, words) in rows[:top]:
+        words = sorted(words)
+        shown = " ".join(words[:5])
+        if len(words) > 5:
+            shown += " ... (%d)" % len(words)
+        print "  %-32s %6d  %s" % (name[:32], n, shown)
+
+def do_cache(common, tries):
+    version = common.version()
+    ok = True
+    for filename in [common.header_cfg_filename(),
+                     common.body_cfg_filename()]:
+        for grammar in [grammar_cache.load_grammar(filename),
+                        grammar_cache.load_decode_grammar(filename)]:
+            cached = grammar_cache.load_choices(grammar, common)
+            fresh = grammar_cache.compile_choices(grammar, common)
+            differ = [f for f in grammar_cache.ChoiceTables._fields
+                      if getattr(cached, f) != getattr(fresh, f)]
+            if differ:
+                print ("version %d, %s (%s): cached choice tables differ "
+                       "in %s" % (version, filename, grammar.form,
+                                  ", ".join(differ)))
+                ok = False
+    if ok:
+        print "version %d: cached choice tables match" % version
+
+    body = decode.load_and_norm_grammar(common.body_cfg_filename())
+    if body.choices(common).all_prods:
+        # get_code_bits has no counterpart in the chart parser
+        print "version %d: decoded with get_code_bits, not get_bits" % version
+        return ok
+    header_grammar = grammar_cache.load_grammar(common.header_cfg_filename())
+    body_grammar = grammar_cache.load_grammar(common.body_cfg_filename())
+    size = 16
+    for i in xrange(tries):
+        rnd = random.Random(i)
+        msg = u"".join(unichr(rnd.randint(32, 126)) for j in xrange(size))
+        random.seed(i)
+        (header, text) = encode.do_encode(encode.new_state(
+            common, msg, header_grammar, body_grammar))
+        (conf_name, mask, v, ls_len,
+         compressed) = decode.decode_conf_name(header)
+        state = decode.new_state(common, conf_name, mask, None, body)
+        text = decode.unpretty_body(text, state)
+        state.list_bits.clear()
+        ids = decode.parse_text(text, body, state, size*8)
+        state.list_bits.clear()
+        symbols = decode.chart_parse_text(text, body, state, size*8)
+        if ids.getvalue() != symbols.getvalue():
+            print ("version %d: get_bits and get_number disagree on message "
+                   "%d" % (version, i))
+            ok = False
+        elif decode.bin_to_text(ids, mask) != msg:
+            print "version %d: message %d decoded wrongly" % (version, i)
+            ok = False
+    if ok:
+        print ("version %d: get_bits agrees with get_number on %d messages" %
+               (version, tries))
+    return ok
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Check a grammar for mistakes, and optionally for how '
+        'densely it encodes.')
+    parser.add_argument('filename', metavar='FILE', type=str, nargs='?',
+                        help='the grammar file')
+    parser.add_argument('--density', action='store_true',
+                        help='show how many bits each nonterminal carries '
+                        'and wastes')
+    parser.add_argument('--ambiguity', action='store_true',
+                        help='certify the grammars as unambiguous, or show '
+                        'the nonterminals that might not be')
+    parser.add_argument('--cache', action='store_true',
+                        help='check the cached choice tables and get_bits '
+                        'against the uncached, nltk-based ones')
+    parser.add_argument('--tries', metavar='N', type=int, default=5,
+                        help='with --cache, how many messages to decode both '
+                        'ways')
+    parser.add_argument('--version', metavar='V', type=int,
+                        help='with --density, --ambiguity or --cache, the '
+                        'grammar version to check (default: the latest, or '
+                        'with --cache, all of them)')
+    parser.add_argument('--length', metavar='N', type=int, default=4096,
+                        help='with --density, the message length, in '
+                        'characters, to weigh the lists by')
+    parser.add_argument('--top', metavar='N', type=int, default=20,
+                        help='with --density or --ambiguity, how many '
+                        'nonterminals to show')
+    args = parser.parse_args()
+
+    if args.cache:
+        if args.version is None:
+            versions = sorted(cfp_common.CfpCommon.commons)
+        elif args.version in cfp_common.CfpCommon.commons:
+            versions = [args.version]
+        else:
+            sys.stderr.write("Unrecognized version: %s\n" % args.version)
+            sys.exit(-1)
+        ok = True
+        for v in versions:
+            common = cfp_common.CfpCommon.get_common_for_version(v)
+            ok = do_cache(common, args.tries) and ok
+        if not ok:
+            sys.exit(-1)
+        return
+
+    if not args.density and not args.ambiguity:
+        if not args.filename:
+            parser.error("no grammar file given")
+        do_check(args.filename)
+        return
+
+    if args.version is None:
+        common = cfp_common.CfpCommon.get_latest_common()
+    else:
+        common = cfp_common.CfpCommon.get_common_for_version(args.version)
+        if common is None:
+            sys.stderr.write("Unrecognized version: %s\n" % args.version)
+            sys.exit(-1)
+    if args.filename:
+        filenames = [args.filename]
+    else:
+        filenames = [common.header_cfg_filename(), common.body_cfg_filename()]
+    for filename in filenames:
+        if args.filename:
+            do_check(filename)
+            print
+        if args.density:
+            do_density(filename, common, args.length, args.top)
+            print
+        if args.ambiguity:
+            do_ambiguity(filename, args.top)
+            print
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,150 @@
+# Messages too big for one CFP.
+#
+# The header only has room for a 20-bit length, so a bigger message is
+# split into chunks of up to CHUNK_SIZE characters and each one is sent as
+# its own CFP.  Every chunk starts with "<number>/<total>\n", inside the
+# encoded message (so it's masked like the rest of it), which lets the
+# decoder check that it has all of them and put them back in order.  The
+# CFPs are independent, so they're encoded and decoded in parallel, one
+# per process.
+#
+# Written out together, the CFPs are separated by SEPARATOR lines, which
+# the grammar never produces.
+
+import cfp_common
+import decode
+import encode
+import grammar_cache
+import multiprocessing
+import os
+import random
+import re
+
+SEPARATOR = "%%"
+
+# leaves room for the chunk numbers under the 1MB limit
+CHUNK_SIZE = 2**20 - 32
+
+chunk_re = re.compile(r"(\d+)/(\d+)\n")
+
+def split(text, size=CHUNK_SIZE):
+     """Split text into numbered chunks of at most size characters."""
+     total = max(1, (len(text) + size - 1)//size)
+     return [u"%d/%d\n%s" % (i + 1, total, text[i*size:(i + 1)*size])
+             for i in xrange(total)]
+
+def join(chunks):
+     """Put the chunks from split back together, in any order."""
+     parts = {}
+     total = None
+     for chunk in chunks:
+          m = chunk_re.match(chunk)
+          if m is None:
+               raise decode.DecodeError("Not part of a chunked message")
+          (number, chunk_total) = (int(m.group(1)), int(m.group(2)))
+          if total is None:
+               total = chunk_total
+          elif chunk_total != total:
+               raise decode.DecodeError("Chunks are from different messages")
+          if number in parts:
+               raise decode.DecodeError("Chunk %d appears twice" % number)
+          parts[number] = chunk[m.end():]
+     if total is None:
+          raise decode.DecodeError("No chunks to decode")
+     missing = [str(i) for i in xrange(1, total + 1) if i not in parts]
+     if missing:
+          raise decode.DecodeError("Missing chunk(s) %s of %d" %
+                                   (", ".join(missing), total))
+     if len(parts) > total:
+          raise decode.DecodeError("Too many chunks")
+     return u"".join(parts[i] for i in xrange(1, total + 1))
+
+def split_stream(lines):
+     """Split an iterable of lines into the texts of the CFPs in it."""
+     cfp = []
+     for line in lines:
+          if line.rstrip() == SEPARATOR:
+               yield "".join(cfp)
+               cfp = []
+          else:
+               cfp.append(line)
+     if "".join(cfp).strip():
+          yield "".join(cfp)
+
+def read_dir(dirname):
+     """The texts of the CFPs in every file in dirname, by file name."""
+     for name in sorted(os.listdir(dirname)):
+          path = os.path.join(dirname, name)
+          if os.path.isfile(path):
+               f = open(path)
+               for cfp in split_stream(f):
+                    yield cfp
+               f.close()
+
+def run(func, init, args, jobs):
+     """Yield func(a) for each a in args, in order, in a pool of jobs
+     processes (one per CPU if jobs is None) that each call init first."""
+     if jobs == 1:
+          init()
+          for a in args:
+               yield func(a)
+          return
+     pool = multiprocessing.Pool(jobs, init)
+     try:
+          for result in pool.imap(func, args):
+               yield result
+          pool.close()
+     finally:
+          pool.terminate()
+          pool.join()
+
+# grammars for the encoder, loaded once per process
+encode_grammars = None
+
+def init_encoder():
+     global encode_grammars
+     common = cfp_common.CfpCommon.get_latest_common()
+     encode_grammars = (
+          common,
+          grammar_cache.load_grammar(common.header_cfg_filename()),
+          grammar_cache.load_grammar(common.body_cfg_filename()))
+
+def encode_chunk(args):
+     (chunk, seed, website, compress) = args
+     random.seed(seed)
+     (common, header_grammar, body_grammar) = encode_grammars
+     state = encode.new_state(common, chunk, header_grammar, body_grammar,
+                              website, compress=compress)
+     (header, body) = encode.do_encode(state, website)
+     return u"%s\n\n%s" % (header, body)
+
+def encode_chunks(text, seed, website=None, size=CHUNK_SIZE, jobs=None,
+                  compress=False):
+     """Encode text as a series of CFPs, and yield them in order.  Chunk i
+     is encoded with seed + i.  With compress, each chunk is compressed on
+     its own (see encode.message_state)."""
+     # bigger chunks won't fit the header's length field
+     assert 0 < size <= CHUNK_SIZE
+     chunks = split(text, size)
+     return run(encode_chunk, init_encoder,
+                [(chunks[i], seed + i, website, compress)
+                 for i in xrange(len(chunks))],
+                jobs)
+
+def init_decoder():
+     # load the latest grammars and their parse tables up front; chunks
+     # from other versions load theirs when they first turn up
+     common = cfp_common.CfpCommon.get_latest_common()
+     for filename in [common.header_cfg_filename(),
+                      common.body_cfg_filename()]:
+          decode.load_and_norm_grammar(filename).parser()
+
+def decode_chunk(args):
+     (cfp, strict) = args
+     return decode.decode_lines(iter(cfp.splitlines(True)), strict)
+
+def decode_chunks(cfps, strict=False, jobs=None):
+     """Decode an iterable of CFP texts from encode_chunks, in any order,
+     and return the whole message."""
+     return join(run(decode_chunk, init_decoder,
+                     [(cfp, strict) for cfp in cfps], jobs))
@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+
+# Conference names, by index.
+#
+# The header's conference name encodes 21 bits of metadata as its index in
+# cfp_conf_names.txt, the list written by genconfnames.py.  That list is
+# all 3-letter names with at least one vowel, then all 4- and 5-letter
+# names with at least two, each in alphabetical order (Y counts as a
+# vowel).  So instead of searching the file, we can count our way to a
+# name's index and back.
+#
+# To check this against the file:
+#
+#     ./genconfnames.py > cfp_conf_names.txt
+#     ./conf_names.py cfp_conf_names.txt
+
+import argparse
+import sys
+
+LETTERS = "ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+VOWELS = "AEIOUY"
+CONSONANTS = len(LETTERS) - len(VOWELS)
+
+# (name length, vowels needed), in list order
+GROUPS = ((3, 1), (4, 2), (5, 2))
+
+# Only the first 2**21 names are ever used.
+NUM_NAMES = 1 << 21
+
+def _choose(n, k):
+     r = 1
+     for i in xrange(k):
+          r = r*(n - i)//(i + 1)
+     return r
+
+# _completions[n][k] is the number of ways to fill n letters with at least
+# k vowels (k may be negative, meaning no constraint).
+_MAX_LEN = max(length for (length, need) in GROUPS)
+_completions = [dict((k, sum(_choose(n, j) * len(VOWELS)**j *
+                             CONSONANTS**(n - j)
+                             for j in xrange(max(k, 0), n + 1)))
+                     for k in xrange(-_MAX_LEN, _MAX_LEN + 1))
+                for n in xrange(_MAX_LEN + 1)]
+
+# the index of the first name in each group
+_group_start = []
+_start = 0
+for (_length, _need) in GROUPS:
+     _group_start.append(_start)
+     _start += _completions[_length][_need]
+del _start, _length, _need
+
+# for each letter, how many vowels and consonants come before it
+_vowels_before = {}
+_consonants_before = {}
+for (_i, _c) in enumerate(LETTERS):
+     _vowels_before[_c] = len([v for v in VOWELS if v < _c])
+     _consonants_before[_c] = _i - _vowels_before[_c]
+del _i, _c
+
+def name_from_index(index):
+     """The conference name at index, which must be less than NUM_NAMES."""
+     if index < 0 or index >= NUM_NAMES:
+          raise ValueError("Conference name index out of range: %d" % index)
+     g = len(GROUPS) - 1
+     while _group_start[g] > index:
+          g -= 1
+     (length, need) = GROUPS[g]
+     index -= _group_start[g]
+     name = []
+     for pos in xrange(length - 1, -1, -1):
+          counts = _completions[pos]
+          for c in LETTERS:
+               if c in VOWELS:
+                    n = counts[need - 1]
+               else:
+                    n = counts[need]
+               if index < n:
+                    break
+               index -= n
+          if c in VOWELS:
+               need -= 1
+          name.append(c)
+     return "".join(name)
+
+def index_from_name(name):
+     """The index of the conference name, or None if it isn't one."""
+     for (g, (length, need)) in enumerate(GROUPS):
+          if len(name) == length:
+               break
+     else:
+          return None
+     index = _group_start[g]
+     for (pos, c) in enumerate(name):
+          if c not in _vowels_before:
+               return None
+          counts = _completions[length - pos - 1]
+          index += (_vowels_before[c]*counts[need - 1] +
+                    _consonants_before[c]*counts[need])
+          if c in VOWELS:
+               need -= 1
+     if need > 0 or index >= NUM_NAMES:
+          return None
+     return index
+
+def main():
+     parser = argparse.ArgumentParser(
+          description='Check the conference name ranking against the list '
+          'from genconfnames.py.')
+     parser.add_argument('filename', type=str,
+                         help='the list of names, one per line')
+     args = parser.parse_args()
+
+     bad = 0
+     count = 0
+     with open(args.filename) as f:
+          for (index, line) in enumerate(f):
+               if index >= NUM_NAMES:
+                    break
+               count += 1
+               name = line.rstrip()
+               if (name_from_index(index) != name or
+                   index_from_name(name) != index):
+                    if bad < 10:
+                         print "Mismatch at %d: %s" % (index, name)
+                    bad += 1
+     if count < NUM_NAMES:
+          print "Only %d names in %s" % (count, args.filename)
+          bad += 1
+     if bad:
+          sys.exit(1)
+     print "All %d names match" % NUM_NAMES
+
+if __name__ == "__main__":
+     main()
@@ -1,12 +1,17 @@
 #!/usr/bin/env python
 
 import argparse
+import bitio
 import cfp_common
+import chunked
 import collections
-import math
+import conf_names
+import grammar_cache
+import lr_parser
 import nltk
 import re
-import scipherd
+import scipher_client
+import stats
 import sys
 import time
 
@@ -14,28 +19,15 @@ DecodeState = collections.namedtuple('DecodeState',
                                      ['common', 'conf_name', 'mask',
                                       'header_grammar', 'body_grammar',
                                       'list_bits', 'space_before',
-                                      'space_after', 'done'])
-
-# To find the code, we have to binary search the conf name file.  There are
-# 2097152 possible names.  Binary search cribbed from
-# http://interactivepython.org/courselib/static/pythonds/SortSearch/TheBinarySearch.html
-def binsearch_conf_names(conf_name):
-     first = 0
-     last = 2097152
-
-     f = open(cfp_common.CfpCommon.conf_names_filename(), 'r')
-     while first <= last:
-          midpoint = (first + last)//2
-          mid_name = cfp_common.CfpCommon.conf_name_from_index(f, midpoint)
-          if mid_name == conf_name:
-               return midpoint
-
-          if ((len(conf_name) < len(mid_name)) or
-              (len(conf_name) == len(mid_name) and conf_name < mid_name)):
-               last = midpoint - 1
-          else:
-               first = midpoint + 1
-     f.close()
+                                      'space_after', 'done', 'timer',
+                                      'compressed'])
+# timer is a stats.Timer for the time spent in each phase, if wanted, and
+# compressed is set if the message was compressed (see encode.message_state)
+DecodeState.__new__.__defaults__ = (None, False)
+
+# in cfp_common, so that it's the same class when this file is run as a
+# script and chunked.py imports it
+DecodeError = cfp_common.DecodeError
 
 class Done():
      def __init__(self):
@@ -53,16 +45,12 @@ def get_number(tree, grammar, state, in_list_arg = None):
     if state.done.done:
          return ((nt_label,), [])
 
-    prods = grammar.productions(nt_label)
+    tables = grammar.choices(state.common)
+    sym = tables.ids[tree.label()]
     rhs = ()
     num = []
 
-    # come up with a format with the right number of leading zeroes
-    bits = 0
-    if len(prods) >= 3:
-         bits = int(math.log(len(prods)-1, 2))
-    formatstr = "{0:0%db}" % bits
-    prevPow2 = math.pow(2, bits)
+    bits = tables.bits[sym]
 
     in_list = in_list_arg
     if not in_list and nt_label in state.list_bits:
@@ -81,28 +69,24 @@ def get_number(tree, grammar, state, in_list_arg = None):
               # if we know that this is going to be the end of a list such
               # that the power of 2 was chosen, then don't bother subtracting
               # the bits from the main done.
-              if (nt_label in state.common.list_recursive_terms() and
+              if (tables.recursive[sym] and
                   state.list_bits[in_list] <= 0 and len(state.list_bits) > 1):
                    use_bits = False
 
               state.list_bits[in_list] -= bits
-              #print ("Consumed %d bits for list %s, %s left" %
-              #       (bits, in_list, list_bits[in_list]))
 
     prev_bits_left = state.done.bits_left
     if use_bits:
-         #print "(%s) Consumed %s bits for %s" % (prev_bits_left, bits, nt_label)
          state.done.bits_left -= bits
 
     # set up list_bits if needed, before recursing:
     subtrees = tree.subtrees().next()
-    if len(state.list_bits) == 0 and nt_label == nltk.Nonterminal("CFP_BODY"):
+    if len(state.list_bits) == 0 and sym == tables.body:
          body_rhs = tuple(nltk.Nonterminal(t.label()) for t in subtrees)
-         for p in prods:
-              if p.rhs() == body_rhs:
-                   state.list_bits.update(
-                        state.common.calc_list_bits(state.done.total_len, p))
-                   break
+         p = grammar.rhs_index(nt_label).get(body_rhs)
+         if p is not None:
+              state.list_bits.update(state.common.calc_list_bits(
+                   state.done.total_len, grammar.production(p)))
 
     child_bits = 0
     for t in subtrees:
@@ -120,54 +104,311 @@ def get_number(tree, grammar, state, in_list_arg = None):
              (state.list_bits[in_list] <= 0 and len(state.list_bits) > 1)):
               end_list = True
 
-    for i in range(len(prods)):
-        if prods[i].rhs() == rhs:
-            if (len(state.list_bits) == 0 and
-                nt_label == nltk.Nonterminal("CFP_BODY")):
-                 state.list_bits.update(state.common.calc_list_bits(
-                      state.done.total_len, prods[i]))
-
-            if prev_bits_left <= 0:
-                state.done.done = True
-                return ((nt_label,), [])
-            elif is_list and i == prevPow2:
-                 if use_bits:
-                      state.done.bits_left += bits  # encode didn't count these
-                 if in_list in state.list_bits:
-                      bits_left = state.list_bits[in_list]
-                      if bits_left <= 0 and len(state.list_bits) > 1:
-                           del state.list_bits[in_list]
-                 # end of the list -- still count the choices below us
-                 return ((nt_label,), num)
-            else:
-                 istring = formatstr.format(i)
-                 #print ("(%s) Using %s bits %s (%s -> %s)" %
-                 #       (prev_bits_left, bits, istring, nt_label, rhs))
-                 return ((nt_label,), [istring]+num)
-    print "Couldn't find rhs for label %s, rhs %s" % (rhs, tree.label())
-
-def bin_to_text(binstring, mask):
-    return ''.join(unichr(int(binstring[i:i+8], 2)^mask)
-                   for i in xrange(0, len(binstring), 8))
-
-quote_re = re.compile("\"([^\"]*)\"")
-def tolower_inquotes(matchobj):
-     return "\"%s\"" % matchobj.group(1).lower()
+    p = grammar.rhs_index(nt_label).get(rhs)
+    if p is None:
+         print "Couldn't find rhs for label %s, rhs %s" % (rhs, tree.label())
+         return None
+    i = grammar.choice_index(p)
+    if len(state.list_bits) == 0 and sym == tables.body:
+         state.list_bits.update(state.common.calc_list_bits(
+              state.done.total_len, grammar.production(p)))
+
+    if prev_bits_left <= 0:
+         state.done.done = True
+         return ((nt_label,), [])
+    elif is_list and i == 2**bits:
+         if use_bits:
+              state.done.bits_left += bits  # encode didn't count these
+         if in_list in state.list_bits:
+              bits_left = state.list_bits[in_list]
+              if bits_left <= 0 and len(state.list_bits) > 1:
+                   del state.list_bits[in_list]
+         # end of the list -- still count the choices below us
+         return ((nt_label,), num)
+    else:
+         return ((nt_label,), [bitio.piece(i, bits)]+num)
+
+def bin_to_text(bits, mask):
+    (data, extra, nextra) = bits.getvalue()
+    text = data.translate(bitio.xor_table(mask)).decode("latin-1")
+    if nextra:
+         text += unichr(extra^mask)
+    return text
+
+# loaded grammars, by file name
+grammars = {}
 
 def load_and_norm_grammar(grammar_file):
-     gs = open(grammar_file).read().decode("UTF-8")
      # when decoding, treat all terminals as lower case
-     norm_gs = quote_re.sub(tolower_inquotes, gs)
-     return nltk.CFG.fromstring(norm_gs)
-
-def parse_text(text, grammar, state, length):
-     parser = nltk.parse.LeftCornerChartParser(grammar)
+     if grammar_file not in grammars:
+          grammars[grammar_file] = grammar_cache.load_decode_grammar(
+               grammar_file)
+     return grammars[grammar_file]
+
+def get_bits(root, grammar, state, open_ids=()):
+     """Like get_number, but for a tree from the LR parser (see
+     lr_parser.py), and without recursion, since list nesting can get very
+     deep for big messages.  Returns the list of choices, as bitio pieces.
+
+     The tree may be a partial one (see lr_parser.Parse.partial_tree), in
+     which case open_ids holds the ids of the nodes still missing children.
+     If those children could still add bits, returns None."""
+     out = []
+     tables = grammar.choices(state.common)
+     prod_lhs = grammar.parser().prod_lhs
+     # work on symbol ids, like encode.iter_expand; list_bits is keyed by
+     # them too
+     last_or_nots = set(tables.ids[nt.symbol()]
+                        for nt in state.common.choose_last_or_nots()
+                        if nt.symbol() in tables.ids)
+     list_bits = state.list_bits
+     names = grammar.table[1]
+     # if the timer counts choices, the nonterminal each of out's pieces is
+     # for, and how many times each one is expanded
+     counting = state.timer is not None and state.timer.counts is not None
+     if counting:
+          (out_names, expansions) = ([], {})
+     # (node, in_list) to visit, (None, frame) to finish a node once its
+     # children are done, or (False, (bits, prev_bits_left)) to check that
+     # an open node's missing children won't matter
+     todo = [(root, None)]
+     while todo:
+          (node, arg) = todo.pop()
+          if node is False:
+               (bits, prev_bits_left) = arg
+               if not state.done.done and (bits == 0 or prev_bits_left > 0):
+                    return None
+               continue
+          if node is None:
+               (p, bits, is_list, use_bits, in_list, prev_bits_left,
+                mark) = arg
+               i = tables.index[p]
+               if prev_bits_left <= 0:
+                    state.done.done = True
+                    del out[mark:]
+                    if counting:
+                         del out_names[mark:]
+               elif is_list and i == 2**bits:
+                    if use_bits:
+                         state.done.bits_left += bits  # encode didn't count these
+                    if in_list in list_bits:
+                         bits_left = list_bits[in_list]
+                         if bits_left <= 0 and len(list_bits) > 1:
+                              del list_bits[in_list]
+                    # end of the list -- still count the choices below us
+               else:
+                    out[mark] = bitio.piece(i, bits)
+               continue
+
+          if state.done.done:
+               continue
+          p = node[0]
+          sym = prod_lhs[p]
+          bits = tables.bits[sym]
+          if counting:
+               expansions[names[sym]] = expansions.get(names[sym], 0) + 1
+
+          in_list = arg
+          if in_list is None and sym in list_bits:
+               in_list = sym
+
+          use_bits = sym not in last_or_nots
+
+          # Consume list bits before we start recursing, since that's the
+          # order ./encode.py does it.
+          is_list = False
+          if bits > 0 and in_list in list_bits:
+               is_list = True
+               if use_bits:
+                    if (tables.recursive[sym] and
+                        list_bits[in_list] <= 0 and len(list_bits) > 1):
+                         use_bits = False
+                    list_bits[in_list] -= bits
+
+          prev_bits_left = state.done.bits_left
+          if use_bits:
+               state.done.bits_left -= bits
+
+          if len(list_bits) == 0 and sym == tables.body:
+               for (l, b) in state.common.calc_list_bits(
+                    state.done.total_len, grammar.production(p)).iteritems():
+                    list_bits[tables.ids[l.symbol()]] = b
+
+          if bits > 0:
+               # If this had fewer than 3 rules, the first one was always
+               # used, so don't produce any bits.  Otherwise save a spot for
+               # our bits ahead of our children's.
+               todo.append((None, (p, bits, is_list, use_bits, in_list,
+                                   prev_bits_left, len(out))))
+               out.append(None)
+               if counting:
+                    out_names.append(names[sym])
+          if id(node) in open_ids:
+               todo.append((False, (bits, prev_bits_left)))
+          for child in reversed(node[1]):
+               todo.append((child, in_list))
+     if counting:
+          # only now that the walk has succeeded, since a partial tree
+          # may be walked several times
+          count_choices(state.timer, out, out_names, expansions)
+     return [s for s in out if s is not None]
+
+def get_code_bits(root, grammar, state, open_ids=()):
+     """get_bits, for versions whose choices can use all of a rule's
+     productions (see grammar_cache.compile_choices).  Each choice's code
+     length follows from the production picked, so the choices are just
+     read off in the order the encoder made them, children after their
+     parent, until they cover the message.  The last one may run past its
+     end (see trim_code_bits)."""
+     out = []
+     tables = grammar.choices(state.common)
+     prod_lhs = grammar.parser().prod_lhs
+     last_or_nots = set(tables.ids[nt.symbol()]
+                        for nt in state.common.choose_last_or_nots()
+                        if nt.symbol() in tables.ids)
+     counting = state.timer is not None and state.timer.counts is not None
+     if counting:
+          (out_names, expansions) = ([], {})
+     # nodes to visit, or None once an open node's children are done
+     todo = [root]
+     while todo and not state.done.done:
+          node = todo.pop()
+          if node is None:
+               if state.done.bits_left > 0:
+                    # its missing children could still carry bits
+                    return None
+               state.done.done = True
+               break
+          if state.done.bits_left <= 0:
+               state.done.done = True
+               break
+          p = node[0]
+          sym = prod_lhs[p]
+          if counting:
+               name = grammar.symbol(sym).symbol()
+               expansions[name] = expansions.get(name, 0) + 1
+          bits = tables.bits[sym]
+          i = tables.index[p]
+          # the end of a list takes no bits
+          if (bits > 0 and sym not in last_or_nots and
+              not (tables.recursive[sym] and i == tables.end[sym])):
+               short = tables.short[sym]
+               if i >= short:
+                    (i, bits) = (i + short, bits + 1)
+               out.append(bitio.piece(i, bits))
+               state.done.bits_left -= bits
+               if counting:
+                    out_names.append(name)
+          if id(node) in open_ids:
+               todo.append(None)
+          for child in reversed(node[1]):
+               todo.append(child)
+     if counting:
+          count_choices(state.timer, out, out_names, expansions)
+     return out
+
+def count_choices(timer, out, out_names, expansions):
+     """Add the choices get_bits made to timer's counts."""
+     bits = {}
+     for i in xrange(len(out)):
+          if out[i] is not None:
+               bits[out_names[i]] = (bits.get(out_names[i], 0) +
+                                     bitio.piece_bits(out[i]))
+     for (nt, n) in expansions.iteritems():
+          timer.count(nt, bits.get(nt, 0), n)
+
+def text_to_words(text):
      # add in a marker for single-line spaces, otherwise they will get split out
      if isinstance(text, str):
           text = text.decode("utf-8")
      words = text.lower().replace("\n\n", "\nNEWLINE_SPACE\n").split()
-     ready_words = [w.replace("NEWLINE_SPACE", " ") for w in words]
-     parsed = parser.parse(ready_words)
+     return [w.replace("NEWLINE_SPACE", " ") for w in words]
+
+def trim_bits(n, length):
+     if len(n) < 1:
+          raise DecodeError("Could not decode this text")
+
+     # the total length should be "length".  If not, cut off
+     # some bits from the last number
+     bitlength = sum(bitio.piece_bits(p) for p in n)
+     over = bitlength - length
+     out = bitio.BitWriter()
+     for p in n[:-1]:
+          out.write_piece(p)
+     last_bits = bitio.piece_bits(n[-1])
+     if over >= 0:
+          keep = max(last_bits - over, 0)
+     else:
+          keep = min(-over, last_bits)
+     out.write(n[-1] & ((1 << keep) - 1), keep)
+     return out
+
+def trim_code_bits(n, length):
+     """trim_bits, for get_code_bits: the message is the first length bits
+     of the choices, so cut off the end of the last one."""
+     if len(n) < 1:
+          raise DecodeError("Could not decode this text")
+
+     out = bitio.BitWriter()
+     left = length
+     for p in n:
+          bits = bitio.piece_bits(p)
+          if bits >= left:
+               out.write((p ^ (1 << bits)) >> (bits - left), left)
+               break
+          out.write_piece(p)
+          left -= bits
+     return out
+
+def parse_text(text, grammar, state, length):
+     return parse_words(text_to_words(text), grammar, state, length)
+
+# how many words to parse between checks for an early finish
+EARLY_CHECK_WORDS = 32
+
+def parse_words(words, grammar, state, length, strict=True):
+     """Parse words and return the message bits, or None if they don't
+     parse.  Unless strict is set, this stops reading words as soon as the
+     ones so far are enough to fix all length bits, so the filler the
+     encoder adds after the message isn't parsed (or even checked)."""
+     parse = lr_parser.Parse(grammar.parser(state.common))
+     if grammar.choices(state.common).all_prods:
+          (walk, trim) = (get_code_bits, trim_code_bits)
+     else:
+          (walk, trim) = (get_bits, trim_bits)
+     next_check = EARLY_CHECK_WORDS
+     for w in words:
+          if not parse.feed(w):
+               return None
+          if strict or parse.count < next_check:
+               continue
+          # each check walks the whole tree, so space them out to keep
+          # the total time linear
+          wait = parse.count//4
+          partial = parse.partial_tree()
+          if partial is not None:
+               state.list_bits.clear()
+               state.done.reset(length)
+               n = walk(partial[0], grammar, state, partial[1])
+               if n is not None:
+                    return trim(n, length)
+               # no word carries anywhere near this many bits
+               wait = state.done.bits_left//16
+          next_check = parse.count + max(EARLY_CHECK_WORDS, wait)
+
+     root = parse.finish()
+     if root is None:
+          return None
+     state.list_bits.clear()
+     state.done.reset(length)
+     return trim(walk(root, grammar, state), length)
+
+# The original decoder, using nltk's chart parser.  Much slower, but kept
+# around for comparison.  It only knows how version 1 and before code their
+# choices.
+def chart_parse_text(text, grammar, state, length):
+     parser = nltk.parse.LeftCornerChartParser(grammar)
+     parsed = parser.parse(text_to_words(text))
 
      found = False
      for t in parsed:
@@ -179,16 +420,7 @@ def parse_text(text, grammar, state, length):
           found = True
           state.done.reset(length)
           (l, n) = get_number(t, grammar, state)
-          if len(n) < 1:
-               print "Could not decode this text"
-               sys.exit(-1)
-
-          # the total length should be "length".  If not, cut off
-          # some bits from the last number
-          bitlength = sum(len(s) for s in n)
-          over = bitlength - length
-          n[-1] = n[-1][over:]
-          return "".join(n)
+          return trim_bits(n, length)
 
 # Reverse pretty print:
 #  1) add one space before all punctuation (except '(')
@@ -219,38 +451,161 @@ def decode_conf_name(header):
                break
 
      if not conf_name:
-          raise Exception("Bad header format -- could not find conference name")
+          raise DecodeError("Bad header format -- could not find "
+                            "conference name")
 
-     index = binsearch_conf_names(conf_name)
+     index = conf_names.index_from_name(conf_name)
+     if index is None:
+          raise DecodeError("Bad header format -- unknown conference name %s" %
+                            conf_name)
      mask = index >> 13
      version = ((index >> 5) & 0xff) ^ mask
      ls_len = (index & 0x1f)
-     return (conf_name, mask, version, ls_len)
-
-def decode(header, body_text, state, ls_len):
-     header = reverse_pretty_print_all(header, state)
-
-     header_binstring = parse_text(header.replace(state.conf_name,
-                                                  "CFP_CONF_ABBREV"),
-                                   state.header_grammar, state, 15)
-     #sys.stderr.write("header: %s\n" % header_binstring)
-     ms_len = (int(header_binstring, 2) ^ (state.mask |
-                                           (state.mask & 0x7f) << 8))
-     body_len = (ms_len << 5) | ls_len
+     compressed = bool(version & cfp_common.COMPRESSED)
+     version &= ~cfp_common.COMPRESSED
+     return (conf_name, mask, version, ls_len, compressed)
 
+def unpretty_lines(body_text, state):
+     timer = state.timer or stats.NO_TIMER
+     start = time.time()
      # replace any links with WEBSITE_LINK (don't replace the punctuation
      # after it, though)
      body_text = re.sub('(http://[\w\.]+\w)(\.?\s)', r'WEBSITE_LINK\2',
                         body_text)
      body_text = re.sub('(?:January|February|March|April|May|June|July|August|September|October|November|December) \d{1,2}, \d{4}', r'SUBSTITUTE_DATE', body_text)
-     unpretty_text = reverse_pretty_print_all(
-          body_text.replace(state.conf_name, "CFP_CONF_ABBREV"), state)
+     body_text = body_text.replace(state.conf_name, "CFP_CONF_ABBREV")
+     start = timer.add("dates", start)
+     lines = [reverse_pretty_print(line, state)
+              for line in body_text.splitlines()]
+     timer.add("pretty_print", start)
+     return lines
+
+def unpretty_body(body_text, state):
+     return "\n".join(unpretty_lines(body_text, state))
+
+def body_words(body_lines, state):
+     """The same words as text_to_words(unpretty_body(body_text, state)),
+     but reading the body a line at a time.  None of the substitutions
+     span lines."""
+     newlines = 0
+     started = False
+     for raw_line in body_lines:
+          for line in unpretty_lines(raw_line, state):
+               if started:
+                    newlines += 1
+               started = True
+               if not line:
+                    continue
+               # each pair of line breaks in a row is a single-line space
+               for i in xrange(newlines//2):
+                    yield " "
+               newlines = 0
+               if isinstance(line, str):
+                    line = line.decode("utf-8")
+               for w in line.lower().split():
+                    yield w
+     for i in xrange(newlines//2):
+          yield " "
+
+def decode(header, body, state, ls_len, strict=False):
+     """Decode a message.  body is either the text of the body, or an
+     iterable of its lines, which is only read as far as needed unless
+     strict is set (see parse_words)."""
+     timer = state.timer or stats.NO_TIMER
+     start = time.time()
+     header = reverse_pretty_print_all(header, state)
+     start = timer.add("pretty_print", start)
+
+     header_bits = parse_text(header.replace(state.conf_name,
+                                             "CFP_CONF_ABBREV"),
+                              state.header_grammar, state, 15)
+     timer.add("header", start)
+     #sys.stderr.write("header: %s\n" % header_bits.to_int())
+     ms_len = (header_bits.to_int() ^ (state.mask |
+                                           (state.mask & 0x7f) << 8))
+     body_len = (ms_len << 5) | ls_len
+
+     if isinstance(body, basestring):
+          body = body.splitlines(True)
+     # body_words times its own unprettying
+     (start, timed) = (time.time(), timer.timed)
+     body_bits = parse_words(body_words(body, state), state.body_grammar,
+                             state, body_len*8, strict)
+     timer.add_rest("body", start, timed)
+     if body_bits is None:
+          raise DecodeError("Couldn't parse the message!")
+     text = bin_to_text(body_bits, state.mask)
+     if state.compressed:
+          start = time.time()
+          try:
+               text = bitio.decompress(text.encode("latin-1"))
+          except ValueError as e:
+               raise DecodeError(str(e))
+          text = text.decode("latin-1")
+          timer.add("decompress", start)
+     return text
+
+def new_state(common, conf_name, mask, header_grammar, body_grammar,
+              timer=None, compressed=False):
+     space_before = re.compile('([%s])' %
+                               common.chars_to_remove_a_space_before())
+     space_after = re.compile('([%s])' % common.chars_to_remove_a_space_after())
+     return DecodeState(common, conf_name, mask, header_grammar, body_grammar,
+                        {}, space_before, space_after, Done(), timer,
+                        compressed)
+
+def read_header(lines):
+     """Read the header of the CFP in lines, an iterator over its lines,
+     up to the blank line after it, and return it as one line."""
+     # search until blank line:
+     header = ""
+     header_lines = []
+     for line in lines:
+          line = line.rstrip()
+          # we hit a blank line, and we have at least one line already
+          if not line and len(header_lines) > 0:
+               break
+          header_lines.append(line)
+          header = " ".join(header_lines)
+     return header
 
-     body_binstring = parse_text(unpretty_text, state.body_grammar, state,
-                                 body_len*8)
-     if body_binstring is None:
-          raise Exception("Couldn't parse the message!")
-     return bin_to_text(body_binstring, state.mask)
+def load_grammars(version, timer=None):
+     """(common, header grammar, body grammar) for decoding version, or
+     None if there is no such version."""
+     common = cfp_common.CfpCommon.get_common_for_version(version)
+     if common is None:
+          return None
+     with (timer or stats.NO_TIMER).span("load_grammars"):
+          header_grammar = load_and_norm_grammar(common.header_cfg_filename())
+          body_grammar = load_and_norm_grammar(common.body_cfg_filename())
+          # the parsers are built on first use
+          header_grammar.parser()
+          body_grammar.parser()
+     return (common, header_grammar, body_grammar)
+
+def decode_cfp(header, lines, grammars, strict=False, timer=None):
+     """Decode the CFP with the given header (see read_header), reading
+     its body from lines only as far as needed.  grammars(version) is
+     like load_grammars, for callers that keep their own."""
+     start = time.time()
+     (conf_name, mask, version, ls_len, compressed) = decode_conf_name(header)
+     if timer is not None:
+          timer.add("conf_name", start)
+     loaded = grammars(version)
+     if loaded is None:
+          raise DecodeError("Unrecognized version: %s" % version)
+     (common, header_grammar, body_grammar) = loaded
+     state = new_state(common, conf_name, mask, header_grammar, body_grammar,
+                       timer, compressed)
+     return decode(header, lines, state, ls_len, strict)
+
+def decode_lines(lines, strict=False, timer=None):
+     """Decode the CFP in lines, an iterator over its lines.  Only the
+     header and as much of the body as needed are read from it.  The time
+     spent in each phase is added to timer, if given."""
+     return decode_cfp(read_header(lines), lines,
+                       lambda version: load_grammars(version, timer),
+                       strict, timer)
 
 def main():
      parser = argparse.ArgumentParser()
@@ -260,46 +615,67 @@ def main():
                          help='read from this file instead of stdin')
      parser.add_argument('--outfile', metavar='FILE', type=str,
                          help='write to this file instead of stdout')
+     parser.add_argument('--socket-files', action='store_true',
+                         help='with --socket, have the daemon read and write '
+                         'the files itself instead of sending it the data')
+     parser.add_argument('--strict', action='store_true',
+                         help='parse all of the text, even the filler after '
+                         'the message')
+     parser.add_argument('--chunked', action='store_true',
+                         help='decode a message split across several CFPs, '
+                         'as written by encode.py --chunked')
+     parser.add_argument('--indir', metavar='DIR', type=str,
+                         help='with --chunked, read the CFPs from the files '
+                         'in this directory instead of stdin')
+     parser.add_argument('--jobs', metavar='J', type=int,
+                         help='with --chunked, the number of processes to '
+                         'decode with (default: one per CPU)')
+     parser.add_argument('--trace', metavar='FILE', type=str,
+                         help='write how long each phase took to FILE, as '
+                         'JSON ("-" for stderr)')
+     parser.add_argument('--trace-counts', action='store_true',
+                         help='with --trace, also count the choices made for '
+                         'each nonterminal')
      args = parser.parse_args()
 
      if args.socket:
-          ok = scipherd.call_daemon(args.socket, False,
-                                    args.infile, args.outfile)
+          ok = scipher_client.call_daemon(args.socket, False,
+                                          args.infile, args.outfile,
+                                          args.socket_files)
           if ok:
                sys.exit(0)
           else:
                sys.exit(-1)
 
-     # search until blank line:
-     header = ""
-     header_lines = []
-     for line in sys.stdin:
-          line = line.rstrip()
-          # we hit a blank line, and we have at least one line already
-          if not line and len(header_lines) > 0:
-               break
-          header_lines.append(line)
-          header = " ".join(header_lines)
-
-     (conf_name, mask, version, ls_len) = decode_conf_name(header)
-     common = cfp_common.CfpCommon.get_common_for_version(version)
-     if common is None:
-          sys.stderr.write("Unrecognized version: %s\n" % version)
+     if args.trace and args.chunked:
+          sys.stderr.write("--trace doesn't work with --chunked\n")
           sys.exit(-1)
 
-     body_text = ""
-     for line in sys.stdin:
-          body_text += line
-
-     header_grammar = load_and_norm_grammar(common.header_cfg_filename())
-     body_grammar = load_and_norm_grammar(common.body_cfg_filename())
-     space_before = re.compile('([%s])' %
-                               common.chars_to_remove_a_space_before())
-     space_after = re.compile('([%s])' % common.chars_to_remove_a_space_after())
-     state = DecodeState(common, conf_name, mask, header_grammar, body_grammar,
-                         {}, space_before, space_after, Done())
-
-     print decode(header, body_text, state, ls_len),
+     if args.chunked:
+          if args.indir:
+               cfps = chunked.read_dir(args.indir)
+          else:
+               cfps = chunked.split_stream(sys.stdin)
+          try:
+               print chunked.decode_chunks(cfps, args.strict, args.jobs),
+          except DecodeError as e:
+               sys.stderr.write("%s\n" % e)
+               sys.exit(-1)
+          return
+
+     # decode stops reading the body once it has the whole message
+     # (not "for line in sys.stdin", which reads ahead)
+     timer = None
+     if args.trace:
+          timer = stats.Tracer(args.trace_counts)
+     try:
+          msg = decode_lines(iter(sys.stdin.readline, ""), args.strict, timer)
+     except DecodeError as e:
+          sys.stderr.write("%s\n" % e)
+          sys.exit(-1)
+     print msg,
+     if args.trace:
+          stats.write_trace(args.trace, timer)
 
 if __name__ == "__main__":
      main()
@@ -1,37 +1,23 @@
 #!/usr/bin/env python
 
 import argparse
+import bitio
 import cfp_common
+import chunked
 import collections
+import conf_names
 import datetime
-import math
+import grammar_cache
 import nltk
+import planner
 import re
-import Queue
 import random
-import scipherd
+import scipher_client
+import stats
 import sys
 import time
 import zmq
 
-####
-# from http://bytes.com/topic/python/answers/828486-ascii-binary-conversion
-def a2b(a, mask):
-     ord_a = ord(a)
-     if ord_a >= 256:
-          raise Exception("Unsupported character: %s" % a)
-     ai = ord_a ^ mask
-     return ''.join('01'[(ai >> x) & 1] for x in xrange(7, -1, -1))
-####
-
-class Bitstring:
-     def __init__(self):
-          self.reset("")
-
-     def reset(self, bitstring):
-          self.bitstring = bitstring
-          self.index = 0
-
 class LastTime:
      def __init__(self):
           self.last_time = time.time()
@@ -45,98 +31,165 @@ EncodeState = collections.namedtuple('EncodeState',
                                       'header_grammar', 'body_grammar',
                                       'list_bits', 'space_before',
                                       'space_after', 'last_or_nots',
-                                      'last_time'])
-
-def choose(nonterm, in_list, prods, state):
-     if nonterm in state.last_or_nots:
+                                      'last_time', 'timer', 'target',
+                                      'compressed'])
+# timer is a stats.Timer for the time spent in each phase, if wanted,
+# target is the size in bytes to steer the CFP towards, if any (see
+# planner.Steering), and compressed is set if input_text is the message
+# compressed (see message_state)
+EncodeState.__new__.__defaults__ = (None, None, False)
+
+def choose(grammar, tables, sym, in_list, last_or_nots, state):
+     """Pick a production for sym, and return its id."""
+     prods = tables.prods[sym]
+     if sym in last_or_nots:
           # if True, use the last one, otherwise, use anything but.
           # this choice uses no bits
-          if state.last_or_nots[nonterm]:
+          if last_or_nots[sym]:
                return prods[len(prods)-1]
           else:
                return random.choice(prods[:-1])
-     elif state.bitstring.index >= len(state.bitstring.bitstring):
+     elif state.bitstring.at_end():
           # We're past the end of the message, so just pick randomly
           return random.choice(prods)
-     elif len(prods) < 3:
+     bits = tables.bits[sym]
+     if bits == 0:
           return prods[0]
 
-     bits = int(math.log(len(prods)-1, 2))
-     prevPow2 = math.pow(2, bits)
-
      # For lists, only pick the end of the list once we've used all
      # the bits, or we're out of bits.  Unless we're the last list
      # left, then keep going until we consume all bits
      end_list = False
-     if in_list and in_list in state.list_bits:
+     if in_list is not None and in_list in state.list_bits:
           bits_left = state.list_bits[in_list]
           if (bits_left <= 0 and len(state.list_bits) > 1 and
-              nonterm in state.common.list_recursive_terms()):
+              tables.recursive[sym]):
                end_list = True
                del state.list_bits[in_list]
           else:
                state.list_bits[in_list] = bits_left - bits
-               #print ("Consuming %s bits for list %s (%s left)" %
-               #       (bits, in_list, state.list_bits[in_list]))
 
      # otherwise, use the first 'bits' bits to pick the index
-     index = int(prevPow2)
-     if not end_list:
-          strindex = state.bitstring.bitstring[state.bitstring.index:bits+
-                                               state.bitstring.index]
-          index = int(strindex, 2)
-          #print ("(%s) Using bits %s (%s -> %s)" %
-          #       (len(state.bitstring.bitstring)-state.bitstring.index, strindex, nonterm, prods[index]))
-          state.bitstring.index += bits
-          state.bitstring.index = min(state.bitstring.index,
-                                      len(state.bitstring.bitstring))
+     index = tables.end[sym]
+     if not end_list and not tables.all_prods:
+          index = state.bitstring.read(bits)
+     elif not end_list:
+          # a truncated binary code: the first tables.short[sym] indexes
+          # take 'bits' bits, the others one more
+          index = state.bitstring.read_padded(bits)
+          short = tables.short[sym]
+          if index >= short:
+               index = ((index << 1) | state.bitstring.read_padded(1)) - short
+               if in_list is not None and in_list in state.list_bits:
+                    state.list_bits[in_list] -= 1
      # now interpret as an int
      prod = prods[index]
-     if len(state.list_bits) == 0 and nonterm == nltk.Nonterminal("CFP_BODY"):
-          # set the list bits
-          state.list_bits.update(
-               state.common.calc_list_bits(len(state.input_text)*8, prod))
+     if len(state.list_bits) == 0 and sym == tables.body:
+          # set the list bits, by list symbol id
+          list_bits = state.common.calc_list_bits(len(state.input_text)*8,
+                                                  grammar.production(prod))
+          for (l, bits) in list_bits.iteritems():
+               state.list_bits[tables.ids[l.symbol()]] = bits
      return prod
 
-def expand(grammar, nonterm, state, in_list = None):
-     # pick random production, recurse
-     prods = grammar.productions(nonterm)
-     if len(prods) == 0:
-          return prods
-     p = choose(nonterm, in_list, prods, state)
-     return p.rhs()
-
-def expand_all(grammar, nonterm, state):
-     result = ""
-     queue = Queue.LifoQueue()
-     queue.put_nowait(nonterm)
+def iter_expand(grammar, nonterm, state, steer=None):
+     """Expand nonterm all the way down, yielding the output words in
+     order.  Line breaks come out as "\\n" words.  If steer is given, it
+     makes the choices after the end of the message."""
+     # work on symbol and production ids (see grammar_cache.compile_choices)
+     tables = grammar.choices(state.common)
+     prods = tables.prods
+     words = tables.words
+     pushes = tables.pushes
+     last_or_nots = dict((tables.ids[nt.symbol()], v)
+                         for (nt, v) in state.last_or_nots.iteritems()
+                         if nt.symbol() in tables.ids)
+     list_bits = state.list_bits
+     # count each nonterminal's choices, if the timer wants them
+     counts = state.timer is not None and state.timer.counts is not None
+     names = grammar.table[1]
+     stack = [tables.ids[nonterm.symbol()]]
      # do this iteratively; recursively blows past python's recursive limit
      in_list = None
      len_at_start_of_list = 0
-     while not queue.empty():
-          head = queue.get_nowait()
+     while stack:
+          head = stack.pop()
           # Keep track of being in a list until all the bits for the list
           # have been used up
-          if head in state.list_bits:
+          if head in list_bits:
                in_list = head
-               len_at_start_of_list = queue.qsize()
-          # done with the list once we consume the next item in the queue
-          if in_list and queue.qsize() < len_at_start_of_list:
+               len_at_start_of_list = len(stack)
+          # done with the list once we consume the next item in the stack
+          if in_list is not None and len(stack) < len_at_start_of_list:
                in_list = None
-          terms = expand(grammar, head, state, in_list)
-          if len(terms) == 0:
-               if isinstance(head, basestring):
-                    result = " ".join([result, head])
-               else:
-                    result = " ".join([result, str(head)])
-          else :
-               # put them into the lifo queue backwards, so we'll get the
-               # first one out
-               for nt in reversed(terms):
-                    if nt in state.common.append_newlines():
-                         queue.put_nowait(nltk.Nonterminal("\n"))
-                    queue.put_nowait(nt)
-     return result
+          if not prods[head]:
+               if steer is not None:
+                    steer.word(head)
+               yield words[head]
+          elif (steer is not None and head not in last_or_nots and
+                state.bitstring.at_end()):
+               stack.extend(pushes[steer.choose(head, prods[head], stack)])
+          elif not counts:
+               # push the symbols on backwards, so we'll get the first one
+               # out
+               stack.extend(pushes[choose(grammar, tables, head, in_list,
+                                          last_or_nots, state)])
+          else:
+               index = state.bitstring.index
+               stack.extend(pushes[choose(grammar, tables, head, in_list,
+                                          last_or_nots, state)])
+               state.timer.count(names[head], state.bitstring.index - index)
+
+def expand_all(grammar, nonterm, state):
+     # Join the words once at the end; appending to a string copies it
+     # every time.
+     words = list(iter_expand(grammar, nonterm, state))
+     if not words:
+          return ""
+     return " " + " ".join(words)
+
+def compress_text(text):
+     """text, deflated (see bitio.compress) if that makes it shorter, as
+     (the characters to encode, whether they're compressed)."""
+     data = bitio.compress(bitio.text_to_bytes(text, 0))
+     if len(data) >= len(text):
+          return (text, False)
+     return (data.decode("latin-1"), True)
+
+def base_state(common, header_grammar, body_grammar, website=None):
+     """An EncodeState with no message, holding what doesn't change from
+     one message to the next.  message_state fills in the rest, so the
+     daemon can make this once and use it for every message."""
+     space_before = re.compile('\s([%s])' %
+                               common.chars_to_remove_a_space_before())
+     space_after = re.compile('([%s])\s' %
+                              common.chars_to_remove_a_space_after())
+     last_or_nots = dict(common.choose_last_or_nots())
+     if website:
+          last_or_nots[nltk.Nonterminal("SUBMIT_CLOSING")] = True
+     return EncodeState(u"", None, common, header_grammar, body_grammar,
+                        None, space_before, space_after, last_or_nots, None)
+
+def message_state(base, input_text, timer=None, target=None,
+                  compress=False):
+     """base, from base_state, set up to encode input_text.  If compress
+     is set, the message is compressed first, if that helps; every
+     character saved saves 8 bits of choices."""
+     compressed = False
+     if compress:
+          with (timer or stats.NO_TIMER).span("compress"):
+               (input_text, compressed) = compress_text(input_text)
+     return base._replace(input_text=input_text, bitstring=bitio.BitReader(),
+                          list_bits={}, last_time=LastTime(), timer=timer,
+                          target=target, compressed=compressed)
+
+def new_state(common, input_text, header_grammar, body_grammar,
+              website=None, timer=None, target=None, compress=False):
+     """An EncodeState for encoding input_text with common's grammars (see
+     message_state)."""
+     return message_state(base_state(common, header_grammar, body_grammar,
+                                     website),
+                          input_text, timer, target, compress)
 
 # Must be determinstically reversible by the decoder, so use the
 # following rules:
@@ -163,7 +216,8 @@ def pretty_print_all(text, state):
 #  with.
 #
 #  bits 0-7: a random XOR mask for the body of the data
-#  bits 8-15: a version number for the grammar itself (masked)
+#  bits 8-15: a version number for the grammar itself, with the top bit
+#             set if the message is compressed (masked)
 #  bits 16-20: the least significant 5 bits of the input text
 #
 #  Once this is figured out, generate the header by using a masked
@@ -171,39 +225,51 @@ def pretty_print_all(text, state):
 #  (15 bytes, capping the whole thing at 1M)
 
 def do_encode(state, website = None):
+     (header, body_lines) = encode_stream(state, website)
+     return (header, "\n".join(body_lines))
+
+def encode_stream(state, website = None):
+     """Like do_encode, but the body comes back as a generator of finished
+     lines, which does the encoding as it's consumed."""
+     timer = state.timer or stats.NO_TIMER
+     start = time.time()
      mask = random.randint(0,255)
      version = state.common.version()
-     if version < 0 or version > 255:
+     if version < 0 or version >= cfp_common.COMPRESSED:
           print "Bad grammar version: %d" % version
           sys.exit(-1)
+     version_byte = version
+     if state.compressed:
+          version_byte |= cfp_common.COMPRESSED
 
      ls_len = len(state.input_text) & 0x1f
 
-     name_index = (mask << 13) | ((version ^ mask) << 5) | ls_len
-     f = open(cfp_common.CfpCommon.conf_names_filename(), 'r')
-     conf_name = cfp_common.CfpCommon.conf_name_from_index(f, name_index)
-     f.close()
-     #print "3) %s" % time.time()
+     name_index = (mask << 13) | ((version_byte ^ mask) << 5) | ls_len
+     conf_name = conf_names.name_from_index(name_index)
+     start = timer.add("conf_name", start)
 
      ms_len = len(state.input_text) >> 5
-     masked_len = "{0:015b}".format(ms_len ^ (mask | (mask & 0x7f) << 8))
+     masked_len = ms_len ^ (mask | (mask & 0x7f) << 8)
      #sys.stderr.write("header: %s\n" % masked_len)
-     state.bitstring.reset(masked_len)
+     state.bitstring.reset_int(masked_len, 15)
      header = expand_all(state.header_grammar,
                          state.header_grammar.start(), state)
+     start = timer.add("header", start)
      header = pretty_print_all(header.replace("CFP_CONF_ABBREV", conf_name),
                                state)
-
-     #print "4) %s" % time.time()
-
-     body_string = "".join([a2b(c, mask) for c in state.input_text])
-     state.bitstring.reset(body_string)
-     body = expand_all(state.body_grammar, state.body_grammar.start(), state)
-     if website:
-          body = body.replace("WEBSITE_LINK", website)
-
-     #print "5) %s" % time.time()
-
+     timer.add("pretty_print", start)
+
+     state.bitstring.reset(bitio.text_to_bytes(state.input_text, mask))
+     steer = None
+     if state.target:
+          sizes = planner.get_planner(version, website).body
+          steer = planner.Steering(sizes, state.target -
+                                   len(header.encode('utf-8')) -
+                                   planner.SEPARATOR_BYTES)
+     return (header, body_lines(state, conf_name, website, steer))
+
+def body_lines(state, conf_name, website, steer=None):
+     timer = state.timer or stats.NO_TIMER
      # Replace dates:
      date_re = re.compile("(SUBSTITUTE_DATE)")
      def sub_datetime(matchobj):
@@ -211,11 +277,44 @@ def do_encode(state, website = None):
           next_time = state.last_time.next_time()
           return (datetime.date.fromtimestamp(next_time).strftime("%B %d, %Y").
                   lstrip("0").replace(" 0", " "))
-     body = date_re.sub(sub_datetime, body)
 
-     #print "6) %s" % time.time()
-     body =  pretty_print_all(body.replace("CFP_CONF_ABBREV", conf_name), state)
-     return (header, body)
+     # None of the substitutions span lines, so do them a line at a time,
+     # as soon as each line is done.
+     def finish(words):
+          start = time.time()
+          line = " ".join(words)
+          if website:
+               line = line.replace("WEBSITE_LINK", website)
+          line = date_re.sub(sub_datetime, line)
+          line = line.replace("CFP_CONF_ABBREV", conf_name)
+          start = timer.add("dates", start)
+          lines = [pretty_print(l, state) for l in line.splitlines() or [""]]
+          timer.add("pretty_print", start)
+          return lines
+
+     # the body's time is whatever isn't spent in finish, or by the caller
+     # between lines
+     (start, timed) = (time.time(), timer.timed)
+     words = []
+     for word in iter_expand(state.body_grammar, state.body_grammar.start(),
+                             state, steer):
+          if word == "\n":
+               lines = finish(words)
+               timer.add_rest("body", start, timed)
+               for line in lines:
+                    yield line
+               (start, timed) = (time.time(), timer.timed)
+               words = []
+          else:
+               words.append(word)
+     # a final line break doesn't start another line
+     if words:
+          lines = finish(words)
+     else:
+          lines = []
+     timer.add_rest("body", start, timed)
+     for line in lines:
+          yield line
 
 def main():
      parser = argparse.ArgumentParser()
@@ -227,14 +326,43 @@ def main():
                          help='read from this file instead of stdin')
      parser.add_argument('--outfile', metavar='FILE', type=str,
                          help='write to this file instead of stdout')
+     parser.add_argument('--socket-files', action='store_true',
+                         help='with --socket, have the daemon read and write '
+                         'the files itself instead of sending it the data')
      parser.add_argument('--website', metavar='W', type=str,
                          help='a website link to include, if any '
                          '(must start with "http://")')
+     parser.add_argument('--stream', action='store_true',
+                         help='write out each line as soon as it is encoded')
+     parser.add_argument('--chunked', action='store_true',
+                         help='split the message across as many CFPs as '
+                         'needed (messages over 1MB always are)')
+     parser.add_argument('--chunk-size', metavar='N', type=int,
+                         default=chunked.CHUNK_SIZE,
+                         help='with --chunked, the most characters to put '
+                         'in one CFP (at most, and by default, %d)' %
+                         chunked.CHUNK_SIZE)
+     parser.add_argument('--jobs', metavar='J', type=int,
+                         help='with --chunked, the number of processes to '
+                         'encode with (default: one per CPU)')
+     parser.add_argument('--compress', action='store_true',
+                         help='compress the message first, if that makes '
+                         'the CFP shorter')
+     parser.add_argument('--target-size', metavar='N', type=int,
+                         help='make the CFP about N bytes long, if the '
+                         'message leaves room (see planner.py)')
+     parser.add_argument('--trace', metavar='FILE', type=str,
+                         help='write how long each phase took to FILE, as '
+                         'JSON ("-" for stderr)')
+     parser.add_argument('--trace-counts', action='store_true',
+                         help='with --trace, also count the choices made for '
+                         'each nonterminal')
      args = parser.parse_args()
 
      if args.socket:
-          ok = scipherd.call_daemon(args.socket, True,
-                                    args.infile, args.outfile)
+          ok = scipher_client.call_daemon(args.socket, True,
+                                          args.infile, args.outfile,
+                                          args.socket_files)
           if ok:
                sys.exit(0)
           else:
@@ -251,37 +379,69 @@ def main():
      for line in sys.stdin:
           input_text += line.decode('utf-8')
 
-     if len(input_text) > 2**20:
-          print "Input text must be smaller than 1MB."
+     # the header's length field only has 20 bits
+     if len(input_text) > chunked.CHUNK_SIZE and not args.chunked:
+          sys.stderr.write("Input text is too long for one CFP, so it "
+                           "will be split across several CFPs; decode them "
+                           "with --chunked.\n")
+          args.chunked = True
+
+     if args.trace and args.chunked:
+          sys.stderr.write("--trace doesn't work with --chunked\n")
           sys.exit(-1)
 
-     common = cfp_common.CfpCommon.get_latest_common()
-     space_before = re.compile('\s([%s])' %
-                               common.chars_to_remove_a_space_before())
-     space_after = re.compile('([%s])\s' %
-                              common.chars_to_remove_a_space_after())
+     if args.target_size and args.chunked:
+          sys.stderr.write("--target-size doesn't work with --chunked\n")
+          sys.exit(-1)
 
-     last_or_nots = common.choose_last_or_nots()
-     if args.website:
-          if args.website.find("http://") != 0:
-               sys.stderr.write("Bad website: %s\n" % args.website)
-               sys.exit(-1)
-          last_or_nots[nltk.Nonterminal("SUBMIT_CLOSING")] = True
+     if not 0 < args.chunk_size <= chunked.CHUNK_SIZE:
+          sys.stderr.write("--chunk-size must be between 1 and %d\n" %
+                           chunked.CHUNK_SIZE)
+          sys.exit(-1)
 
-     # load grammars
-     #print "1) %s" % time.time()
-     header_grammar = nltk.data.load("file:%s" % common.header_cfg_filename(),
-                                     'cfg')
-     body_grammar = nltk.data.load("file:%s" % common.body_cfg_filename(),
-                                   'cfg')
-     #print "2) %s" % time.time()
-     state = EncodeState(input_text, Bitstring(), common, header_grammar,
-                         body_grammar, {}, space_before, space_after,
-                         last_or_nots, LastTime())
-     (header, body) = do_encode(state, args.website)
-     print header
-     print ""
-     print body
+     if args.website and args.website.find("http://") != 0:
+          sys.stderr.write("Bad website: %s\n" % args.website)
+          sys.exit(-1)
+
+     if args.chunked:
+          first = True
+          for cfp in chunked.encode_chunks(input_text, seed, args.website,
+                                           args.chunk_size, args.jobs,
+                                           args.compress):
+               if not first:
+                    print chunked.SEPARATOR
+               print cfp
+               sys.stdout.flush()
+               first = False
+          return
+
+     if args.trace:
+          timer = stats.Tracer(args.trace_counts)
+     else:
+          timer = stats.NO_TIMER
+     with timer.span("load_grammars"):
+          common = cfp_common.CfpCommon.get_latest_common()
+          header_grammar = grammar_cache.load_grammar(
+               common.header_cfg_filename())
+          body_grammar = grammar_cache.load_grammar(
+               common.body_cfg_filename())
+     state = new_state(common, input_text, header_grammar, body_grammar,
+                       args.website, timer if args.trace else None,
+                       args.target_size, args.compress)
+     if args.stream:
+          (header, body_lines) = encode_stream(state, args.website)
+          print header
+          print ""
+          for line in body_lines:
+               print line
+               sys.stdout.flush()
+     else:
+          (header, body) = do_encode(state, args.website)
+          print header
+          print ""
+          print body
+     if args.trace:
+          stats.write_trace(args.trace, timer)
 
 
 if __name__ == "__main__":
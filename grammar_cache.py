@@ -0,0 +1,595 @@
+#!/usr/bin/env python
+
+# On-disk cache of compiled grammars.
+#
+# Parsing a .cfg file with nltk takes about half a second per file, which
+# dominates script-mode runs for short messages.  Instead, we compile each
+# grammar once into a flat table of symbol names and integer productions,
+# and store it in CACHE_DIR keyed by a hash of the .cfg file's contents.
+# The table holds both the encode form of the grammar and the lower-cased
+# form that the decoder parses against.  If a .cfg file changes, its hash
+# changes too, so the cache is rebuilt automatically on the next load.
+# The tables built from those for each grammar version, the encoder's
+# choice tables and the decoder's LR parse tables, are cached alongside
+# them, so that a run only has to load them.
+#
+# To build the cache for every known grammar version ahead of time:
+#
+#     ./grammar_cache.py
+
+import argparse
+import cfp_common
+import collections
+import glob
+import hashlib
+import lr_parser
+import marshal
+import math
+import nltk
+import os
+import re
+import sys
+
+CACHE_DIR = ".grammar_cache"
+
+# Bump this whenever the layout of the compiled table changes.  Tables are
+# stored with marshal, which loads the flat lists and tuples we use several
+# times faster than cPickle; its format can differ between interpreters, so
+# the marshal version is part of the cache key too.
+CACHE_FORMAT = 7
+
+quote_re = re.compile("\"([^\"]*)\"")
+def tolower_inquotes(matchobj):
+     return "\"%s\"" % matchobj.group(1).lower()
+
+def norm_grammar_string(gs):
+     # when decoding, treat all terminals as lower case
+     return quote_re.sub(tolower_inquotes, gs)
+
+def compile_grammar(grammar):
+     """Flatten an nltk CFG into (start, names, is_nonterm, prods, lhs_index).
+
+     Every symbol is numbered once; prods is a list of (lhs, rhs) id tuples
+     in grammar order, and lhs_index maps a nonterminal id to the ids of its
+     productions, in order."""
+     names = []
+     is_nonterm = []
+     ids = {}
+     def symbol_id(sym):
+          nonterm = isinstance(sym, nltk.Nonterminal)
+          key = (nonterm, sym.symbol() if nonterm else sym)
+          if key not in ids:
+               ids[key] = len(names)
+               names.append(key[1])
+               is_nonterm.append(nonterm)
+          return ids[key]
+
+     start = symbol_id(grammar.start())
+     prods = []
+     lhs_index = {}
+     for p in grammar.productions():
+          lhs = symbol_id(p.lhs())
+          lhs_index.setdefault(lhs, []).append(len(prods))
+          prods.append((lhs, tuple(symbol_id(s) for s in p.rhs())))
+     return (start, names, is_nonterm, prods, lhs_index)
+
+# What the encoder needs to know about each symbol and production, as lists
+# indexed by id (see compile_choices).
+ChoiceTables = collections.namedtuple('ChoiceTables',
+                                      ['ids', 'prods', 'bits', 'words',
+                                       'recursive', 'pushes', 'newline',
+                                       'body', 'codes', 'short', 'end',
+                                       'index', 'all_prods', 'folded'])
+
+def compile_choices(grammar, common):
+     """Build the encoder's tables for grammar, a CachedGrammar:
+
+     ids        nonterminal name -> id
+     prods      symbol id -> tuple of its production ids
+     bits       symbol id -> bits a choice between its productions encodes
+     words      symbol id -> its output word, if it has no productions
+     recursive  symbol id -> True for the list terms that can end a list
+     pushes     production id -> the symbol ids to push onto the expansion
+                stack, last one first, with line breaks after the symbols
+                in common.append_newlines(), and the symbols of
+                constant_symbols already expanded
+     newline    the id of the line break symbol
+     body       the id of CFP_BODY, or None
+     codes      symbol id -> how many of its first productions the message
+                picks from
+     short      symbol id -> how many of those take bits bits; the rest
+                take one more
+     end        symbol id -> the index of the production that ends a list
+     index      production id -> its index in prods
+     all_prods  common.uses_all_productions()
+     folded     production id -> how many expansions of constant symbols
+                its pushes save
+
+     Up to version 1, a choice between n >= 3 productions reads k =
+     floor(log2(n-1)) bits and picks among the first 2**k, leaving the next
+     one to end lists, and prods are in grammar order.
+
+     With all_prods, the codes are a truncated binary code: with
+     2**k <= codes < 2**(k+1), the first 2**(k+1) - codes productions take
+     k bits and the others k+1.  The codes cover the productions version 1
+     picks from, and then those of the rest that the decoder can always
+     tell apart from the others by their first word (see clashing_prods).
+     The productions left over go last, and are only used after the
+     message.  A list term keeps its last production to end the list."""
+     (start, names, is_nonterm, prods, lhs_index) = grammar.table
+     newline = len(names)
+     ids = dict(grammar._nonterm_ids)
+     symbols = [grammar.symbol(i) for i in xrange(len(names))]
+     symbols.append(nltk.Nonterminal("\n"))
+
+     recursive_terms = set(common.list_recursive_terms())
+     recursive = [s in recursive_terms for s in symbols]
+     all_prods = common.uses_all_productions()
+     if all_prods:
+          clashes = grammar.clashes()
+
+     prod_ids = [tuple(lhs_index.get(i, ())) for i in xrange(len(symbols))]
+     bits = [0]*len(symbols)
+     words = [None]*len(symbols)
+     codes = [1]*len(symbols)
+     short = [1]*len(symbols)
+     end = [0]*len(symbols)
+     for i in xrange(len(symbols)):
+          n = len(prod_ids[i])
+          if n >= 3:
+               bits[i] = int(math.log(n - 1, 2))
+          if n == 0:
+               if isinstance(symbols[i], basestring):
+                    words[i] = symbols[i]
+               else:
+                    words[i] = str(symbols[i])
+          elif all_prods:
+               ps = prod_ids[i]
+               last = ()
+               if recursive[i] and n > 1:
+                    (ps, last) = (ps[:-1], ps[-1:])
+               old = 1 << bits[i]
+               new = tuple(p for p in ps[old:] if p not in clashes)
+               codes[i] = end[i] = old + len(new)
+               prod_ids[i] = (ps[:old] + new + last +
+                              tuple(p for p in ps[old:] if p in clashes))
+               bits[i] = codes[i].bit_length() - 1
+               short[i] = (2 << bits[i]) - codes[i]
+          else:
+               codes[i] = short[i] = end[i] = 1 << bits[i]
+
+     index = [0]*len(prods)
+     for ps in prod_ids:
+          for i in xrange(len(ps)):
+               index[ps[i]] = i
+
+     append_newlines = common.append_newlines()
+     pushes = []
+     for (lhs, rhs) in prods:
+          push = []
+          for s in reversed(rhs):
+               if symbols[s] in append_newlines:
+                    push.append(newline)
+               push.append(s)
+          pushes.append(tuple(push))
+
+     # expand the constant symbols in place, innermost first
+     constants = constant_symbols(grammar.table)
+     folded = [0]*len(prods)
+     done = set()
+     def fold(p):
+          push = []
+          for s in pushes[p]:
+               if s in constants:
+                    q = lhs_index[s][0]
+                    if q not in done:
+                         fold(q)
+                    push.extend(pushes[q])
+                    folded[p] += 1 + folded[q]
+               else:
+                    push.append(s)
+          pushes[p] = tuple(push)
+          done.add(p)
+     for p in xrange(len(prods)):
+          if p not in done:
+               fold(p)
+
+     return ChoiceTables(ids, prod_ids, bits, words, recursive, pushes,
+                         newline, ids.get("CFP_BODY"), codes, short, end,
+                         index, all_prods, folded)
+
+def constant_symbols(table):
+     """The nonterminals that can only expand one way: they have a single
+     production, which only uses terminals and other such nonterminals.
+     They never carry any bits, so the encoder and the parser work on
+     their words directly (see compile_choices and lr_parser.build_tables).
+     The start symbol is left alone."""
+     (start, names, is_nonterm, prods, lhs_index) = table
+     constants = set()
+     changed = True
+     while changed:
+          changed = False
+          for (lhs, ps) in lhs_index.iteritems():
+               if (lhs not in constants and lhs != start and len(ps) == 1 and
+                   all(not is_nonterm[s] or s in constants
+                       for s in prods[ps[0]][1])):
+                    constants.add(lhs)
+                    changed = True
+     return constants
+
+def clashing_prods(table):
+     """The ids of the productions whose first word, as the decoder sees
+     it, could also come from somewhere else in the grammar, or that can
+     be empty.  A production that doesn't clash starts with a word that
+     only appears below the symbols it starts with, and the symbols they
+     start with and so on, which aren't used anywhere else: wherever the
+     decoder sees that word, that production was used.  Telling the others
+     apart from their neighbours can take the whole rest of the text, or
+     fail, so version 2 on only picks them where version 1 did (see
+     compile_choices)."""
+     (start, names, is_nonterm, prods, lhs_index) = table
+     # the words of each terminal, the productions each symbol is used in,
+     # and the terminals each word is in
+     words = [names[s].lower().split() if not is_nonterm[s] else None
+              for s in xrange(len(names))]
+     users = [[] for s in xrange(len(names))]
+     for p in xrange(len(prods)):
+          for s in prods[p][1]:
+               users[s].append(p)
+     terminals = {}
+     for s in xrange(len(names)):
+          for w in words[s] or ():
+               terminals.setdefault(w, set()).add(s)
+
+     # the first words each symbol can start with, with None for empty
+     first = []
+     for s in xrange(len(names)):
+          if is_nonterm[s]:
+               first.append(set())
+          else:
+               first.append(frozenset(words[s][:1] or [None]))
+     def leading(p):
+          """The symbols production p can start with."""
+          out = []
+          for s in prods[p][1]:
+               out.append(s)
+               if None not in first[s]:
+                    break
+          return out
+     def prod_first(p):
+          out = set()
+          for s in leading(p):
+               out |= first[s]
+               out.discard(None)
+          if all(None in first[s] for s in prods[p][1]):
+               out.add(None)
+          return out
+     changed = True
+     while changed:
+          changed = False
+          for p in xrange(len(prods)):
+               more = prod_first(p)
+               if not more <= first[prods[p][0]]:
+                    first[prods[p][0]] |= more
+                    changed = True
+
+     clashes = []
+     for p in xrange(len(prods)):
+          firsts = prod_first(p)
+          if None in firsts:
+               clashes.append(p)
+               continue
+          # the symbols p starts with, all the way down
+          chain = set()
+          todo = leading(p)
+          while todo:
+               s = todo.pop()
+               if s not in chain:
+                    chain.add(s)
+                    for q in lhs_index.get(s, ()):
+                         todo.extend(leading(q))
+          inside = set([p])
+          for s in chain:
+               inside.update(lhs_index.get(s, ()))
+          if (any(not terminals[w] <= chain for w in firsts) or
+              any(q not in inside for s in chain for q in users[s])):
+               clashes.append(p)
+     return sorted(clashes)
+
+def unreachable_prods(grammar, tables):
+     """For each production id, 1 if the encoder never picks it while the
+     message lasts, else 0 (see lr_parser.preferred)."""
+     unreachable = [0]*len(grammar.table[3])
+     for s in xrange(len(tables.prods)):
+          ps = tables.prods[s]
+          for i in xrange(tables.codes[s], len(ps)):
+               if not (tables.recursive[s] and i == tables.end[s]):
+                    unreachable[ps[i]] = 1
+     return unreachable
+
+class CachedGrammar(nltk.CFG):
+     """An nltk CFG backed by a compiled grammar table.
+
+     Production objects are only created for a nonterminal the first time
+     its productions are asked for, which is all the encoder needs.  The
+     rest of nltk's indexes (needed by the chart parsers) are built on
+     first access to any of them."""
+
+     nltk_indexes = frozenset(['_productions', '_categories', '_lhs_index',
+                               '_rhs_index', '_empty_index', '_lexical_index',
+                               '_is_lexical', '_is_nonlexical', '_min_len',
+                               '_max_len', '_all_unary_are_lexical',
+                               '_immediate_leftcorner_categories',
+                               '_immediate_leftcorner_words', '_leftcorners',
+                               '_leftcorner_parents', '_leftcorner_words'])
+
+     def __init__(self, table, cfg_filename=None, digest=None,
+                  clashes=None, form=None):
+          (start, names, is_nonterm, prods, lhs_index) = table
+          self.table = table
+          self._clashes = None
+          if clashes is not None:
+               self._clashes = frozenset(clashes)
+          # where table is cached, if it is: the .cfg file, its digest, and
+          # which of its compiled forms ("encode" or "decode") it is
+          self.cfg_filename = cfg_filename
+          self.digest = digest
+          self.form = form
+          self._parsers = {}
+          self._choice_index = None
+          self._choices = {}
+          self._rhs_to_prod = {}
+          self._symbols = [None]*len(names)
+          self._nonterm_ids = dict((names[i], i) for i in xrange(len(names))
+                                   if is_nonterm[i])
+          self._prods = [None]*len(prods)
+          self._lhs_prods = {}
+          self._start = self.symbol(start)
+
+     def symbol(self, i):
+          s = self._symbols[i]
+          if s is None:
+               (start, names, is_nonterm, prods, lhs_index) = self.table
+               if is_nonterm[i]:
+                    s = nltk.Nonterminal(names[i])
+               else:
+                    s = names[i]
+               self._symbols[i] = s
+          return s
+
+     def production(self, i):
+          p = self._prods[i]
+          if p is None:
+               (lhs, rhs) = self.table[3][i]
+               p = nltk.Production(self.symbol(lhs),
+                                   [self.symbol(s) for s in rhs])
+               self._prods[i] = p
+          return p
+
+     def choice_index(self, p):
+          """The position of production p among the productions for its
+          left-hand side."""
+          if self._choice_index is None:
+               self._choice_index = [0]*len(self.table[3])
+               for ids in self.table[4].itervalues():
+                    for i in xrange(len(ids)):
+                         self._choice_index[ids[i]] = i
+          return self._choice_index[p]
+
+     def rhs_index(self, lhs):
+          """A dict from the right-hand side of each of lhs's productions
+          to that production's id.  If several productions have the same
+          right-hand side, the first one wins, as in lr_parser."""
+          index = self._rhs_to_prod.get(lhs)
+          if index is None:
+               index = {}
+               if isinstance(lhs, nltk.Nonterminal):
+                    i = self._nonterm_ids.get(lhs.symbol())
+                    for p in self.table[4].get(i, []):
+                         index.setdefault(self.production(p).rhs(), p)
+               self._rhs_to_prod[lhs] = index
+          return index
+
+     def clashes(self):
+          """The set of ids of the productions clashing_prods finds."""
+          if self._clashes is None:
+               self._clashes = frozenset(clashing_prods(self.table))
+          return self._clashes
+
+     def choices(self, common):
+          """The encoder's tables for this grammar, for common's version
+          of the grammar rules (see compile_choices)."""
+          tables = self._choices.get(common.version())
+          if tables is None:
+               tables = load_choices(self, common)
+               self._choices[common.version()] = tables
+          return tables
+
+     def parser(self, common=None):
+          """The LR parser for this grammar (see lr_parser.py).  Given
+          common, it prefers the parses common's version of the encoder
+          can make; otherwise, version 1's."""
+          key = None
+          if common is not None and self.choices(common).all_prods:
+               key = common.version()
+          parser = self._parsers.get(key)
+          if parser is None:
+               if None not in self._parsers:
+                    self._parsers[None] = lr_parser.Parser(
+                         load_parse_tables(self))
+               parser = self._parsers[None]
+               if key is not None:
+                    tables = dict(parser.tables, unreachable=unreachable_prods(
+                         self, self.choices(common)))
+                    parser = lr_parser.Parser(tables)
+               self._parsers[key] = parser
+          return parser
+
+     def productions(self, lhs=None, rhs=None, empty=False):
+          if lhs and not rhs and not empty:
+               prods = self._lhs_prods.get(lhs)
+               if prods is None:
+                    ids = []
+                    if isinstance(lhs, nltk.Nonterminal):
+                         i = self._nonterm_ids.get(lhs.symbol())
+                         ids = self.table[4].get(i, [])
+                    prods = [self.production(p) for p in ids]
+                    self._lhs_prods[lhs] = prods
+               return prods
+          return nltk.CFG.productions(self, lhs, rhs, empty)
+
+     def __getattr__(self, name):
+          # only reached for attributes that haven't been set yet
+          if name not in CachedGrammar.nltk_indexes:
+               raise AttributeError(name)
+          self._productions = [self.production(i)
+                               for i in xrange(len(self.table[3]))]
+          self._categories = set(p.lhs() for p in self._productions)
+          self._calculate_indexes()
+          self._calculate_grammar_forms()
+          self._calculate_leftcorners()
+          return getattr(self, name)
+
+def cache_filename(cfg_filename, digest, kind=""):
+     base = cfg_filename.replace(os.sep, "_")
+     return os.path.join(CACHE_DIR, "%s.%s%s.marshal" % (base, digest, kind))
+
+def build(cfg_filename, gs=None, digest=None):
+     """Compile cfg_filename and write the result into the cache."""
+     if gs is None:
+          gs = open(cfg_filename).read()
+     if digest is None:
+          digest = file_digest(gs)
+     ugs = gs.decode("UTF-8")
+     tables = {'format': CACHE_FORMAT,
+               'digest': digest,
+               'encode': compile_grammar(nltk.CFG.fromstring(ugs)),
+               'decode': compile_grammar(
+                    nltk.CFG.fromstring(norm_grammar_string(ugs)))}
+     tables['clashes'] = clashing_prods(tables['decode'])
+
+     # remove stale entries for this grammar file before writing ours
+     for old in glob.glob(cache_filename(cfg_filename, "*")):
+          os.unlink(old)
+     write_cache(cache_filename(cfg_filename, digest), tables)
+     return tables
+
+def write_cache(filename, tables):
+     try:
+          if not os.path.isdir(CACHE_DIR):
+               os.makedirs(CACHE_DIR)
+          tmpname = "%s.%d" % (filename, os.getpid())
+          f = open(tmpname, 'wb')
+          marshal.dump(tables, f)
+          f.close()
+          os.rename(tmpname, filename)
+     except (IOError, OSError) as e:
+          # not being able to cache is only a performance problem
+          sys.stderr.write("Could not cache %s: %s\n" % (filename, e))
+
+def file_digest(gs):
+     return hashlib.sha1("%d.%d\0%s" % (CACHE_FORMAT, marshal.version,
+                                         gs)).hexdigest()
+
+def load_tables(cfg_filename):
+     gs = open(cfg_filename).read()
+     digest = file_digest(gs)
+     try:
+          f = open(cache_filename(cfg_filename, digest), 'rb')
+          tables = marshal.load(f)
+          f.close()
+          if tables.get('format') == CACHE_FORMAT:
+               return tables
+     except (IOError, EOFError, ValueError, TypeError):
+          pass
+     return build(cfg_filename, gs, digest)
+
+def load_parse_tables(grammar):
+     """Load the LR parse tables for a decode grammar, building them if
+     needed.  They're cached separately since the encoder doesn't use them
+     and they take a second or so to build."""
+     if grammar.cfg_filename is None:
+          return lr_parser.build_tables(grammar.table,
+                                        constant_symbols(grammar.table))
+     filename = cache_filename(grammar.cfg_filename, grammar.digest,
+                               ".%s.lr" % grammar.form)
+     try:
+          f = open(filename, 'rb')
+          tables = marshal.load(f)
+          f.close()
+          return tables
+     except (IOError, EOFError, ValueError, TypeError):
+          pass
+     tables = lr_parser.build_tables(grammar.table,
+                                     constant_symbols(grammar.table))
+     write_cache(filename, tables)
+     return tables
+
+def common_digest(common):
+     """A hash of the rules in common that compile_choices uses."""
+     rules = (sorted(nt.symbol() for nt in common.list_recursive_terms()),
+              sorted(nt.symbol() for nt in common.append_newlines()),
+              common.uses_all_productions())
+     return hashlib.sha1(repr(rules)).hexdigest()
+
+def load_choices(grammar, common):
+     """Load the encoder's tables for grammar and common's version (see
+     compile_choices), building them if needed.  They take about as long
+     to build as the grammar takes to load, and they only change with the
+     grammar or the version's rules, so they're cached for each version.
+     The hash of those rules is kept inside, rather than in the file
+     name, so that a version whose rules are still being worked on
+     doesn't leave a file behind for each change."""
+     if grammar.cfg_filename is None:
+          return compile_choices(grammar, common)
+     filename = cache_filename(grammar.cfg_filename, grammar.digest,
+                               ".%s.v%d" % (grammar.form, common.version()))
+     rules = common_digest(common)
+     try:
+          f = open(filename, 'rb')
+          cached = marshal.load(f)
+          f.close()
+          if cached['rules'] == rules:
+               return ChoiceTables(*cached['tables'])
+     except (IOError, EOFError, ValueError, TypeError, KeyError):
+          pass
+     tables = compile_choices(grammar, common)
+     # marshal only takes plain tuples
+     write_cache(filename, {'rules': rules, 'tables': tuple(tables)})
+     return tables
+
+def load_grammar(cfg_filename):
+     """Load the grammar used for encoding."""
+     tables = load_tables(cfg_filename)
+     return CachedGrammar(tables['encode'], cfg_filename, tables['digest'],
+                          tables['clashes'], "encode")
+
+def load_decode_grammar(cfg_filename):
+     """Load the grammar with all terminals lower-cased, for decoding."""
+     tables = load_tables(cfg_filename)
+     return CachedGrammar(tables['decode'], cfg_filename, tables['digest'],
+                          tables['clashes'], "decode")
+
+def main():
+     parser = argparse.ArgumentParser(
+          description='Build the compiled grammar cache for all versions.')
+     parser.add_argument('--clean', action='store_true',
+                         help='remove all cached grammars first')
+     args = parser.parse_args()
+
+     if args.clean:
+          for old in glob.glob(os.path.join(CACHE_DIR, "*.marshal")):
+               os.unlink(old)
+
+     for version in sorted(cfp_common.CfpCommon.commons.keys()):
+          common = cfp_common.CfpCommon.get_common_for_version(version)
+          for filename in [common.header_cfg_filename(),
+                           common.body_cfg_filename()]:
+               load_grammar(filename).choices(common)
+               decode_grammar = load_decode_grammar(filename)
+               decode_grammar.choices(common)
+               decode_grammar.parser(common)
+               print "version %d: %s" % (version, filename)
+
+if __name__ == "__main__":
+     main()
@@ -0,0 +1,480 @@
+#!/usr/bin/env python
+
+# A linear-time parser for the CFP grammars.
+#
+# nltk's chart parsers are super-linear in both time and memory in the
+# length of the text, which makes decoding anything but small messages
+# very slow.  Since our grammars are unambiguous, we can do much better:
+# here we build an LR(0) automaton with SLR(1) lookaheads from a compiled
+# grammar (see grammar_cache.py), and run it over the text in a single
+# left-to-right pass.
+#
+# The grammars are not quite SLR(1): in a few states one token of
+# lookahead is not enough to pick between shifting and reducing.  In that
+# case the parser follows every possible action with its own stack, a
+# simple form of GLR parsing.  Stacks share their common prefixes, and the
+# wrong ones die out within a token or two, so the parse stays linear.
+# The tables record the nonterminals those states reduce to (see
+# find_conflicts); a grammar with none is SLR(1), and so certainly
+# unambiguous, and its parser doesn't look for second parses.
+#
+# Lower-casing the terminals for decoding does make a few spots in the
+# grammars ambiguous (e.g. "CFP" and "Cfp" are interchangeable in
+# CFP_TITLE), and a few phrases can be derived two ways in the original
+# grammars too (e.g. "online algorithms").  When two stacks reach the same
+# state over the same span of text, we keep the parse the encoder could
+# have made: up to grammar version 1, the encoder picks a production by
+# reading just enough bits to index the first 2^n+1 of them, so a parse
+# that uses any production past that loses to one that doesn't.  (Later
+# versions can pick any production; grammar_cache.CachedGrammar.parser
+# swaps in their own unreachable table.)  Otherwise the parse that uses
+# the lowest production numbers wins.
+#
+# A parse tree node is a list [production id, child nodes, count], where
+# the children only include the nonterminals on the right-hand side, and
+# count is the number of productions in the subtree that the encoder
+# never picks from bits.
+
+import collections
+import math
+
+# marks the end of the input in the lookahead sets
+END = -1
+
+# the production id used for the augmented start rule
+ACCEPT = -1
+
+def build_tables(table, constants=()):
+     """Build the parse tables for a compiled grammar (start, names,
+     is_nonterm, prods, lhs_index).  The nonterminals in constants, which
+     can only expand one way (see grammar_cache.constant_symbols), are
+     replaced by their words wherever they're used, so the parser never
+     reduces to them, and they never show up in the parse tree.  The
+     result only holds ints, lists, dicts and frozensets, so it can be
+     cached with marshal."""
+     (start, names, is_nonterm, prods, lhs_index) = table
+
+     # Productions that are identical after normalization (e.g. "Do" and
+     # "do" both lower-cased to "do") would just be a pointless ambiguity,
+     # so only the first copy of each is used for parsing.
+     seen = set()
+     by_lhs = collections.defaultdict(list)
+     for lhs in sorted(lhs_index.keys()):
+          if lhs in constants:
+               continue
+          for p in lhs_index[lhs]:
+               if prods[p] not in seen:
+                    seen.add(prods[p])
+                    by_lhs[lhs].append(p)
+
+     # This comes after removing the duplicates: productions that only
+     # become the same once folded (e.g. using "CFP" and "Cfp", which are
+     # both "cfp" for the decoder) are still told apart by preferred.
+     words = {}
+     def fold(s):
+          if s not in words:
+               words[s] = tuple(w for c in prods[lhs_index[s][0]][1]
+                                for w in (fold(c) if c in constants
+                                          else (c,)))
+          return words[s]
+     prods = [(lhs, tuple(w for s in r
+                          for w in (fold(s) if s in constants else (s,))))
+              for (lhs, r) in prods]
+
+     # nonterminals reachable as the left corner of each nonterminal
+     left = collections.defaultdict(set)
+     for lhs, ps in by_lhs.iteritems():
+          for p in ps:
+               first = prods[p][1][0]
+               if is_nonterm[first]:
+                    left[lhs].add(first)
+     left_closure = {}
+     for lhs in by_lhs:
+          reach = set([lhs])
+          todo = [lhs]
+          while todo:
+               for nt in left[todo.pop()]:
+                    if nt not in reach:
+                         reach.add(nt)
+                         todo.append(nt)
+          left_closure[lhs] = reach
+
+     # the productions of each nonterminal, grouped by their first symbol
+     starting_with = {}
+     for lhs, ps in by_lhs.iteritems():
+          groups = collections.defaultdict(list)
+          for p in ps:
+               groups[prods[p][1][0]].append(p)
+          starting_with[lhs] = groups
+
+     def rhs(p):
+          if p == ACCEPT:
+               return (start,)
+          return prods[p][1]
+
+     # The canonical LR(0) collection.  Items are (production, dot) pairs,
+     # and states are identified by their kernel items.  Closure items are
+     # never stored; they are the dot-0 items of the nonterminals that can
+     # start at a dot, so we jump straight to their dot-1 successors.
+     state_ids = {}
+     kernels = []
+     def state_for(kernel):
+          kernel = tuple(sorted(set(kernel)))
+          if kernel not in state_ids:
+               state_ids[kernel] = len(kernels)
+               kernels.append(kernel)
+          return state_ids[kernel]
+
+     state_for([(ACCEPT, 0)])
+     shifts = []
+     gotos = []
+     completes = []
+     i = 0
+     while i < len(kernels):
+          successors = collections.defaultdict(list)
+          predicted = set()
+          complete = []
+          for (p, dot) in kernels[i]:
+               r = rhs(p)
+               if dot == len(r):
+                    complete.append(p)
+                    continue
+               successors[r[dot]].append((p, dot+1))
+               if is_nonterm[r[dot]]:
+                    predicted.update(left_closure.get(r[dot], ()))
+          for nt in predicted:
+               for sym, ps in starting_with[nt].iteritems():
+                    successors[sym].extend((p, 1) for p in ps)
+
+          shift = {}
+          goto = {}
+          for sym, kernel in successors.iteritems():
+               if is_nonterm[sym]:
+                    goto[sym] = state_for(kernel)
+               else:
+                    shift[sym] = state_for(kernel)
+          shifts.append(shift)
+          gotos.append(goto)
+          completes.append(complete)
+          i += 1
+
+     # SLR(1) lookaheads: reduce by A -> w only if the next token can
+     # follow A.  There are no empty productions, so FIRST sets are simple.
+     first = {}
+     for lhs in by_lhs:
+          first[lhs] = set()
+          for nt in left_closure[lhs]:
+               for sym in starting_with[nt]:
+                    if not is_nonterm[sym]:
+                         first[lhs].add(sym)
+     follow = collections.defaultdict(set)
+     follow[start].add(END)
+     changed = True
+     while changed:
+          changed = False
+          for lhs, ps in by_lhs.iteritems():
+               for p in ps:
+                    r = prods[p][1]
+                    for j in xrange(len(r)):
+                         if not is_nonterm[r[j]]:
+                              continue
+                         if j+1 < len(r):
+                              nxt = r[j+1]
+                              add = first[nxt] if is_nonterm[nxt] else [nxt]
+                         else:
+                              add = follow[lhs]
+                         before = len(follow[r[j]])
+                         follow[r[j]].update(add)
+                         if len(follow[r[j]]) != before:
+                              changed = True
+
+     # many nonterminals share the same follow set, so store each one once
+     lookaheads = []
+     lookahead_ids = {}
+     lookahead_of = {}
+     for nt, fs in follow.iteritems():
+          fs = frozenset(fs)
+          if fs not in lookahead_ids:
+               lookahead_ids[fs] = len(lookaheads)
+               lookaheads.append(fs)
+          lookahead_of[nt] = lookahead_ids[fs]
+
+     reduces = []
+     for complete in completes:
+          reduces.append(tuple((p, lookahead_of[prods[p][0]])
+                               for p in complete if p != ACCEPT))
+
+     # productions past the first 2^n+1 for their left-hand side
+     unreachable = [0]*len(prods)
+     for lhs, ps in lhs_index.iteritems():
+          if len(ps) >= 3:
+               limit = 2**int(math.log(len(ps)-1, 2))
+               for i in xrange(limit+1, len(ps)):
+                    unreachable[ps[i]] = 1
+
+     # nonterminals that can derive a string starting with themselves
+     left_recursive = [lhs for lhs in by_lhs
+                       if any(lhs in left_closure[nt] for nt in left[lhs])]
+
+     terminal_ids = dict((names[i], i) for i in xrange(len(names))
+                         if not is_nonterm[i])
+     tables = {'terminal_ids': terminal_ids,
+               'shifts': shifts,
+               'gotos': gotos,
+               'reduces': reduces,
+               'lookaheads': lookaheads,
+               'prod_lhs': [lhs for (lhs, r) in prods],
+               'prod_len': [len(r) for (lhs, r) in prods],
+               'prod_rhs': [r for (lhs, r) in prods],
+               'unreachable': unreachable,
+               'kernels': kernels,
+               'start': start,
+               'left_recursive': left_recursive,
+               'accept_state': gotos[0][start]}
+     tables['conflicts'] = sorted(set(prods[p][0]
+                                      for (state, t, ps, shift)
+                                      in find_conflicts(tables)
+                                      for p in ps))
+     return tables
+
+def find_conflicts(tables):
+     """The spots where one token of lookahead isn't enough to pick the
+     parser's next action, as (state, terminal id or END, the productions
+     it could reduce by, whether it could shift the terminal too).  If
+     there are none, the grammar is SLR(1), which means it's unambiguous;
+     otherwise it may or may not be."""
+     conflicts = []
+     for state in xrange(len(tables['shifts'])):
+          shift = tables['shifts'][state]
+          by_token = collections.defaultdict(list)
+          for (p, la) in tables['reduces'][state]:
+               for t in tables['lookaheads'][la]:
+                    by_token[t].append(p)
+          for (t, ps) in sorted(by_token.iteritems()):
+               if len(ps) > 1 or t in shift:
+                    conflicts.append((state, t, ps, t in shift))
+     return conflicts
+
+class Parser:
+     def __init__(self, tables):
+          self.tables = tables
+          self.terminal_ids = tables['terminal_ids']
+          self.shifts = tables['shifts']
+          self.gotos = tables['gotos']
+          self.reduces = tables['reduces']
+          self.lookaheads = tables['lookaheads']
+          self.prod_lhs = tables['prod_lhs']
+          self.prod_len = tables['prod_len']
+          self.prod_rhs = tables['prod_rhs']
+          self.unreachable = tables['unreachable']
+          self.kernels = tables['kernels']
+          self.start = tables['start']
+          self.left_recursive = frozenset(tables['left_recursive'])
+          self.accept_state = tables['accept_state']
+          # with no conflicts, no text has two parses to choose between
+          self.unambiguous = not tables['conflicts']
+          self._corner_paths = {}
+          self._by_lhs = None
+          self._left_closure = {}
+
+     def parse(self, words):
+          """Parse a sequence of words, and return the root node of the
+          parse tree, or None if the words can't be parsed."""
+          parse = Parse(self)
+          for w in words:
+               if not parse.feed(w):
+                    return None
+          return parse.finish()
+
+     def step(self, stacks, t):
+          """Do all the reductions allowed before token t, and then shift
+          t.  Returns the new set of stacks."""
+          shifts = self.shifts
+          gotos = self.gotos
+          reduces = self.reduces
+          lookaheads = self.lookaheads
+          prod_lhs = self.prod_lhs
+          prod_len = self.prod_len
+          unreachable = self.unreachable
+          unambiguous = self.unambiguous
+
+          shifted = []
+          todo = list(stacks)
+          seen = {}
+          while todo:
+               stack = todo.pop()
+               state = stack[0]
+               for (p, la) in reduces[state]:
+                    if t not in lookaheads[la]:
+                         continue
+                    children = []
+                    count = unreachable[p]
+                    rest = stack
+                    for j in xrange(prod_len[p]):
+                         if rest[1] is not None:
+                              children.append(rest[1])
+                              count += rest[1][2]
+                         rest = rest[2]
+                    children.reverse()
+                    node = [p, children, count]
+                    new_state = gotos[rest[0]][prod_lhs[p]]
+                    if unambiguous:
+                         # no other parse of this span to compare with
+                         todo.append((new_state, node, rest))
+                         continue
+                    key = (new_state, id(rest))
+                    if key in seen:
+                         # Two parses of the same symbol over the same text.
+                         # The first one may already be part of other
+                         # stacks, so update it in place if need be.
+                         old = seen[key][1]
+                         if preferred(node, old):
+                              old[:] = node
+                         continue
+                    new_stack = (new_state, node, rest)
+                    seen[key] = new_stack
+                    todo.append(new_stack)
+               if t != END:
+                    nxt = shifts[state].get(t)
+                    if nxt is not None:
+                         shifted.append((nxt, None, stack))
+               else:
+                    shifted.append(stack)
+          return shifted
+
+     def corner_path(self, b, a):
+          """If there's only one way for nonterminal b to derive a string
+          that starts with nonterminal a, returns the productions used on
+          the way down (empty if a is b).  Otherwise returns None."""
+          key = (b, a)
+          if key not in self._corner_paths:
+               self._corner_paths[key] = self._find_corner_path(b, a)
+          return self._corner_paths[key]
+
+     def _find_corner_path(self, b, a):
+          if b in self.left_recursive:
+               return None
+          if b == a:
+               return []
+          if self._by_lhs is None:
+               # the productions the parser uses, as in build_tables
+               self._by_lhs = collections.defaultdict(list)
+               seen = set()
+               for p in xrange(len(self.prod_lhs)):
+                    prod = (self.prod_lhs[p], self.prod_rhs[p])
+                    if prod not in seen:
+                         seen.add(prod)
+                         self._by_lhs[prod[0]].append(p)
+          paths = [p for p in self._by_lhs[b]
+                   if a in self.left_closure(self.prod_rhs[p][0])]
+          if len(paths) != 1:
+               return None
+          rest = self.corner_path(self.prod_rhs[paths[0]][0], a)
+          if rest is None:
+               return None
+          return [paths[0]] + rest
+
+     def left_closure(self, sym):
+          """The nonterminals that sym can start with, including itself."""
+          if sym not in self._left_closure:
+               reach = set([sym])
+               todo = [sym]
+               while todo:
+                    for p in self._by_lhs.get(todo.pop(), ()):
+                         first = self.prod_rhs[p][0]
+                         if first not in reach:
+                              reach.add(first)
+                              todo.append(first)
+               self._left_closure[sym] = reach
+          return self._left_closure[sym]
+
+class Parse:
+     """A parse in progress, fed one word at a time."""
+
+     def __init__(self, parser):
+          self.parser = parser
+          # A stack is a linked list of (state, node, rest), where node is
+          # the subtree for the symbol that was shifted into that state (or
+          # None for terminals).
+          self.bottom = (0, None, None)
+          self.stacks = [self.bottom]
+          self.count = 0
+
+     def feed(self, word):
+          """Shift the next word.  Returns False if the words so far can't
+          be the start of a parse."""
+          t = self.parser.terminal_ids.get(word)
+          if t is None:
+               self.stacks = []
+          elif self.stacks:
+               self.stacks = self.parser.step(self.stacks, t)
+          self.count += 1
+          return len(self.stacks) > 0
+
+     def finish(self):
+          """Returns the root node of the parse tree, or None if the words
+          fed so far aren't a complete parse."""
+          if not self.stacks:
+               return None
+          for s in self.parser.step(self.stacks, END):
+               if s[0] == self.parser.accept_state and s[2] is self.bottom:
+                    return s[1]
+          return None
+
+     def partial_tree(self):
+          """If the words so far fix every production from the root down to
+          the last word, whatever comes next, returns (root, open) for the
+          tree so far: open holds the ids of the nodes on its right edge,
+          which are still missing their later children.  Otherwise returns
+          None."""
+          if len(self.stacks) != 1:
+               return None
+          parser = self.parser
+          prod_lhs = parser.prod_lhs
+          stack = self.stacks[0]
+          child = None
+          open_ids = set()
+          while True:
+               kernel = parser.kernels[stack[0]]
+               if len(kernel) != 1:
+                    return None
+               (p, dot) = kernel[0]
+               if child is not None:
+                    # child must be the next symbol of p, or nested inside
+                    # it in only one possible way
+                    if p == ACCEPT:
+                         symbol = parser.start
+                    else:
+                         symbol = parser.prod_rhs[p][dot]
+                    path = parser.corner_path(symbol, prod_lhs[child[0]])
+                    if path is None:
+                         return None
+                    for q in reversed(path):
+                         child = [q, [child], 0]
+                         open_ids.add(id(child))
+               if p == ACCEPT:
+                    return (child, open_ids)
+               children = []
+               for j in xrange(dot):
+                    if stack[1] is not None:
+                         children.append(stack[1])
+                    stack = stack[2]
+               children.reverse()
+               if child is not None:
+                    children.append(child)
+               child = [p, children, 0]
+               open_ids.add(id(child))
+
+def preferred(a, b):
+     """True if tree a is a likelier encoding than tree b: it uses fewer
+     productions the encoder can't pick, or else lower production numbers,
+     comparing nodes in the order the encoder chose them."""
+     if a[2] != b[2]:
+          return a[2] < b[2]
+     todo = [(a, b)]
+     while todo:
+          (x, y) = todo.pop()
+          if x[0] != y[0]:
+               return x[0] < y[0]
+          todo.extend(reversed(zip(x[1], y[1])))
+     return False
@@ -0,0 +1,550 @@
+#!/usr/bin/env python
+
+# Predict how big the CFP for a message will be, without encoding it.
+#
+# Each choice the encoder makes either reads bits of the message, picking
+# among the productions the message can pick (see encode.choose), or, once
+# the message has run out, picks evenly among all of them.  So for every
+# symbol we work out the mean and variance of the words and bytes it
+# expands to, and the bits it reads, both ways.  The lists in the body are
+# different: the encoder keeps adding items to each one until it has used
+# up the bits common.calc_list_bits gave it, and the last list goes on
+# until the message ends.  So we walk the body in order, keeping track of
+# the bits left, with each list as long as its share of the message makes
+# it.  The header always carries 15 bits.
+#
+# min and max are three standard deviations either side of the mean.
+#
+#     ./planner.py 100 4096 1000000
+#     ./planner.py --version 0 --json 100
+#
+# encode.py --target-size uses the same numbers to steer the choices it
+# makes after the end of the message towards a total size (see Steering).
+
+import argparse
+import cfp_common
+import collections
+import conf_names
+import datetime
+import grammar_cache
+import json
+import math
+import nltk
+import random
+
+# bits in the header's masked message length (see encode.encode_stream)
+HEADER_BITS = 15
+
+# "\n\n" between the header and the body, and the last line's "\n"
+SEPARATOR_BYTES = 3
+
+# Words, bytes and bits of message of an expansion, and the variance of the
+# first two.
+Size = collections.namedtuple('Size', ['words', 'words_var', 'bytes',
+                                       'bytes_var', 'bits'])
+ZERO = Size(0.0, 0.0, 0.0, 0.0, 0.0)
+
+Plan = collections.namedtuple('Plan', ['length', 'version', 'words',
+                                       'words_min', 'words_max', 'bytes',
+                                       'bytes_min', 'bytes_max',
+                                       'bits_per_byte'])
+
+def add(a, b):
+     return Size(a.words + b.words, a.words_var + b.words_var,
+                 a.bytes + b.bytes, a.bytes_var + b.bytes_var,
+                 a.bits + b.bits)
+
+def times(size, n):
+     """The Size of n independent expansions."""
+     return Size(size.words*n, size.words_var*n, size.bytes*n,
+                 size.bytes_var*n, size.bits*n)
+
+def mix(weighted):
+     """The Size of picking one of the (weight, Size) pairs at random."""
+     total = float(sum(w for (w, s) in weighted))
+     words = sum(w*s.words for (w, s) in weighted)/total
+     nbytes = sum(w*s.bytes for (w, s) in weighted)/total
+     return Size(words,
+                 sum(w*(s.words_var + s.words**2)
+                     for (w, s) in weighted)/total - words**2,
+                 nbytes,
+                 sum(w*(s.bytes_var + s.bytes**2)
+                     for (w, s) in weighted)/total - nbytes**2,
+                 sum(w*s.bits for (w, s) in weighted)/total)
+
+def mean_date_bytes():
+     """The average length of a date as encode.body_lines writes it."""
+     start = datetime.date(2015, 1, 1)
+     days = [start + datetime.timedelta(i) for i in xrange(365)]
+     return (sum(len(d.strftime("%B %d, %Y").lstrip("0").replace(" 0", " "))
+                 for d in days)/365.0)
+
+def mean_conf_name_bytes():
+     step = conf_names.NUM_NAMES//256
+     return (sum(len(conf_names.name_from_index(i))
+                 for i in xrange(0, conf_names.NUM_NAMES, step))/256.0)
+
+DATE_BYTES = mean_date_bytes()
+CONF_NAME_BYTES = mean_conf_name_bytes()
+
+def strongly_connected(successors, n):
+     """The strongly connected components of the graph on 0..n-1, each
+     after all of the ones it leads to (Tarjan's algorithm, without
+     recursion)."""
+     index = [None]*n
+     low = [0]*n
+     on_stack = [False]*n
+     stack = []
+     components = []
+     counter = 0
+     for root in xrange(n):
+          if index[root] is not None:
+               continue
+          work = [(root, 0)]
+          while work:
+               (v, i) = work.pop()
+               if i == 0:
+                    index[v] = low[v] = counter
+                    counter += 1
+                    stack.append(v)
+                    on_stack[v] = True
+               succ = successors[v]
+               while i < len(succ):
+                    w = succ[i]
+                    i += 1
+                    if index[w] is None:
+                         work.append((v, i))
+                         work.append((w, 0))
+                         break
+                    elif on_stack[w]:
+                         low[v] = min(low[v], index[w])
+               else:
+                    if low[v] == index[v]:
+                         component = []
+                         while True:
+                              w = stack.pop()
+                              on_stack[w] = False
+                              component.append(w)
+                              if w == v:
+                                   break
+                         components.append(component)
+                    if work:
+                         u = work[-1][0]
+                         low[u] = min(low[u], low[v])
+     return components
+
+class GrammarSizes:
+     """The Sizes of every symbol in one grammar, while the message lasts
+     (data) and after it has run out (filler)."""
+     def __init__(self, grammar, common, last_or_nots, website=None):
+          self.grammar = grammar
+          self.common = common
+          self.tables = t = grammar.choices(common)
+          self.last_or_nots = dict((t.ids[nt.symbol()], v)
+                                   for (nt, v) in last_or_nots.iteritems()
+                                   if nt.symbol() in t.ids)
+          nsyms = len(t.prods)
+          self.cost = [self.word_size(t.words[s], website)
+                       if not t.prods[s] else None
+                       for s in xrange(nsyms)]
+
+          # the symbols each symbol's productions push
+          successors = [sorted(set(c for p in t.prods[s]
+                                   for c in t.pushes[p] if t.prods[c]))
+                        for s in xrange(nsyms)]
+          self.successors = successors
+          self.components = strongly_connected(successors, nsyms)
+          # symbols that lead to a list term, which the body walk (see
+          # Walk) has to look inside
+          self.has_list = [bool(t.recursive[s]) for s in xrange(nsyms)]
+          for component in self.components:
+               for s in component:
+                    if any(self.has_list[c] for c in successors[s]):
+                         self.has_list[s] = True
+               if any(self.has_list[s] for s in component):
+                    for s in component:
+                         self.has_list[s] = True
+
+          self.data = self.solve(True)
+          self.filler = self.solve(False)
+          # for each list term, one more item, and the production that
+          # ends the list, while the message lasts
+          self.item = self.data
+          self.end = [None]*nsyms
+          for s in xrange(nsyms):
+               if t.recursive[s] and t.prods[s]:
+                    end = t.prods[s][min(t.end[s], len(t.prods[s]) - 1)]
+                    self.end[s] = self.prod_size(end, self.data, s)
+
+     def expansions(self, root, leaves=(), items=None):
+          """How many times each symbol is expanded, on average, in one
+          expansion of root while the message lasts.  The symbols in
+          leaves aren't looked inside, and each list term s met along the
+          way has items[s] items (by default, one)."""
+          t = self.tables
+          counts = [0.0]*len(t.prods)
+          counts[root] = 1.0
+          def flows(s):
+               """(symbol, expansions per expansion of s) below s."""
+               if s in leaves or not t.prods[s]:
+                    return []
+               (prods, bits) = self.choices(s, True)
+               total = float(sum(w for (w, p) in prods))
+               out = []
+               for (w, p) in prods:
+                    for c in t.pushes[p]:
+                         if c == s and t.recursive[s]:
+                              # counted in items
+                              continue
+                         n = w/total
+                         if items and t.recursive[c] and c in items:
+                              n *= items[c]
+                         out.append((c, n))
+               return out
+          # parents come before their children in reversed(components)
+          for component in reversed(self.components):
+               inside = set(component)
+               out = dict((s, flows(s)) for s in component)
+               if len(component) > 1 or any(c in inside
+                                            for (c, n) in out[component[0]]):
+                    # recursion: iterate until the counts settle down
+                    outside = dict((s, counts[s]) for s in component)
+                    for i in xrange(1000):
+                         new = dict(outside)
+                         for s in component:
+                              for (c, n) in out[s]:
+                                   if c in inside:
+                                        new[c] += counts[s]*n
+                         change = max(abs(new[s] - counts[s])
+                                      for s in component)
+                         for s in component:
+                              counts[s] = new[s]
+                         if change < 1e-12:
+                              break
+               for s in component:
+                    for (c, n) in out[s]:
+                         if c not in inside:
+                              counts[c] += counts[s]*n
+          return counts
+
+     def word_size(self, word, website):
+          if word == "\n":
+               # takes the place of the space after the last word
+               return ZERO
+          if word == "SUBSTITUTE_DATE":
+               nbytes = DATE_BYTES
+          elif word == "CFP_CONF_ABBREV":
+               nbytes = CONF_NAME_BYTES
+          elif word == "WEBSITE_LINK" and website:
+               nbytes = len(website)
+          else:
+               nbytes = len(word.encode('utf-8'))
+          # pretty-printing drops the space before some punctuation, and
+          # after "("
+          if word[:1] and word[0] in self.common.chars_to_remove_a_space_before():
+               nbytes -= 1
+          if word[-1:] in self.common.chars_to_remove_a_space_after():
+               nbytes -= 1
+          return Size(1.0, 0.0, nbytes + 1.0, 0.0, 0.0)
+
+     def choices(self, s, data):
+          """The productions the encoder picks from for s, as (weight,
+          production) pairs, and the bits of message the choice takes on
+          average."""
+          t = self.tables
+          prods = t.prods[s]
+          if s in self.last_or_nots:
+               if self.last_or_nots[s]:
+                    return ([(1, prods[-1])], 0)
+               return ([(1, p) for p in prods[:-1]], 0)
+          if not data:
+               return ([(1, p) for p in prods], 0)
+          # the short codes are twice as likely as the long ones
+          (bits, short, codes) = (t.bits[s], t.short[s], t.codes[s])
+          return ([(2 if i < short else 1, prods[i]) for i in xrange(codes)],
+                  bits + float(codes - short)/(2 << bits))
+
+     def prod_size(self, p, sizes, skip=None):
+          size = ZERO
+          for c in self.tables.pushes[p]:
+               if c != skip:
+                    size = add(size, sizes[c])
+          return size
+
+     def symbol_size(self, s, sizes, data):
+          (prods, bits) = self.choices(s, data)
+          # a list term's data size is one item: while the message lasts,
+          # it never picks the production that ends the list
+          skip = s if data and self.tables.recursive[s] else None
+          size = mix([(w, self.prod_size(p, sizes, skip)) for (w, p) in prods])
+          return size._replace(bits=size.bits + bits)
+
+     def solve(self, data):
+          """Every symbol's Size, for data or filler choices."""
+          sizes = list(self.cost)
+          for component in self.components:
+               s = component[0]
+               if not self.tables.prods[s]:
+                    continue
+               if len(component) == 1 and s not in self.successors[s]:
+                    sizes[s] = self.symbol_size(s, sizes, data)
+                    continue
+               # recursive symbols are worked out by iterating until they
+               # settle down
+               for s in component:
+                    sizes[s] = ZERO
+               for i in xrange(1000):
+                    change = 0.0
+                    for s in component:
+                         old = sizes[s]
+                         sizes[s] = self.symbol_size(s, sizes, data)
+                         change = max(change,
+                                      abs(sizes[s].bytes - old.bytes),
+                                      abs(sizes[s].bytes_var - old.bytes_var))
+                    if change < 1e-9:
+                         break
+          return sizes
+
+class Walk:
+     """The Size of expanding a grammar with msg_bits bits of message, in
+     the order the encoder does it."""
+     def __init__(self, sizes, msg_bits):
+          self.sizes = sizes
+          self.msg_bits = msg_bits
+          # symbol id -> the symbols it can expand to
+          self.reached = {}
+
+     def expand(self, bits):
+          t = self.sizes.tables
+          return self.walk(t.ids[self.sizes.grammar.start().symbol()],
+                           bits, {}, None, False)[0]
+
+     def walk(self, s, left, lists, budget, last):
+          """The Size of expanding s with left bits of message left, and
+          budget bits left for the list being expanded, if any.  Returns
+          that, and the bits left after it."""
+          sizes = self.sizes
+          t = sizes.tables
+          if not t.prods[s]:
+               return (sizes.cost[s], left, budget)
+          if left <= 0:
+               return (sizes.filler[s], left, budget)
+          if budget is None and s in lists:
+               (budget, last) = lists[s]
+               if t.recursive[s]:
+                    (size, left, budget) = self.walk_list(s, left, budget,
+                                                          last)
+               else:
+                    (size, left, budget) = self.walk_choices(s, left, lists,
+                                                             budget, last)
+               return (size, left, None)
+          if t.recursive[s]:
+               return self.walk_list(s, left, budget, last)
+          if not sizes.has_list[s]:
+               data = sizes.data[s]
+               if data.bits <= left:
+                    used = data.bits
+                    size = data
+               else:
+                    # the message runs out somewhere in here
+                    used = left
+                    f = left/data.bits
+                    size = mix([(f, data), (1 - f, sizes.filler[s])])
+               if budget is not None:
+                    budget -= used
+               return (size, left - used, budget)
+          return self.walk_choices(s, left, lists, budget, last)
+
+     def walk_choices(self, s, left, lists, budget, last):
+          sizes = self.sizes
+          t = sizes.tables
+          (prods, bits) = sizes.choices(s, True)
+          left -= bits
+          if budget is not None:
+               budget -= bits
+          results = []
+          for (w, p) in prods:
+               p_lists = lists
+               if s == t.body and not lists:
+                    p_lists = self.list_bits(p)
+               size = ZERO
+               (p_left, p_budget) = (left, budget)
+               for c in reversed(t.pushes[p]):
+                    (c_size, p_left, p_budget) = self.walk(c, p_left, p_lists,
+                                                           p_budget, last)
+                    size = add(size, c_size)
+               results.append((w, size, p_left, p_budget))
+          n = float(sum(r[0] for r in results))
+          size = mix([(r[0], r[1]) for r in results])
+          left = sum(r[0]*r[2] for r in results)/n
+          if budget is not None:
+               budget = sum(r[0]*r[3] for r in results)/n
+          return (size._replace(bits=size.bits + bits), left, budget)
+
+     def walk_list(self, s, left, budget, last):
+          """A list term: items until its budget runs out (or the message,
+          for the last list), and then the end of the list."""
+          sizes = self.sizes
+          item = sizes.item[s]
+          end = sizes.end[s]
+          if item.bits <= 0:
+               return (sizes.filler[s], left, budget)
+          if budget is not None and not last:
+               n = max(0, math.ceil(budget/item.bits))
+               used = n*item.bits + end.bits
+               if used <= left:
+                    return (add(times(item, n), end), left - used,
+                            budget - used)
+          # the message ends in this list, and the rest of it is filler
+          n = left/item.bits
+          size = add(times(item, n), sizes.filler[s])
+          if budget is not None:
+               budget -= left
+          return (size._replace(bits=left), 0, budget)
+
+     def list_bits(self, p):
+          """The bits for each list in body production p, and which list
+          comes last, by list symbol id."""
+          t = self.sizes.tables
+          production = self.sizes.grammar.production(p)
+          bits = self.sizes.common.calc_list_bits(self.msg_bits, production)
+          ids = dict((t.ids[l.symbol()], b) for (l, b) in bits.iteritems())
+          # the lists come in the order of the sections holding them
+          order = []
+          for c in reversed(t.pushes[p]):
+               order.extend(l for l in self.reachable(c)
+                            if l in ids and l not in order)
+          return dict((l, (ids[l], l == order[-1])) for l in order)
+
+     def reachable(self, s):
+          """The symbols s can expand to, including itself."""
+          if s not in self.reached:
+               t = self.sizes.tables
+               seen = set()
+               todo = [s]
+               while todo:
+                    c = todo.pop()
+                    if c not in seen:
+                         seen.add(c)
+                         for p in t.prods[c]:
+                              todo.extend(t.pushes[p])
+               self.reached[s] = seen
+          return self.reached[s]
+
+class Planner:
+     """Plans CFPs for one grammar version."""
+     def __init__(self, common, website=None):
+          self.common = common
+          last_or_nots = dict(common.choose_last_or_nots())
+          if website:
+               # as encode.new_state does
+               last_or_nots[nltk.Nonterminal("SUBMIT_CLOSING")] = True
+          self.header = GrammarSizes(
+               grammar_cache.load_grammar(common.header_cfg_filename()),
+               common, last_or_nots, website)
+          self.body = GrammarSizes(
+               grammar_cache.load_grammar(common.body_cfg_filename()),
+               common, last_or_nots, website)
+
+     def header_size(self):
+          return Walk(self.header, 0).expand(HEADER_BITS)
+
+     def body_size(self, length):
+          return Walk(self.body, length*8).expand(length*8)
+
+     def plan(self, length):
+          """The Plan for a message of length characters."""
+          size = add(self.header_size(), self.body_size(length))
+          words_sd = math.sqrt(max(size.words_var, 0))
+          bytes_sd = math.sqrt(max(size.bytes_var, 0))
+          nbytes = size.bytes + SEPARATOR_BYTES
+          return Plan(length, self.common.version(), size.words,
+                      max(0, size.words - 3*words_sd),
+                      size.words + 3*words_sd, nbytes,
+                      max(0, nbytes - 3*bytes_sd), nbytes + 3*bytes_sd,
+                      length*8/nbytes)
+
+# (version, website) -> Planner
+planners = {}
+
+def get_planner(version=None, website=None):
+     """The Planner for version (by default, the latest), cached."""
+     if version is None:
+          version = cfp_common.CfpCommon.maxv
+     key = (version, website)
+     if key not in planners:
+          common = cfp_common.CfpCommon.get_common_for_version(version)
+          if common is None:
+               raise Exception("Unrecognized version: %s" % version)
+          planners[key] = Planner(common, website)
+     return planners[key]
+
+def plan(length, version=None, website=None):
+     """Predict the size of the CFP for a message of length characters."""
+     return get_planner(version, website).plan(length)
+
+class Steering:
+     """Steers the choices the encoder makes after the message has run out
+     towards a body of target bytes.  Once the message is out, each choice
+     is made at random among the productions that move the expected size
+     of the body the right way."""
+     def __init__(self, sizes, target):
+          self.target = target
+          t = sizes.tables
+          self.fill = [size.bytes for size in sizes.filler]
+          self.cost = [c.bytes if c is not None else 0.0
+                       for c in sizes.cost]
+          self.prod_fill = [sum(self.fill[c] for c in push)
+                            for push in t.pushes]
+          # bytes written so far, then once the message is out, those and
+          # the expected bytes of everything still to come
+          self.size = 0.0
+          self.steering = False
+
+     def word(self, sym):
+          if not self.steering:
+               self.size += self.cost[sym]
+
+     def choose(self, sym, prods, stack):
+          if not self.steering:
+               self.size += self.fill[sym] + sum(self.fill[s] for s in stack)
+               self.steering = True
+          if self.size < self.target:
+               better = [p for p in prods
+                         if self.prod_fill[p] >= self.fill[sym]]
+          else:
+               better = [p for p in prods
+                         if self.prod_fill[p] <= self.fill[sym]]
+          p = random.choice(better or prods)
+          self.size += self.prod_fill[p] - self.fill[sym]
+          return p
+
+def main():
+     parser = argparse.ArgumentParser(
+          description='Predict the size of the CFPs for messages of the '
+          'given lengths.')
+     parser.add_argument('lengths', metavar='LENGTH', type=int, nargs='+',
+                         help='message lengths, in characters')
+     parser.add_argument('--version', metavar='V', type=int,
+                         help='the grammar version (default: the latest)')
+     parser.add_argument('--website', metavar='W', type=str,
+                         help='the website link encode.py will be given')
+     parser.add_argument('--json', action='store_true',
+                         help='print each plan as a line of JSON')
+     args = parser.parse_args()
+
+     planner = get_planner(args.version, args.website)
+     if not args.json:
+          print "%10s %26s %30s %9s" % ("length", "words (min-max)",
+                                        "bytes (min-max)", "bits/byte")
+     for length in args.lengths:
+          p = planner.plan(length)
+          if args.json:
+               print json.dumps(p._asdict(), sort_keys=True)
+          else:
+               print "%10d %8.0f (%7.0f-%7.0f) %10.0f (%8.0f-%8.0f) %9.3f" % (
+                    p.length, p.words, p.words_min, p.words_max, p.bytes,
+                    p.bytes_min, p.bytes_max, p.bits_per_byte)
+
+if __name__ == "__main__":
+     main()
@@ -0,0 +1,268 @@
+# Client side of the scipherd.py protocol (described there).
+#
+# Client keeps one connection to the daemon open and lets any number of
+# requests be in flight at once:
+#
+#     client = scipher_client.Client("ipc:///tmp/scipherd")
+#     futures = [client.encode(msg) for msg in msgs]
+#     cfps = [f.result() for f in futures]
+#     client.close()
+#
+# Each request is sent as a batch of its own (or several at once with
+# Client.batch), so the batch id in each reply says which request it
+# answers.  Nothing happens in the background: replies are read whenever
+# the caller waits for a result, or calls process_replies().  To drive a
+# client from an event loop, watch fileno() for reading and call
+# process_replies() whenever it's readable, and after sending requests
+# (zmq only signals it when something changes); futures can also run
+# callbacks when they complete.
+#
+# This module only needs zmq, so services can use it without loading the
+# grammars.
+
+import json
+import os
+import sys
+import tempfile
+import time
+import zmq
+
+PROTOCOL = "SCIPHER/1"
+
+class Future:
+     """The result of a request to the daemon, once the reply arrives."""
+     def __init__(self, client):
+          self.client = client
+          self.ok = None
+          self.value = None
+          self.callbacks = []
+
+     def done(self):
+          return self.ok is not None
+
+     def result(self, timeout=None):
+          """Wait for the reply, for up to timeout seconds, and return the
+          result.  Raises an Exception holding the daemon's message if the
+          request failed."""
+          self.client.wait([self], timeout)
+          if not self.done():
+               raise Exception("Timed out waiting for the daemon")
+          if not self.ok:
+               raise Exception(self.value)
+          return self.value
+
+     def add_done_callback(self, fn):
+          """Call fn(future) once the reply arrives (right away if it
+          already has)."""
+          if self.done():
+               fn(self)
+          else:
+               self.callbacks.append(fn)
+
+     def set_result(self, ok, value):
+          self.ok = ok
+          self.value = value
+          for fn in self.callbacks:
+               fn(self)
+          self.callbacks = []
+
+class Client:
+     """A connection to the daemon.  Like zmq sockets, a client must only be
+     used by one thread at a time."""
+     def __init__(self, socket_name):
+          self.context = zmq.Context()
+          self.socket = self.context.socket(zmq.DEALER)
+          self.socket.connect(socket_name)
+          self.next_id = 0
+          # batch id -> futures for its jobs
+          self.pending = {}
+
+     def close(self):
+          self.socket.close(0)
+          self.context.term()
+
+     def __enter__(self):
+          return self
+
+     def __exit__(self, *exc):
+          self.close()
+
+     def fileno(self):
+          return self.socket.getsockopt(zmq.FD)
+
+     def batch(self, jobs):
+          """Send jobs, a list of (command, data) pairs, as one batch, and
+          return a future for each job."""
+          batch = str(self.next_id)
+          self.next_id += 1
+          request = [PROTOCOL, "batch", batch]
+          for (command, data) in jobs:
+               if isinstance(data, unicode):
+                    data = data.encode('utf-8')
+               request.extend([command, data])
+          futures = [Future(self) for job in jobs]
+          self.pending[batch] = futures
+          self.socket.send_multipart(request)
+          return futures
+
+     def encode(self, text):
+          return self.batch([("encode", text)])[0]
+
+     def decode(self, cfp):
+          return self.batch([("decode", cfp)])[0]
+
+     def process_replies(self, timeout=0):
+          """Handle the replies that have arrived, waiting up to timeout
+          seconds (forever if None) for the first one.  Returns whether
+          there were any."""
+          if timeout is not None:
+               timeout = int(timeout*1000)
+          if not self.socket.poll(timeout):
+               return False
+          while True:
+               try:
+                    reply = self.socket.recv_multipart(zmq.NOBLOCK)
+               except zmq.Again:
+                    return True
+               self.handle_reply(reply)
+
+     def handle_reply(self, reply):
+          if reply[0] != PROTOCOL:
+               raise Exception("Unsupported protocol in reply: %s" % reply[0])
+          if reply[1] == "item":
+               futures = self.pending.get(reply[2])
+               if futures is not None:
+                    result = reply[5] if len(reply) > 5 else ""
+                    futures[int(reply[3])].set_result(reply[4] == "ok",
+                                                      result)
+          elif reply[1] == "done":
+               self.pending.pop(reply[2], None)
+          elif reply[1] == "error":
+               # a batch the daemon wouldn't take at all; it doesn't say
+               # which, but we only send well-formed ones
+               raise Exception(reply[2])
+
+     def wait(self, futures, timeout=None):
+          """Wait until all the futures are done, or timeout seconds have
+          passed."""
+          if timeout is not None:
+               deadline = time.time() + timeout
+          while not all(f.done() for f in futures):
+               if timeout is None:
+                    self.process_replies(None)
+               elif not self.process_replies(max(deadline - time.time(), 0)):
+                    return
+
+     def as_completed(self, futures):
+          """Yield the futures as they complete."""
+          left = set(futures)
+          while left:
+               for f in [f for f in left if f.done()]:
+                    left.remove(f)
+                    yield f
+               if left:
+                    self.process_replies(None)
+
+def send_request(socket_name, request):
+     """Send request (a list of frames) to the daemon on a connection of its
+     own, and return its reply as (ok, the rest of the reply's frames)."""
+     context = zmq.Context()
+     socket = context.socket(zmq.DEALER)
+     socket.connect(socket_name)
+     socket.send_multipart(request)
+     reply = socket.recv_multipart()
+     socket.close()
+     context.term()
+     if reply[0] != PROTOCOL:
+          return (False, ["Unsupported protocol in reply: %s" % reply[0]])
+     return (reply[1] == "ok", reply[2:])
+
+def get_stats(socket_name):
+     """The daemon's stats (see scipherd.py), as a dict."""
+     (ok, reply) = send_request(socket_name, [PROTOCOL, "stats"])
+     if not ok:
+          raise Exception(reply[0])
+     return json.loads(reply[0])
+
+def send_batch(socket_name, jobs):
+     """Send jobs, a list of (command, data) pairs, to the daemon in one
+     batch, and yield (index, ok, result or error message) for each one as
+     the replies come in."""
+     client = Client(socket_name)
+     try:
+          futures = client.batch(jobs)
+          index = dict((futures[i], i) for i in xrange(len(futures)))
+          for f in client.as_completed(futures):
+               yield (index[f], f.ok, f.value)
+     finally:
+          client.close()
+
+def call_daemon(socket_name, encode, infile_arg, outfile_arg,
+                via_files=False):
+     if via_files:
+          return call_daemon_files(socket_name, encode, infile_arg,
+                                   outfile_arg)
+     if infile_arg:
+          inf = open(infile_arg, 'rb')
+          data = inf.read()
+          inf.close()
+     else:
+          data = sys.stdin.read()
+
+     client = Client(socket_name)
+     if encode:
+          future = client.encode(data)
+     else:
+          future = client.decode(data)
+     try:
+          result = future.result()
+     except Exception as e:
+          sys.stderr.write("%s\n" % e)
+          return False
+     finally:
+          client.close()
+
+     if outfile_arg:
+          outf = open(outfile_arg, 'wb')
+          outf.write(result)
+          outf.close()
+     elif encode:
+          sys.stdout.write(result)
+     else:
+          print result,
+     return True
+
+def call_daemon_files(socket_name, encode, infile_arg, outfile_arg):
+     infile = infile_arg
+     if not infile:
+          # write the data to a temporary file and call the daemon
+          (inf, infile) = tempfile.mkstemp()
+          for line in sys.stdin:
+               os.write(inf, line)
+          os.close(inf)
+
+     outfile = outfile_arg
+     if not outfile:
+          (outf, outfile) = tempfile.mkstemp()
+          os.close(outf)
+
+     command = "encode-file" if encode else "decode-file"
+     (ok, reply) = send_request(socket_name,
+                                [PROTOCOL, command, os.path.abspath(infile),
+                                 os.path.abspath(outfile)])
+
+     if not outfile_arg:
+          outf = open(outfile, 'r')
+          for line in outf:
+               if ok:
+                   print line,
+               else:
+                   sys.stderr.write(line)
+          outf.close()
+          os.unlink(outfile)
+     elif not ok:
+          sys.stderr.write("%s\n" % reply[0])
+
+     if not infile_arg:
+          os.unlink(infile)
+     return ok
@@ -7,186 +7,461 @@ import cfp_common
 import collections
 import decode
 import encode
+import grammar_cache
 import io
-import nltk
+import json
 import os
-import pickle
 import re
+import resource
+import scipher_client
+import shutil
+import signal
+import stats
 import sys
 import tempfile
 import threading
+import time
 import zmq
 
-Task = collections.namedtuple('Task', ['encode', 'infile', 'outfile'])
+# Requests and replies are zmq multipart messages, whose first frame is
+# PROTOCOL and whose second is the command or status.  The requests are:
+#
+#   encode, <message>             encode the message, which is UTF-8 text
+#   decode, <CFP>                 decode the CFP, which is UTF-8 text
+#   encode-file, <infile>, <outfile>
+#   decode-file, <infile>, <outfile>
+#                                 the same, but through files the daemon
+#                                 reads and writes itself
+#
+# and the replies are either "ok" followed by the result (for encode and
+# decode; the file commands write it to outfile instead), or "error"
+# followed by a message.
+#
+# Many messages can be sent at once in a batch:
+#
+#   batch, <id>, <command>, <data>, <command>, <data>, ...
+#
+# where each command is one of the above with a single argument, and id
+# tells this batch's replies apart from any other the client has
+# running.  Each job in a batch gets a reply of its own, as soon as it's
+# done, so they can arrive in any order:
+#
+#   item, <id>, <index of the job>, ok or error, <result or message>
+#
+# and then, once they have all arrived:
+#
+#   done, <id>
+#
+# The daemon answers one more request itself:
+#
+#   stats                         ok, then a JSON object of request
+#                                 counts, latency histograms (overall and
+#                                 for each phase of encoding or decoding),
+#                                 bytes in and out, message bits per byte
+#                                 of CFP, the queue and each worker's busy
+#                                 time
+#
+# Workers send the daemon each reply with an extra frame in front, a JSON
+# report of the request for the stats (see Worker.report), which also holds
+# a trace of the request with --trace.
+PROTOCOL = scipher_client.PROTOCOL
+FILE_COMMANDS = ("encode-file", "decode-file")
+
+# sent by a worker to the daemon when it's ready for its first request
+READY = "READY"
 
 def tprint(msg):
     """like print, but won't get newlines confused with multiple threads"""
     sys.stdout.write(msg + '\n')
     sys.stdout.flush()
 
+# log one in every log_every requests (none if 0); set by --log-every
+log_every = 0
+log_count = 0
+
+def log_request(msg):
+    """tprint for the line logged for each request, if it's sampled."""
+    global log_count
+    if log_every > 0:
+        log_count += 1
+        if log_count % log_every == 0:
+            tprint(msg)
+
+# where to write a trace of each request, if anywhere, and whether to count
+# each nonterminal's choices in it; set by --trace and --trace-counts
+trace_file = None
+trace_counts = False
+
+# whether to compress messages before encoding them, if that helps (see
+# encode.message_state); set by --compress
+compress = False
+
+def write_trace(worker, client, report):
+    """Write the trace in a request's report to trace_file, one JSON
+    object per line."""
+    trace = dict(report['trace'])
+    trace.update({'worker': worker, 'client': client.encode('hex'),
+                  'command': report['command'], 'ok': report['ok'],
+                  'time': time.time()})
+    trace_file.write(json.dumps(trace, sort_keys=True) + "\n")
+    trace_file.flush()
+
+def rss_mb():
+    """This process's resident set size, in MB (or its peak, where the
+    current size isn't available)."""
+    try:
+        f = open('/proc/self/statm')
+        pages = int(f.read().split()[1])
+        f.close()
+        return pages*resource.getpagesize()/(1024.0*1024.0)
+    except (IOError, OSError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024.0
+
 class States:
-    def __init__(self):
-        self.encode_states = {}
-        self.decode_states = {}
-        # get the latest version and work backwards
-        version = cfp_common.CfpCommon.get_latest_common().version()
-        self.latest_version = version
-        while version >= 0:
+    """The grammars for each version.  The latest version, which all encoding
+    and most decoding uses, is loaded up front.  Older versions are only
+    needed for decoding, so they are loaded the first time a CFP needs them
+    and kept in a least-recently-used cache of up to max_old versions,
+    unless they're listed in preload."""
+    def __init__(self, max_old=2, preload=()):
+        self.max_old = max_old
+        self.lock = threading.Lock()
+        # version -> DecodeState, for preloaded versions
+        self.pinned = {}
+        # version -> DecodeState for other old versions, least recently
+        # used first
+        self.recent = collections.OrderedDict()
+
+        common = cfp_common.CfpCommon.get_latest_common()
+        self.latest_version = common.version()
+        start = time.time()
+        rss = rss_mb()
+        self.encode_state = self.load_encode_state(common)
+        self.pinned[self.latest_version] = self.load_decode_state(common)
+        self.report(self.latest_version, start, rss)
+
+        for version in preload:
             common = cfp_common.CfpCommon.get_common_for_version(version)
-            if common is None:
-                continue
-
-            # encode state
-            header_grammar = nltk.data.load("file:%s" %
-                                            common.header_cfg_filename(),
-                                            'cfg')
-            body_grammar = nltk.data.load("file:%s" %
-                                          common.body_cfg_filename(),
-                                          'cfg')
-            space_before = re.compile('\s([%s])' %
-                                      common.chars_to_remove_a_space_before())
-            space_after = re.compile('([%s])\s' %
-                                     common.chars_to_remove_a_space_after())
-            last_or_nots = common.choose_last_or_nots()
-            estate = encode.EncodeState("", None, common, header_grammar,
-                                        body_grammar, {}, space_before,
-                                        space_after, last_or_nots, None)
-            self.encode_states[version] = estate
-
-            # decode state
-            de_header_grammar = decode.load_and_norm_grammar(
-                common.header_cfg_filename())
-            de_body_grammar = decode.load_and_norm_grammar(
-                common.body_cfg_filename())
-            de_space_before = re.compile(
-                '([%s])' % common.chars_to_remove_a_space_before())
-            de_space_after = re.compile(
-                '([%s])' % common.chars_to_remove_a_space_after())
-            destate = decode.DecodeState(common, "", 0, de_header_grammar,
-                                         de_body_grammar, {}, de_space_before,
-                                         de_space_after, None)
-            self.decode_states[version] = destate
-
-            version -= 1
+            if common is not None and version not in self.pinned:
+                start = time.time()
+                rss = rss_mb()
+                self.pinned[version] = self.load_decode_state(common)
+                self.report(version, start, rss)
+
+    def report(self, version, start, rss):
+        tprint('Loaded grammar version %d in %.2fs, RSS %.1f MB (+%.1f MB)' %
+               (version, time.time() - start, rss_mb(), rss_mb() - rss))
+
+    def load_encode_state(self, common):
+        header_grammar = grammar_cache.load_grammar(
+            common.header_cfg_filename())
+        body_grammar = grammar_cache.load_grammar(
+            common.body_cfg_filename())
+        # build the encoder's tables here, not in the workers
+        header_grammar.choices(common)
+        body_grammar.choices(common)
+        return encode.base_state(common, header_grammar, body_grammar)
+
+    def load_decode_state(self, common):
+        # not decode.load_and_norm_grammar, which would keep evicted
+        # grammars around
+        de_header_grammar = grammar_cache.load_decode_grammar(
+            common.header_cfg_filename())
+        de_body_grammar = grammar_cache.load_decode_grammar(
+            common.body_cfg_filename())
+        de_header_grammar.choices(common)
+        de_body_grammar.choices(common)
+        de_header_grammar.parser()
+        de_body_grammar.parser()
+        de_space_before = re.compile(
+            '([%s])' % common.chars_to_remove_a_space_before())
+        de_space_after = re.compile(
+            '([%s])' % common.chars_to_remove_a_space_after())
+        return decode.DecodeState(common, "", 0, de_header_grammar,
+                                  de_body_grammar, {}, de_space_before,
+                                  de_space_after, None)
+
+    def decode_state(self, version):
+        """The DecodeState for version, or None if there is no such
+        version."""
+        s = self.pinned.get(version)
+        if s is not None:
+            return s
+        with self.lock:
+            s = self.recent.pop(version, None)
+            if s is None:
+                common = cfp_common.CfpCommon.get_common_for_version(version)
+                if common is None:
+                    return None
+                start = time.time()
+                rss = rss_mb()
+                s = self.load_decode_state(common)
+                self.report(version, start, rss)
+                if self.max_old <= 0:
+                    return s
+                while len(self.recent) >= self.max_old:
+                    (old, _) = self.recent.popitem(last=False)
+                    tprint('Unloaded grammar version %d' % old)
+            self.recent[version] = s
+            return s
 
 class Worker(threading.Thread):
-    """ServerWorker"""
-    def __init__(self, context, states):
+    """ServerWorker.  Runs as a thread, or in a process of its own if
+    parent is the pid of the daemon (see start_process)."""
+    def __init__(self, context, states, backend, identity, parent=None):
         threading.Thread.__init__ (self)
         self.context = context
         self.states = states
+        self.backend = backend
+        self.identity = identity
+        self.parent = parent
+
+    def encode_lines(self, input_text, timer=None):
+        """The lines of the CFP for input_text."""
+        state = encode.message_state(self.states.encode_state, input_text,
+                                     timer, compress=compress)
+        (header, body_lines) = encode.encode_stream(state)
+        yield header
+        yield u""
+        for line in body_lines:
+            yield line
+
+    def grammars(self, version):
+        """Like decode.load_grammars, from the preloaded states."""
+        s = self.states.decode_state(version)
+        if s is None:
+            return None
+        return (s.common, s.header_grammar, s.body_grammar)
+
+    def decode_lines(self, lines, timer=None):
+        """Decode the CFP in lines, an iterator over its lines, which is
+        only read as far as needed."""
+        return decode.decode_cfp(decode.read_header(lines), lines,
+                                 self.grammars, timer=timer)
 
-    def process_encode(self, infile, outfile):
-        input_text = ""
+    def process_encode(self, infile, outfile, timer=None):
         inf = io.open(infile, 'r', encoding='utf-8')
-        for line in inf:
-            input_text += line
+        input_text = inf.read()
         inf.close()
 
-        s = self.states.encode_states[self.states.latest_version]
-        state = encode.EncodeState(input_text, encode.Bitstring(), s.common,
-                                   s.header_grammar, s.body_grammar, {},
-                                   s.space_before, s.space_after,
-                                   s.last_or_nots, encode.LastTime())
-        (header, body) = encode.do_encode(state)
-
         outf = io.open(outfile, 'w', encoding='utf-8')
-        outf.write("%s\n\n%s\n" % (header, body))
+        for line in self.encode_lines(input_text, timer):
+            outf.write(u"%s\n" % line)
         outf.close()
 
-    def process_decode(self, infile, outfile):
+    def process_decode(self, infile, outfile, timer=None):
         inf = io.open(infile, 'r', encoding='utf-8')
-        # search until blank line:
-        header = ""
-        header_lines = []
-        for line in inf:
-            line = line.rstrip()
-            # we hit a blank line, and we have at least one line already
-            if not line and len(header_lines) > 0:
-                break
-            header_lines.append(line)
-            header = " ".join(header_lines)
-
-        (conf_name, mask, version, ls_len) = decode.decode_conf_name(header)
-        s = self.states.decode_states.get(version, None)
-        if s is None:
-            inf.close()
-            return
-
-        body_text = ""
-        for line in inf:
-            body_text += line
+        # the rest of the file is only read as far as needed
+        msg = self.decode_lines(inf, timer)
         inf.close()
 
-        state = decode.DecodeState(s.common, conf_name, mask,
-                                   s.header_grammar, s.body_grammar, {},
-                                   s.space_before, s.space_after, decode.Done())
-        msg = decode.decode(header, body_text, state, ls_len)
-
         outf = io.open(outfile, 'w', encoding='utf-8')
         outf.write(msg)
         outf.close()
 
+    def handle(self, request, timer=None):
+        """Carry out a request (see PROTOCOL), and return the reply.  The
+        time spent in each phase is added to timer, if given."""
+        if len(request) < 2 or request[0] != PROTOCOL:
+            return [PROTOCOL, "error",
+                    "Unsupported protocol; this daemon speaks %s" % PROTOCOL]
+        command = request[1]
+        args = request[2:]
+        try:
+            if command == "encode" and len(args) == 1:
+                text = args[0].decode('utf-8')
+                cfp = u"".join(u"%s\n" % line
+                               for line in self.encode_lines(text, timer))
+                return [PROTOCOL, "ok", cfp.encode('utf-8')]
+            elif command == "decode" and len(args) == 1:
+                lines = iter(args[0].decode('utf-8').splitlines(True))
+                return [PROTOCOL, "ok",
+                        self.decode_lines(lines, timer).encode('utf-8')]
+            elif command in FILE_COMMANDS and len(args) == 2:
+                try:
+                    if command == "encode-file":
+                        self.process_encode(args[0], args[1], timer)
+                    else:
+                        self.process_decode(args[0], args[1], timer)
+                except Exception as e:
+                    outf = io.open(args[1], 'w', encoding='utf-8')
+                    outf.write(u"%s\n" % unicode(e))
+                    outf.close()
+                    raise
+                return [PROTOCOL, "ok"]
+            else:
+                return [PROTOCOL, "error", "Bad request: %s with %d frames" %
+                        (command, len(args))]
+        except Exception as e:
+            return [PROTOCOL, "error", unicode(e).encode('utf-8')]
+
+    def report(self, request, reply, timer):
+        """The numbers from a request for the daemon's stats."""
+        command = request[1] if len(request) > 1 else ""
+        ok = reply[1] == "ok"
+        if command in FILE_COMMANDS and len(request) == 4:
+            (bytes_in, bytes_out) = [os.path.getsize(f)
+                                     if os.path.isfile(f) else 0
+                                     for f in request[2:]]
+        else:
+            bytes_in = sum(len(f) for f in request[2:])
+            bytes_out = sum(len(f) for f in reply[2:])
+        report = {'command': command, 'ok': ok, 'phases': timer.phases,
+                  'bytes_in': bytes_in, 'bytes_out': bytes_out}
+        # the message's bits (as UTF-8), and the bytes of CFP for them
+        if command in ("encode", "encode-file"):
+            (report['message_bits'], report['cfp_bytes']) = (bytes_in*8,
+                                                             bytes_out)
+        elif command in ("decode", "decode-file"):
+            (report['message_bits'], report['cfp_bytes']) = (bytes_out*8,
+                                                             bytes_in)
+        return report
+
     def run(self):
         worker = self.context.socket(zmq.DEALER)
-        worker.connect('inproc://backend')
-        tprint('Worker started')
+        worker.identity = self.identity
+        worker.connect(self.backend)
+        worker.send_multipart([READY])
+        tprint('Worker %s started' % self.identity)
         while True:
-            ident, task = worker.recv_multipart()
-            task = pickle.loads(task)
-            tprint('Worker received %s from %s' % (task, ident))
-            ok = True
-            try:
-                if task.encode:
-                    self.process_encode(task.infile, task.outfile)
-                else:
-                    self.process_decode(task.infile, task.outfile)
-                worker.send_multipart([ident, str(True)])
-            except Exception as e:
-                outf = io.open(task.outfile, 'w', encoding='utf-8')
-                outf.write("%s\n" % unicode(e))
-                outf.close()
-                worker.send_multipart([ident, str(False)])
+            if self.parent is not None and not worker.poll(1000):
+                # don't outlive the daemon
+                if os.getppid() != self.parent:
+                    break
+                continue
+            frames = worker.recv_multipart()
+            (ident, request) = (frames[0], frames[1:])
+            if trace_file is not None:
+                timer = stats.Tracer(trace_counts)
+            else:
+                timer = stats.Timer()
+            reply = self.handle(request, timer)
+            report = self.report(request, reply, timer)
+            if trace_file is not None:
+                report['trace'] = timer.to_dict()
+            worker.send_multipart([ident, json.dumps(report)] + reply)
 
         worker.close()
 
-
-def call_daemon(socket_name, encode, infile_arg, outfile_arg):
-     infile = infile_arg
-     if not infile:
-          # write the data to a temporary file and call the daemon
-          (inf, infile) = tempfile.mkstemp()
-          for line in sys.stdin:
-               os.write(inf, line)
-          os.close(inf)
-
-     outfile = outfile_arg
-     if not outfile:
-          (outf, outfile) = tempfile.mkstemp()
-          os.close(outf)
-     task = Task(encode, infile, outfile)
-
-     context = zmq.Context()
-     socket = context.socket(zmq.DEALER)
-     identity = u'worker-%s' % infile
-     socket.identity = identity.encode('ascii')
-     socket.connect(socket_name)
-     socket.send_pyobj(task)
-     ok = socket.recv() == "True"
-
-     if not outfile_arg:
-          outf = open(outfile, 'r')
-          for line in outf:
-               if ok:
-                   print line,
-               else:
-                   sys.stderr.write(line)
-          outf.close()
-          os.unlink(outfile)
-
-     if not infile_arg:
-          os.unlink(infile)
-     return ok
+def start_process(states, backend):
+    """Fork a worker process, and return its pid.  The child shares the
+    grammars already loaded into states with the daemon."""
+    parent = os.getpid()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            # the daemon's zmq context can't be used after a fork
+            context = zmq.Context()
+            Worker(context, states, backend, "process-%d" % os.getpid(),
+                   parent).run()
+        finally:
+            os._exit(0)
+    return pid
+
+class Broker:
+    """Hands requests to idle workers, one at a time, and their replies back
+    to the clients.  Requests wait in a queue until a worker is free.  The
+    jobs in a batch are queued as separate requests, so they're spread
+    across all the workers."""
+    def __init__(self, frontend, backend):
+        self.frontend = frontend
+        self.backend = backend
+        self.idle = collections.deque()
+        # worker identity -> (client, batch, index, start time) it's working
+        # for; batch and index are None outside of batches
+        self.busy = {}
+        # (client, request frames, batch, index) waiting for a worker
+        self.waiting = collections.deque()
+        # (client, batch id) -> number of jobs not yet answered
+        self.batches = {}
+        self.stats = stats.Stats()
+        self.max_waiting = 0
+
+    def dispatch(self):
+        while self.idle and self.waiting:
+            worker = self.idle.popleft()
+            (client, request, batch, index) = self.waiting.popleft()
+            self.busy[worker] = (client, batch, index, time.time())
+            self.backend.send_multipart([worker, client] + request)
+
+    def stats_reply(self):
+        d = self.stats.to_dict()
+        d['queue'] = {'waiting': len(self.waiting),
+                      'max_waiting': self.max_waiting,
+                      'busy_workers': len(self.busy),
+                      'idle_workers': len(self.idle)}
+        return [PROTOCOL, "ok", json.dumps(d)]
+
+    def from_client(self, frames):
+        (client, request) = (frames[0], frames[1:])
+        if request == [PROTOCOL, "stats"]:
+            self.frontend.send_multipart([client] + self.stats_reply())
+            return
+        if request[:1] == [PROTOCOL] and request[1:2] == ["batch"]:
+            self.start_batch(client, request[2:])
+        else:
+            self.waiting.append((client, request, None, None))
+        self.max_waiting = max(self.max_waiting, len(self.waiting))
+        self.dispatch()
+
+    def start_batch(self, client, args):
+        if len(args) % 2 != 1:
+            self.frontend.send_multipart(
+                [client, PROTOCOL, "error",
+                 "Bad request: batch with %d frames" % len(args)])
+            return
+        batch = args[0]
+        jobs = len(args)//2
+        if (client, batch) in self.batches:
+            self.frontend.send_multipart(
+                [client, PROTOCOL, "error",
+                 "Batch %s is already running" % batch])
+            return
+        if jobs == 0:
+            self.frontend.send_multipart([client, PROTOCOL, "done", batch])
+            return
+        self.batches[(client, batch)] = jobs
+        for i in range(jobs):
+            self.waiting.append((client, [PROTOCOL] + args[2*i+1:2*i+3],
+                                 batch, i))
+
+    def reply(self, client, batch, index, reply):
+        if batch is None:
+            self.frontend.send_multipart([client] + reply)
+            return
+        self.frontend.send_multipart([client, PROTOCOL, "item", batch,
+                                      str(index)] + reply[1:])
+        self.batches[(client, batch)] -= 1
+        if self.batches[(client, batch)] == 0:
+            del self.batches[(client, batch)]
+            self.frontend.send_multipart([client, PROTOCOL, "done", batch])
+
+    def from_worker(self, frames):
+        worker = frames[0]
+        job = self.busy.pop(worker, None)
+        if job is not None and len(frames) > 3:
+            (client, batch, index, start) = job
+            busy = time.time() - start
+            report = json.loads(frames[2])
+            self.stats.record(worker, busy, report)
+            if 'trace' in report:
+                write_trace(worker, client, report)
+            log_request('%s: %s for %s, %s in %.1f ms' %
+                        (worker, report['command'], client.encode('hex'),
+                         "ok" if report['ok'] else "error", busy*1000))
+            self.reply(client, batch, index, frames[3:])
+        self.idle.append(worker)
+        self.dispatch()
+
+    def worker_gone(self, worker):
+        if worker in self.idle:
+            self.idle.remove(worker)
+        job = self.busy.pop(worker, None)
+        if job is not None:
+            (client, batch, index, start) = job
+            self.reply(client, batch, index,
+                       [PROTOCOL, "error",
+                        "The worker died while handling this request"])
 
 def main():
     parser = argparse.ArgumentParser()
@@ -194,39 +469,101 @@ def main():
                         default="ipc:///tmp/scipherd",
                         help='the local socket to bind to')
     parser.add_argument('--workers', metavar='w', type=int, default=1,
-                        help='the local socket to bind to')
+                        help='the number of workers')
+    parser.add_argument('--processes', action='store_true',
+                        help='run each worker in a process of its own, '
+                        'instead of a thread')
+    parser.add_argument('--compress', action='store_true',
+                        help='compress messages before encoding them, if '
+                        'that makes the CFPs shorter')
+    parser.add_argument('--old-versions', metavar='N', type=int, default=2,
+                        help='the most older grammar versions to keep loaded '
+                        'for decoding, besides the preloaded ones')
+    parser.add_argument('--preload', metavar='V,V,...', type=str, default='',
+                        help='older grammar versions to load at startup and '
+                        'keep loaded, or "all"')
+    parser.add_argument('--log-every', metavar='N', type=int, default=0,
+                        help='log one in every N requests (none by default)')
+    parser.add_argument('--trace', metavar='FILE', type=str,
+                        help='append a JSON trace of each request to FILE, '
+                        'one per line')
+    parser.add_argument('--trace-counts', action='store_true',
+                        help='with --trace, also count the choices made for '
+                        'each nonterminal')
+    parser.add_argument('--stats', action='store_true',
+                        help='print the stats of the daemon already running '
+                        'on the socket, and exit')
     args = parser.parse_args()
-    states = States()
+    if args.stats:
+        print json.dumps(scipher_client.get_stats(args.socket), indent=2,
+                         sort_keys=True)
+        return
+    global log_every, trace_file, trace_counts, compress
+    log_every = args.log_every
+    compress = args.compress
+    if args.trace:
+        trace_file = open(args.trace, 'a')
+        trace_counts = args.trace_counts
+    if args.preload == 'all':
+        preload = cfp_common.CfpCommon.commons.keys()
+    else:
+        preload = [int(v) for v in args.preload.split(',') if v]
+    # load the grammars before any workers start, so worker processes share
+    # them
+    states = States(args.old_versions, preload)
 
     context = zmq.Context()
     frontend = context.socket(zmq.ROUTER)
     frontend.bind(args.socket)
 
-    backend = context.socket(zmq.DEALER)
-    backend.bind('inproc://backend')
-
-    workers = []
+    if args.processes:
+        # clean up (below) when killed, too
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        backend_dir = tempfile.mkdtemp(prefix='scipherd-')
+        backend_name = 'ipc://%s/backend' % backend_dir
+    else:
+        backend_name = 'inproc://backend'
+    backend = context.socket(zmq.ROUTER)
+    backend.bind(backend_name)
+    broker = Broker(frontend, backend)
+
+    # worker pid -> identity, for worker processes
+    processes = {}
     for i in range(args.workers):
-        worker = Worker(context, states)
-        worker.start()
-        workers.append(worker)
+        if args.processes:
+            pid = start_process(states, backend_name)
+            processes[pid] = "process-%d" % pid
+        else:
+            worker = Worker(context, states, backend_name, "thread-%d" % i)
+            worker.start()
 
     poll = zmq.Poller()
     poll.register(frontend, zmq.POLLIN)
     poll.register(backend,  zmq.POLLIN)
 
-    # load all grammars
-
-    while True:
-        sockets = dict(poll.poll())
-        if frontend in sockets:
-            ident, msg = frontend.recv_multipart()
-            tprint('Server received a message from id %s' % ident)
-            backend.send_multipart([ident, msg])
-        if backend in sockets:
-            ident, msg = backend.recv_multipart()
-            tprint('Sending a message to frontend id %s' % ident)
-            frontend.send_multipart([ident, msg])
+    try:
+        while True:
+            # wake up now and then to check on worker processes
+            sockets = dict(poll.poll(1000 if processes else None))
+            if frontend in sockets:
+                broker.from_client(frontend.recv_multipart())
+            if backend in sockets:
+                broker.from_worker(backend.recv_multipart())
+
+            while processes:
+                (pid, status) = os.waitpid(-1, os.WNOHANG)
+                if pid == 0:
+                    break
+                tprint('Worker %s exited with status %d, restarting' %
+                       (processes[pid], status))
+                broker.worker_gone(processes.pop(pid))
+                pid = start_process(states, backend_name)
+                processes[pid] = "process-%d" % pid
+    finally:
+        for pid in processes:
+            os.kill(pid, signal.SIGTERM)
+        if args.processes:
+            shutil.rmtree(backend_dir, True)
 
     frontend.close()
     backend.close()
@@ -0,0 +1,224 @@
+# Timing and counters for the daemon's stats request (see scipherd.py),
+# and for tracing.
+#
+# Encoding and decoding time their phases into state.timer, if it's set.
+# The daemon's workers then send each request's numbers to the broker,
+# which adds them up in a Stats object.  A Tracer, used as the timer, also
+# keeps each span of time in order, and can count the choices made for
+# each nonterminal; encode.py and decode.py --trace write one out as JSON.
+
+import contextlib
+import json
+import sys
+import time
+
+# the phases that encode.py and decode.py time
+PHASES = ["conf_name", "header", "body", "dates", "pretty_print"]
+
+class Timer:
+     """Time spent in each phase of one encode or decode, in seconds."""
+     # nonterminal name -> [expansions, bits], when they're being counted
+     # (see Tracer)
+     counts = None
+
+     def __init__(self):
+          self.phases = {}
+          # total time added to any phase
+          self.timed = 0.0
+
+     def add(self, phase, start):
+          """Add the time since start to phase, and return the time now."""
+          now = time.time()
+          self.phases[phase] = self.phases.get(phase, 0.0) + now - start
+          self.timed += now - start
+          return now
+
+     def add_rest(self, phase, start, timed):
+          """Like add, but leave out whatever was added to other phases
+          since self.timed was timed, for phases that contain others."""
+          now = time.time()
+          spent = now - start - (self.timed - timed)
+          self.phases[phase] = self.phases.get(phase, 0.0) + spent
+          self.timed += spent
+          return now
+
+     @contextlib.contextmanager
+     def span(self, phase):
+          """Time the body of a with statement as phase."""
+          start = time.time()
+          try:
+               yield
+          finally:
+               self.add(phase, start)
+
+class NoTimer:
+     """Stands in for a Timer when nothing is being timed."""
+     phases = {}
+     timed = 0.0
+     counts = None
+
+     def add(self, phase, start):
+          return 0.0
+
+     def add_rest(self, phase, start, timed):
+          return 0.0
+
+     @contextlib.contextmanager
+     def span(self, phase):
+          yield
+
+class Tracer(Timer):
+     """A Timer that also keeps every span it times, in order, and, if
+     counts is set, how many times each nonterminal was expanded and how
+     many bits of the message its choices held."""
+     def __init__(self, counts=False):
+          Timer.__init__(self)
+          self.start = time.time()
+          # (phase, start, end), in seconds since self.start
+          self.spans = []
+          if counts:
+               self.counts = {}
+
+     def add(self, phase, start):
+          now = Timer.add(self, phase, start)
+          self.spans.append((phase, start - self.start, now - self.start))
+          return now
+
+     def add_rest(self, phase, start, timed):
+          now = Timer.add_rest(self, phase, start, timed)
+          self.spans.append((phase, start - self.start, now - self.start))
+          return now
+
+     def count(self, nonterminal, bits, expansions=1):
+          """Count expansions of nonterminal, whose choices held bits
+          bits of the message between them."""
+          c = self.counts.get(nonterminal)
+          if c is None:
+               c = self.counts[nonterminal] = [0, 0]
+          c[0] += expansions
+          c[1] += bits
+
+     def to_dict(self):
+          d = {'phases_ms': dict((phase, seconds*1000)
+                                 for (phase, seconds)
+                                 in self.phases.iteritems()),
+               'spans': [{'phase': phase, 'start_ms': start*1000,
+                          'end_ms': end*1000}
+                         for (phase, start, end) in self.spans]}
+          if self.counts is not None:
+               d['nonterminals'] = dict(
+                    (nt, {'expansions': n, 'bits': bits})
+                    for (nt, (n, bits)) in self.counts.iteritems())
+          return d
+
+NO_TIMER = NoTimer()
+
+def write_trace(filename, tracer):
+     """Write tracer out as JSON to filename, or to stderr for "-"."""
+     if filename == "-":
+          json.dump(tracer.to_dict(), sys.stderr, indent=2, sort_keys=True)
+          sys.stderr.write("\n")
+          return
+     f = open(filename, 'w')
+     json.dump(tracer.to_dict(), f, indent=2, sort_keys=True)
+     f.write("\n")
+     f.close()
+
+class Histogram:
+     """Counts of values in milliseconds, in power-of-two buckets."""
+     def __init__(self):
+          self.count = 0
+          self.total = 0.0
+          self.max = 0.0
+          # bucket i holds values under 2**i ms (bucket 0: under 1 ms)
+          self.buckets = []
+
+     def add(self, ms):
+          self.count += 1
+          self.total += ms
+          self.max = max(self.max, ms)
+          i = 0
+          while ms >= (1 << i):
+               i += 1
+          if i >= len(self.buckets):
+               self.buckets.extend([0]*(i + 1 - len(self.buckets)))
+          self.buckets[i] += 1
+
+     def percentile(self, p):
+          """The upper bound of the bucket holding the pth percentile."""
+          seen = 0
+          for i in xrange(len(self.buckets)):
+               seen += self.buckets[i]
+               if seen*100 >= p*self.count:
+                    return min(1 << i, self.max)
+          return self.max
+
+     def to_dict(self):
+          d = {'count': self.count, 'total_ms': self.total,
+               'max_ms': self.max,
+               'buckets': dict(("<%d" % (1 << i), self.buckets[i])
+                               for i in xrange(len(self.buckets))
+                               if self.buckets[i])}
+          if self.count:
+               d['mean_ms'] = self.total/self.count
+               for p in (50, 90, 99):
+                    d['p%d_ms' % p] = self.percentile(p)
+          return d
+
+class Stats:
+     """Everything the daemon counts, per command."""
+     def __init__(self):
+          self.start = time.time()
+          self.requests = {}
+          self.errors = {}
+          self.latency = {}
+          # (command, phase) -> Histogram
+          self.phases = {}
+          self.bytes_in = {}
+          self.bytes_out = {}
+          # bits of message, and bytes of CFP they took
+          self.message_bits = {}
+          self.cfp_bytes = {}
+          # worker -> seconds spent on requests
+          self.busy = {}
+
+     def add(self, d, key, n):
+          d[key] = d.get(key, 0) + n
+
+     def record(self, worker, busy, report):
+          """Add one request's report (see Worker.handle) from worker,
+          which was busy with it for busy seconds."""
+          command = report['command']
+          self.add(self.requests, command, 1)
+          if not report['ok']:
+               self.add(self.errors, command, 1)
+          self.add(self.busy, worker, busy)
+          self.latency.setdefault(command, Histogram()).add(busy*1000)
+          for (phase, seconds) in report['phases'].iteritems():
+               self.phases.setdefault((command, phase),
+                                      Histogram()).add(seconds*1000)
+          self.add(self.bytes_in, command, report['bytes_in'])
+          self.add(self.bytes_out, command, report['bytes_out'])
+          if report['ok'] and report.get('message_bits'):
+               self.add(self.message_bits, command, report['message_bits'])
+               self.add(self.cfp_bytes, command, report['cfp_bytes'])
+
+     def to_dict(self):
+          commands = {}
+          for command in self.requests:
+               c = {'requests': self.requests[command],
+                    'errors': self.errors.get(command, 0),
+                    'bytes_in': self.bytes_in.get(command, 0),
+                    'bytes_out': self.bytes_out.get(command, 0),
+                    'latency': self.latency[command].to_dict(),
+                    'phases': dict((phase, h.to_dict())
+                                   for ((cmd, phase), h)
+                                   in self.phases.iteritems()
+                                   if cmd == command)}
+               if self.cfp_bytes.get(command):
+                    c['bits_per_cfp_byte'] = (float(self.message_bits[command])/
+                                              self.cfp_bytes[command])
+               commands[command] = c
+          return {'uptime_s': time.time() - self.start,
+                  'commands': commands,
+                  'worker_busy_s': dict(self.busy)}